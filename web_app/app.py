@@ -1,18 +1,32 @@
+import heapq
 import json
 import os
 import random
 import sys
-from typing import List, Tuple, Dict, NamedTuple
+import threading
+import time
+from typing import List, Tuple, Dict, NamedTuple, AbstractSet, Optional
 
-from flask import Flask, render_template, redirect, url_for, session, request, jsonify, abort
+from flask import Flask, render_template, redirect, url_for, session, request, jsonify, abort, send_from_directory
 from flask_session import Session
+from sqlalchemy.orm import selectinload, load_only
+from werkzeug.exceptions import BadRequest
 
+import completion
+import metrics
+import neighbors
 import similarity
+import snapshots
+import thumbnails
 import triplets
 from forms import LogInForm, SignUpForm
-from tables import db, FashionItem, User, Outfit
+from memory import process_memory
+from tables import db, database_uri, item_path, FashionItem, User, Outfit, user_items, merge_category
+from validation import InvalidRequest, int_field, int_list_field, json_object, mask_weights, diversity_lambda, \
+    wardrobe_scope
 
-CONFIG_FILE_PATH = 'config.json'
+# Overridable so load tests can run the app against a stand-in database
+CONFIG_FILE_PATH = os.environ.get('CONFIG_FILE', 'config.json')
 
 if not os.path.exists(CONFIG_FILE_PATH):
     with open(CONFIG_FILE_PATH, 'w') as config_file:
@@ -29,37 +43,119 @@ if not os.path.exists(CONFIG_FILE_PATH):
     print('Please fill out config.json')
     sys.exit(0)
 
+# The session cache counts every write towards its threshold, overwrites included, and once over it deletes every
+# third session file, logging those users out. Sessions are written on every request, so the threshold has to be far
+# above the number of requests between restarts rather than the number of users.
+SESSION_FILE_THRESHOLD = 100000
+
 application = Flask(__name__)
 
 application.config['SESSION_TYPE'] = 'filesystem'
+application.config['SESSION_FILE_THRESHOLD'] = SESSION_FILE_THRESHOLD
 Session(application)
 
 application.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 with open(CONFIG_FILE_PATH) as config_file:
     config_json = json.load(config_file)
 
-    db_json = config_json['database']
-    application.config['SQLALCHEMY_DATABASE_URI'] = 'mysql+pymysql://{}:{}@{}:{}/{}'.format(
-        db_json['user'],
-        db_json['password'],
-        db_json['host'],
-        db_json['port'],
-        db_json['database']
-    )
+    application.config['SQLALCHEMY_DATABASE_URI'] = database_uri(config_json['database'])
 
     application.config['SECRET_KEY'] = config_json['secret_key']
+    similarity.configure_indexes(config_json.get('indexes', {}))
+    similarity.configure_result_cache(config_json.get('result_cache', {}))
 db.init_app(application)
+metrics.init_app(application)
 
 with application.app_context():
     db.create_all()
+    similarity.add_missing_columns(db.session, User.__table__)
+    similarity.migrate_packed_embeddings(db.session)
 
     if __name__ == '__main__':
         similarity.load_all_items(db.session)
 
 with application.app_context():
     similarity.load_primary_indexes(db.session)
+    similarity.load_catalog(db.session)
+    similarity.warm_up_indexes()
+
+    # gunicorn preloads the app and forks the workers from this process, which would otherwise inherit the pooled
+    # connections used above and share their sockets between processes
+    db.session.remove()
+    db.engine.dispose()
+thumbnails.load_thumbnails()
+application.jinja_env.globals['thumbnail_url'] = thumbnails.thumbnail_url
+
+
+def refresh_indexes():
+    while True:
+        time.sleep(similarity.DELTA_REFRESH_SECONDS)
+
+        with application.app_context():
+            try:
+                similarity.refresh_indexes(db.session)
+            except Exception as e:
+                print('Failed to refresh indexes: {}'.format(e))
+            finally:
+                db.session.remove()
+
+
+# Started per worker on its first request, since threads started before a fork don't exist in the workers
+@application.before_first_request
+def start_index_refresh():
+    threading.Thread(target=refresh_indexes, daemon=True).start()
+
+
+@application.errorhandler(InvalidRequest)
+def invalid_request(e: InvalidRequest):
+    return BadRequest(str(e)).get_response()
+
+
+def request_json() -> Dict:
+    return json_object(request.get_json(silent=True))
+
 
 USER_ID_KEY = 'user_id'
+MAX_BATCH_QUERIES = 32
+MAX_RESULTS_PER_CATEGORY = 10
+MAX_OUTFIT_ITEMS = 20
+MAX_COMPLETION_BUDGET_SECONDS = 0.5
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+TRIPLETS_PAGE_SIZE = 1000
+
+# Columns needed to display an item, so pages don't load the packed embeddings of every item they show
+DISPLAY_COLUMNS = ('id', 'name', 'category', 'semantic_category')
+
+# Wardrobe items rendered with a page, the rest are fetched by the page from the wardrobe API
+WARDROBE_PAGE_SIZE = 24
+MAX_WARDROBE_PAGE_SIZE = 200
+
+# Queries to read a user snapshot: its version, and loading it when the cached one is missing or stale, including the
+# categories of items missing from the catalog
+SNAPSHOT_QUERIES = 3
+# Queries to bump and read back the wardrobe version of a change
+VERSION_QUERIES = 2
+
+# Maximum number of database queries per request, checked when the app is in testing mode. Recommendations may
+# query the categories, details and, for fused and diversified queries, embeddings of new items that are not in the
+# compiled catalog yet.
+QUERY_BUDGETS = {
+    'login': 1,
+    'signup': 2,
+    'wardrobe': 1 + SNAPSHOT_QUERIES,
+    'randomize_wardrobe': 3 + VERSION_QUERIES,
+    'outfits': 3 + SNAPSHOT_QUERIES,
+    'outfit_creator': 1 + SNAPSHOT_QUERIES,
+    'api_wardrobe': 1 + SNAPSHOT_QUERIES,
+    'api_add_wardrobe_item': 3 + VERSION_QUERIES,
+    'api_remove_wardrobe_item': 1 + VERSION_QUERIES,
+    'api_create_outfit': 3,
+    'api_delete_outfit': 3,
+    'api_recommend': 6 + SNAPSHOT_QUERIES,
+    'api_recommend_batch': 3 + 3 * MAX_BATCH_QUERIES + SNAPSHOT_QUERIES,
+    'api_complete_outfit': 3 + SNAPSHOT_QUERIES
+}
+metrics.set_query_budgets(QUERY_BUDGETS)
 
 
 @application.route('/')
@@ -102,9 +198,10 @@ def signup():
         if user is None:
             user = User(username=form.username.data)
             db.session.add(user)
+            db.session.flush()
+            session[USER_ID_KEY] = user.id
             db.session.commit()
 
-            session[USER_ID_KEY] = user.id
             return redirect(url_for('index'))
 
         form.username.errors.append('That username is taken.')
@@ -117,12 +214,62 @@ def item_from_path(path: str) -> FashionItem:
     return db.session.query(FashionItem).filter(FashionItem.name == item_name).one()
 
 
-def by_category(items: List[FashionItem]) -> Dict[str, FashionItem]:
-    items_by_category = {k: [] for k in similarity.MERGED_CATEGORIES}
-    for item in items:
-        items_by_category[item.merged_category()].append(item)
+def wardrobe_item_ids(user_id: int) -> List[int]:
+    return [r[0] for r in db.session.query(user_items.c.item_id).filter(user_items.c.user_id == user_id)]
+
+
+def load_user_snapshot(user_id: int, username: str, version: int) -> snapshots.UserSnapshot:
+    wardrobe_ids = wardrobe_item_ids(user_id)
+    return snapshots.create_snapshot(
+        user_id, username, version, similarity.item_merged_categories(db.session, wardrobe_ids))
+
+
+def user_snapshot() -> snapshots.UserSnapshot:
+    user_id = session[USER_ID_KEY]
+    username, version = db.session.query(User.username, User.wardrobe_version).filter(User.id == user_id).one()
+    return snapshots.get_snapshot(user_id, version, lambda: load_user_snapshot(user_id, username, version))
+
+
+def bump_wardrobe_version(user_id: int) -> int:
+    # Part of the transaction of every wardrobe change, whose row lock keeps other changes from bumping it again
+    # before the commit
+    db.session.execute(User.__table__.update()
+                       .where(User.id == user_id)
+                       .values(wardrobe_version=User.wardrobe_version + 1))
+    return db.session.query(User.wardrobe_version).filter(User.id == user_id).scalar()
+
+
+def load_wardrobe_items(user_id: int) -> List[FashionItem]:
+    return db.session.query(FashionItem)\
+        .join(user_items, user_items.c.item_id == FashionItem.id)\
+        .filter(user_items.c.user_id == user_id).all()
+
 
-    return items_by_category
+def in_wardrobe(user_id: int, item_id: int) -> bool:
+    return db.session.query(user_items.c.item_id)\
+        .filter(user_items.c.user_id == user_id, user_items.c.item_id == item_id).first() is not None
+
+
+class WardrobePage(NamedTuple):
+    items: List[similarity.Item]
+    # Id of the last item of the page, if there are more items after it
+    next_cursor: Optional[int]
+
+
+def wardrobe_pages(snapshot: snapshots.UserSnapshot, categories: List[str], cursor: int = -1,
+                   limit: int = WARDROBE_PAGE_SIZE) -> Dict[str, WardrobePage]:
+    # Pages of items ordered by id, for each category. Items are hydrated from the catalog together, with only the
+    # items of the pages ever read from the database.
+    page_ids = {}
+    for cat in categories:
+        ids = heapq.nsmallest(limit + 1, (i for i in snapshot.wardrobe_by_category.get(cat, ()) if i > cursor))
+        page_ids[cat] = (ids[:limit], ids[limit - 1] if len(ids) > limit else None)
+
+    items = similarity.hydrate_items(db.session, [i for ids, _ in page_ids.values() for i in ids])
+    return {
+        cat: WardrobePage([items[i] for i in ids if i in items], next_cursor)
+        for cat, (ids, next_cursor) in page_ids.items()
+    }
 
 
 @application.route('/wardrobe')
@@ -130,11 +277,11 @@ def wardrobe():
     if USER_ID_KEY not in session:
         return redirect('/')
 
-    user = db.session.query(User).filter(User.id == session[USER_ID_KEY]).one()
+    snapshot = user_snapshot()
     return render_template('wardrobe.html',
-                           username=user.username,
-                           user_wardrobe=user.wardrobe_items,
-                           wardrobe_by_category=by_category(user.wardrobe_items),
+                           username=snapshot.username,
+                           wardrobe_count=len(snapshot.wardrobe_ids),
+                           wardrobe_pages=wardrobe_pages(snapshot, similarity.MERGED_CATEGORIES),
                            display_categories=similarity.MERGED_CATEGORIES_DISPLAY)
 
 
@@ -143,16 +290,19 @@ def randomize_wardrobe():
     if USER_ID_KEY not in session:
         return redirect('/')
 
-    user = db.session.query(User).filter(User.id == session[USER_ID_KEY]).one()
-    if len(user.wardrobe_items) > 0:
+    user_id = session[USER_ID_KEY]
+    if db.session.query(user_items.c.item_id).filter(user_items.c.user_id == user_id).first() is not None:
         abort(400)
 
     random_ids = random.sample(list(range(0, 250000)), random.randrange(200, 300))
 
-    random_items = db.session.query(FashionItem).filter(FashionItem.id.in_(random_ids)).all()
-    for item in random_items:
-        user.wardrobe_items.append(item)
+    random_item_ids = [r[0] for r in db.session.query(FashionItem.id).filter(FashionItem.id.in_(random_ids))]
+    if len(random_item_ids) > 0:
+        db.session.execute(user_items.insert(), [{'user_id': user_id, 'item_id': i} for i in random_item_ids])
+    bump_wardrobe_version(user_id)
     db.session.commit()
+    similarity.invalidate_wardrobe_indexes(user_id)
+    snapshots.invalidate_snapshot(user_id)
 
     return redirect(url_for('wardrobe'))
 
@@ -162,10 +312,12 @@ def outfits():
     if USER_ID_KEY not in session:
         return redirect('/')
 
-    user = db.session.query(User).filter(User.id == session[USER_ID_KEY]).one()
+    user = db.session.query(User)\
+        .options(selectinload(User.outfits).selectinload(Outfit.items).load_only(*DISPLAY_COLUMNS))\
+        .filter(User.id == session[USER_ID_KEY]).one()
     return render_template('outfits.html',
                            username=user.username,
-                           user=user,
+                           wardrobe_ids=user_snapshot().wardrobe_ids,
                            outfits=user.outfits)
 
 
@@ -174,32 +326,70 @@ def outfit_creator():
     if USER_ID_KEY not in session:
         return redirect('/')
 
-    user = db.session.query(User).filter(User.id == session[USER_ID_KEY]).one()
+    snapshot = user_snapshot()
     return render_template('outfit_creator.html',
-                           username=user.username,
-                           user_wardrobe=user.wardrobe_items,
-                           wardrobe_by_category=by_category(user.wardrobe_items),
+                           username=snapshot.username,
+                           wardrobe_pages=wardrobe_pages(snapshot, similarity.MERGED_CATEGORIES),
                            categories=similarity.MERGED_CATEGORIES,
                            display_categories=similarity.MERGED_CATEGORIES_DISPLAY)
 
 
+@application.route('/api/wardrobe')
+def api_wardrobe():
+    if USER_ID_KEY not in session:
+        abort(403)
+
+    category = request.args.get('category')
+    if category is not None and category not in similarity.MERGED_CATEGORIES:
+        abort(400)
+    size = request.args.get('size', 'small')
+    if size not in thumbnails.THUMBNAIL_SIZES:
+        abort(400)
+
+    pages = wardrobe_pages(
+        snapshot=user_snapshot(),
+        categories=[category] if category is not None else similarity.MERGED_CATEGORIES,
+        cursor=request.args.get('cursor', -1, type=int),
+        limit=min(max(request.args.get('limit', WARDROBE_PAGE_SIZE, type=int), 1), MAX_WARDROBE_PAGE_SIZE)
+    )
+
+    return jsonify({
+        'results': [{
+            'category': cat,
+            'items': [{
+                'id': item.id,
+                'path': item.get_path(),
+                'thumbnail': thumbnails.thumbnail_url(item, size),
+                'category': item.merged_category()
+            } for item in page.items],
+            'next_cursor': page.next_cursor
+        } for cat, page in pages.items()]
+    })
+
+
 @application.route('/api/add_wardrobe_item', methods=['POST'])
 def api_add_wardrobe_item():
     if USER_ID_KEY not in session:
         abort(403)
 
-    user = db.session.query(User).filter(User.id == session[USER_ID_KEY]).one()
-    item = db.session.query(FashionItem).filter(FashionItem.id == request.json['item_id']).one()
+    user_id = session[USER_ID_KEY]
+    item = db.session.query(FashionItem.id, FashionItem.semantic_category)\
+        .filter(FashionItem.id == int_field(request_json(), 'item_id')).first()
 
-    if item in user.wardrobe_items:
+    if item is None or in_wardrobe(user_id, item.id):
         abort(400)
 
-    user.wardrobe_items.append(item)
+    item_id = item.id
+    db.session.execute(user_items.insert().values(user_id=user_id, item_id=item_id))
+    version = bump_wardrobe_version(user_id)
     db.session.commit()
+    similarity.invalidate_wardrobe_indexes(user_id)
+    snapshots.update_snapshot(user_id, version,
+                              lambda s: s.with_wardrobe_item(item_id, merge_category(item.semantic_category)))
 
     return jsonify({
         'success': True,
-        'item_id': item.id
+        'item_id': item_id
     })
 
 
@@ -208,18 +398,24 @@ def api_remove_wardrobe_item():
     if USER_ID_KEY not in session:
         abort(403)
 
-    user = db.session.query(User).filter(User.id == session[USER_ID_KEY]).one()
-    item = db.session.query(FashionItem).filter(FashionItem.id == request.json['item_id']).one()
+    user_id = session[USER_ID_KEY]
+    item_id = int_field(request_json(), 'item_id')
 
-    if item not in user.wardrobe_items:
+    # The item is only in the wardrobe if a row was deleted
+    deleted = db.session.execute(user_items.delete().where(
+        (user_items.c.user_id == user_id) & (user_items.c.item_id == item_id))).rowcount
+    if deleted == 0:
+        db.session.rollback()
         abort(400)
 
-    user.wardrobe_items.remove(item)
+    version = bump_wardrobe_version(user_id)
     db.session.commit()
+    similarity.invalidate_wardrobe_indexes(user_id)
+    snapshots.update_snapshot(user_id, version, lambda s: s.without_wardrobe_item(item_id))
 
     return jsonify({
         'success': True,
-        'item_id': item.id
+        'item_id': item_id
     })
 
 
@@ -228,21 +424,31 @@ def api_create_outfit():
     if USER_ID_KEY not in session:
         abort(403)
 
-    user = db.session.query(User).filter(User.id == session[USER_ID_KEY]).one()
-    items = db.session.query(FashionItem).filter(FashionItem.id.in_(request.json['items'])).all()
+    query_json = request_json()
+    name = query_json.get('name', 'Untitled')
+    if not isinstance(name, str):
+        abort(400, 'name must be a string.')
+
+    items = db.session.query(FashionItem).options(load_only('id'))\
+        .filter(FashionItem.id.in_(int_list_field(query_json, 'items'))).all()
 
     outfit = Outfit(
-        name=request.json['name'] if 'name' in request.json else 'Untitled',
+        name=name,
+        user_id=session[USER_ID_KEY],
         items=items
     )
 
-    user.outfits.append(outfit)
+    db.session.add(outfit)
+    db.session.flush()
+    # Read before committing, since committing expires the objects and reading them afterwards would query them again
+    outfit_id = outfit.id
+    item_ids = [item.id for item in items]
     db.session.commit()
 
     return jsonify({
         'success': True,
-        'outfit_id': outfit.id,
-        'item_ids': [item.id for item in outfit.items]
+        'outfit_id': outfit_id,
+        'item_ids': item_ids
     })
 
 
@@ -251,10 +457,10 @@ def api_delete_outfit():
     if USER_ID_KEY not in session:
         abort(403)
 
-    user = db.session.query(User).filter(User.id == session[USER_ID_KEY]).one()
-    outfit = db.session.query(Outfit).filter(Outfit.id == request.json['outfit_id']).one()
+    outfit = db.session.query(Outfit)\
+        .filter(Outfit.id == int_field(request_json(), 'outfit_id'), Outfit.user_id == session[USER_ID_KEY]).first()
 
-    if outfit not in user.outfits:
+    if outfit is None:
         abort(400)
 
     db.session.delete(outfit)
@@ -270,46 +476,218 @@ def api_recommend():
     if USER_ID_KEY not in session:
         abort(403)
 
-    user = db.session.query(User).filter(User.id == session[USER_ID_KEY]).one()
-    query_item = db.session.query(FashionItem).filter(FashionItem.id == request.json['item_id']).one()
-
-    if request.json['wardrobe'] == 'random':
-        request.json['wardrobe'] = random.choice((True, False))
-
+    query_json = request_json()
+    user_id = session[USER_ID_KEY]
+    item_id = int_field(query_json, 'item_id')
+    wardrobe = wardrobe_scope(query_json)
     results_per_category = random.randrange(1, 3)
+    weights = mask_weights(query_json)
+    mmr_lambda = diversity_lambda(query_json)
+
+    with metrics.timed('query_item'):
+        query_item = db.session.query(FashionItem).filter(FashionItem.id == item_id).first()
+    if query_item is None:
+        abort(400, 'Unknown item.')
+    with metrics.timed('snapshot'):
+        snapshot = user_snapshot()
+    wardrobe_ids = list(snapshot.wardrobe_ids)
 
     mask_i = random.randrange(1, 5)
-    if request.json['wardrobe']:
-        wardrobe_indexes = similarity.create_indexes(user.wardrobe_items)
+    if wardrobe:
+        with metrics.timed('wardrobe_index'):
+            wardrobe_indexes = similarity.get_wardrobe_indexes(
+                user_id, wardrobe_ids, lambda: load_wardrobe_items(user_id))
 
+    if weights is not None:
+        nn_ids = similarity.get_fused_nn_ids_by_category(
+            session=db.session,
+            indexes=wardrobe_indexes if wardrobe else similarity.PRIMARY_CATEGORY_INDEXES,
+            query=query_item,
+            weights=weights,
+            results_per_category=results_per_category,
+            num_neighbors=min(similarity.FUSED_NUM_NEIGHBORS, len(wardrobe_ids)) if wardrobe
+            else similarity.FUSED_NUM_NEIGHBORS,
+            mmr_lambda=mmr_lambda
+        )
+        results = similarity.hydrate_results(
+            nn_ids, similarity.hydrate_items(db.session, similarity.result_ids(nn_ids)))
+    elif wardrobe:
         results = similarity.get_nns_by_category(
             session=db.session,
             index=wardrobe_indexes[mask_i],
             query=query_item,
             results_per_category=results_per_category,
-            num_neighbors=min(1000, len(user.wardrobe_items))
+            num_neighbors=min(1000, len(wardrobe_ids)),
+            mmr_lambda=mmr_lambda
         )
     else:
-        results = similarity.get_nns_by_category(
+        nn_ids = neighbors.catalog_nn_ids_by_category(
             session=db.session,
-            index=similarity.PRIMARY_INDEXES[mask_i],
+            mask=mask_i,
             query=query_item,
             results_per_category=results_per_category,
-            num_neighbors=min(1000, len(user.wardrobe_items))
+            mmr_lambda=mmr_lambda
         )
+        results = similarity.hydrate_results(
+            nn_ids, similarity.hydrate_items(db.session, similarity.result_ids(nn_ids)))
+
+    with metrics.timed('membership'):
+        results_json = recommendations_json(results, snapshot.wardrobe_ids)
+
+    return jsonify({
+        'results': results_json
+    })
+
 
+def recommendations_json(results: Dict[str, List[Tuple[similarity.Item, float]]],
+                         wardrobe_id_set: AbstractSet[int]) -> List[Dict]:
     results_json = []
     for cat, cat_results in results.items():
         for item, score in cat_results:
             results_json.append({
                 'id': item.id,
                 'path': item.get_path(),
+                'thumbnail': thumbnails.thumbnail_url(item, 'small'),
                 'category': item.merged_category(),
-                'in_wardrobe': item in user.wardrobe_items
+                'in_wardrobe': item.id in wardrobe_id_set
             })
 
+    return results_json
+
+
+@application.route('/api/recommend_batch', methods=['POST'])
+def api_recommend_batch():
+    if USER_ID_KEY not in session:
+        abort(403)
+
+    queries = request_json().get('queries')
+    if not isinstance(queries, list) or not all(isinstance(q, dict) for q in queries):
+        abort(400, 'queries must be a list of objects.')
+    if len(queries) > MAX_BATCH_QUERIES:
+        abort(400, 'At most {} queries can be batched.'.format(MAX_BATCH_QUERIES))
+
+    user_id = session[USER_ID_KEY]
+    snapshot = user_snapshot()
+    wardrobe_ids = list(snapshot.wardrobe_ids)
+
+    # Every query is validated before any of them is run
+    parsed_queries = []
+    for q in queries:
+        scope = q.get('scope', 'random')
+        if scope not in ('wardrobe', 'catalog', 'random'):
+            abort(400, 'scope must be wardrobe, catalog or random.')
+
+        parsed_queries.append((
+            int_field(q, 'item_id'),
+            int_field(q, 'mask', 0, similarity.NUM_MASKS) if 'mask' in q else random.randrange(1, 5),
+            int_field(q, 'results_per_category', 1, MAX_RESULTS_PER_CATEGORY) if 'results_per_category' in q
+            else random.randrange(1, 3),
+            random.choice(('wardrobe', 'catalog')) if scope == 'random' else scope,
+            mask_weights(q),
+            diversity_lambda(q)
+        ))
+
+    query_item_ids = {item_id for item_id, *_ in parsed_queries}
+    query_items = {item.id: item for item in
+                   db.session.query(FashionItem).filter(FashionItem.id.in_(query_item_ids))}
+    if len(query_items) != len(query_item_ids):
+        abort(400, 'Unknown query items.')
+
+    wardrobe_indexes = None
+    batch_results = []
+    for item_id, mask_i, results_per_category, scope, weights, mmr_lambda in parsed_queries:
+
+        if scope == 'wardrobe' and wardrobe_indexes is None:
+            with metrics.timed('wardrobe_index'):
+                wardrobe_indexes = similarity.get_wardrobe_indexes(
+                    user_id, wardrobe_ids, lambda: load_wardrobe_items(user_id))
+
+        if weights is not None:
+            results = similarity.get_fused_nn_ids_by_category(
+                session=db.session,
+                indexes=wardrobe_indexes if scope == 'wardrobe' else similarity.PRIMARY_CATEGORY_INDEXES,
+                query=query_items[item_id],
+                weights=weights,
+                results_per_category=results_per_category,
+                num_neighbors=min(similarity.FUSED_NUM_NEIGHBORS, len(wardrobe_ids)) if scope == 'wardrobe'
+                else similarity.FUSED_NUM_NEIGHBORS,
+                mmr_lambda=mmr_lambda
+            )
+        elif scope == 'wardrobe':
+            results = similarity.get_nn_ids_by_category(
+                session=db.session,
+                index=wardrobe_indexes[mask_i],
+                query=query_items[item_id],
+                results_per_category=results_per_category,
+                num_neighbors=min(1000, len(wardrobe_ids)),
+                mmr_lambda=mmr_lambda
+            )
+        else:
+            results = neighbors.catalog_nn_ids_by_category(
+                session=db.session,
+                mask=mask_i,
+                query=query_items[item_id],
+                results_per_category=results_per_category,
+                mmr_lambda=mmr_lambda
+            )
+
+        batch_results.append((item_id, mask_i if weights is None else None, weights, scope, results))
+
+    result_items = similarity.hydrate_items(
+        db.session, list({i for *_, results in batch_results for i in similarity.result_ids(results)}))
+
+    wardrobe_id_set = snapshot.wardrobe_ids
     return jsonify({
-        'results': results_json
+        'results': [{
+            'item_id': item_id,
+            'mask': mask_i,
+            'weights': weights,
+            'scope': scope,
+            'results': recommendations_json(similarity.hydrate_results(results, result_items), wardrobe_id_set)
+        } for item_id, mask_i, weights, scope, results in batch_results]
+    })
+
+
+@application.route('/api/complete_outfit', methods=['POST'])
+def api_complete_outfit():
+    if USER_ID_KEY not in session:
+        abort(403)
+
+    query_json = request_json()
+    outfit_ids = list(set(int_list_field(query_json, 'items')))
+    if not 0 < len(outfit_ids) <= MAX_OUTFIT_ITEMS:
+        abort(400, 'Outfits must have between 1 and {} items.'.format(MAX_OUTFIT_ITEMS))
+
+    scope = query_json.get('scope', 'wardrobe')
+    if scope not in ('wardrobe', 'catalog'):
+        abort(400, 'scope must be wardrobe or catalog.')
+
+    weights = mask_weights(query_json) or [1.0] * (similarity.NUM_MASKS + 1)
+    try:
+        budget_ms = float(query_json.get('budget_ms', completion.COMPLETION_BUDGET_SECONDS * 1000))
+    except (TypeError, ValueError):
+        abort(400, 'budget_ms must be a number.')
+    # Also false for NaN
+    if not budget_ms > 0:
+        abort(400, 'budget_ms must be positive.')
+    budget_seconds = min(budget_ms / 1000, MAX_COMPLETION_BUDGET_SECONDS)
+
+    snapshot = user_snapshot()
+    try:
+        nn_ids = completion.complete_outfit(
+            session=db.session,
+            outfit_ids=outfit_ids,
+            weights=weights,
+            wardrobe_by_category=snapshot.wardrobe_by_category if scope == 'wardrobe' else None,
+            budget_seconds=budget_seconds
+        )
+    except ValueError:
+        abort(400, 'Unknown outfit items.')
+
+    results = similarity.hydrate_results(nn_ids, similarity.hydrate_items(db.session, similarity.result_ids(nn_ids)))
+    return jsonify({
+        'scope': scope,
+        'results': recommendations_json(results, snapshot.wardrobe_ids)
     })
 
 
@@ -326,6 +704,89 @@ def debug_similarity():
     return render_template('debug.html', query=query, results=results, category_results=category_results)
 
 
+@application.route('/debug/memory')
+def debug_memory():
+    return jsonify({
+        'pid': os.getpid(),
+        'memory': process_memory()
+    })
+
+
+def cache_gauges():
+    caches = [('wardrobe_index', similarity.WARDROBE_INDEX_CACHE), ('results', similarity.RESULT_CACHE),
+              ('user_snapshots', snapshots.SNAPSHOTS)]
+    if similarity.RESULT_DISK_CACHE is not None:
+        caches.append(('results_disk', similarity.RESULT_DISK_CACHE))
+
+    gauges = []
+    for name, cache in caches:
+        stats = cache.stats()
+        gauges += [({'pid': str(os.getpid()), 'cache': name, 'stat': k}, v) for k, v in (
+            ('hits', stats.hits),
+            ('misses', stats.misses),
+            ('evictions', stats.evictions),
+            ('entries', stats.entries),
+            ('size_bytes', stats.size_bytes),
+            ('hit_rate', stats.hit_rate())
+        )]
+
+    return gauges
+
+
+metrics.register_gauge('cache', 'Cache statistics.', cache_gauges)
+metrics.register_gauge('memory_bytes', 'Worker memory usage.', lambda: [
+    ({'pid': str(os.getpid()), 'type': k}, v) for k, v in process_memory().items()])
+metrics.register_gauge('delta_items', 'Catalog items not yet compacted into the primary indexes.', lambda: [
+    ({'pid': str(os.getpid())}, similarity.delta_item_count())])
+metrics.register_gauge('index_generation', 'Generation of the loaded primary indexes.', lambda: [
+    ({'pid': str(os.getpid())}, similarity.INDEX_GENERATION)])
+
+
+# Each worker exposes its own metrics, so the endpoint is only served to local scrapers
+@application.route('/metrics')
+def metrics_endpoint():
+    if request.remote_addr not in LOCAL_ADDRESSES:
+        abort(404)
+
+    return metrics.render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@application.route('/thumbs/<size>/<file_name>')
+def thumbnail(size: str, file_name: str):
+    if size not in thumbnails.THUMBNAIL_SIZES:
+        abort(404)
+
+    # Flask resolves relative directories against the app's root path, while data paths are relative to the working
+    # directory
+    response = send_from_directory(os.path.abspath(os.path.join(thumbnails.THUMBNAILS_DIR, size)), file_name)
+    response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(thumbnails.CACHE_SECONDS)
+    return response
+
+
+def triplet_image_urls(triplet_names: List[List[str]]) -> List[List[str]]:
+    # Thumbnails of the items of a page, with one query for the ids of all its names. Names that aren't items use their
+    # full size image.
+    names = {name for names in triplet_names for name in names}
+    item_ids = dict(db.session.query(FashionItem.name, FashionItem.id).filter(FashionItem.name.in_(names))) \
+        if len(names) > 0 else {}
+    items = similarity.hydrate_items(db.session, list(item_ids.values()))
+
+    def image_url(name: str) -> str:
+        item = items.get(item_ids.get(name))
+        return thumbnails.thumbnail_url(item, 'small') if item is not None else item_path(name)
+
+    return [[image_url(name) for name in names] for names in triplet_names]
+
+
 @application.route('/triplets')
 def view_triplets():
-    return render_template('triplets.html', triplets=triplets.get_triplets(1000))
+    # A seed is always chosen here, so the page links keep paging through the same sample
+    seed = request.args.get('seed', type=int)
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    page = max(request.args.get('page', 0, type=int), 0)
+
+    return render_template('triplets.html',
+                           triplets=triplet_image_urls(triplets.get_triplets(TRIPLETS_PAGE_SIZE, seed, page)),
+                           seed=seed,
+                           page=page)
@@ -0,0 +1,404 @@
+# Asynchronous variant of the recommendation and wardrobe API routes of app.py. Database round trips run on an
+# async driver and overlap with each other, and index queries run in a thread pool, so a worker keeps serving
+# requests while others wait on MySQL or Annoy. Databases other than MySQL, like the SQLite stand-in of load tests, are
+# queried through SQLAlchemy in a thread pool instead. Log-in and pages are still served by app.py, whose filesystem
+# sessions are read here.
+#
+# python async_app.py
+# gunicorn -c gunicorn.conf.py --worker-class aiohttp.GunicornWebWorker async_app:application
+import asyncio
+import json
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, List, Dict, Optional, Tuple
+
+import aiomysql
+from aiohttp import web
+from sqlalchemy import create_engine, select
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.sql import ClauseElement
+from werkzeug.contrib.cache import FileSystemCache
+
+import neighbors
+import similarity
+import thumbnails
+from catalog import CatalogItem
+from tables import database_uri, FashionItem, User, user_items, merge_category
+from validation import InvalidRequest, int_field, json_object, mask_weights, diversity_lambda, wardrobe_scope
+
+CONFIG_FILE_PATH = os.environ.get('CONFIG_FILE', 'config.json')
+
+# Same storage and cookie as the filesystem sessions of app.py
+SESSION_FILE_DIR = 'flask_session'
+SESSION_KEY_PREFIX = 'session:'
+SESSION_COOKIE_NAME = 'session'
+SESSION_FILE_THRESHOLD = 100000
+USER_ID_KEY = 'user_id'
+
+# Requests handled concurrently per worker, threads running index queries and builds, and database connections
+DEFAULT_CONCURRENCY = 64
+DEFAULT_ANN_THREADS = 4
+DEFAULT_DB_POOL_SIZE = 10
+
+ITEMS = FashionItem.__table__
+USERS = User.__table__
+ITEM_COLUMNS = [ITEMS.c[name] for name in ['id', 'name', 'category', 'semantic_category', 'full_embedding_packed'] +
+                ['mask_{}_embedding_packed'.format(i + 1) for i in range(similarity.NUM_MASKS)]]
+
+with open(CONFIG_FILE_PATH) as config_file:
+    config_json = json.load(config_file)
+
+DATABASE_URI = database_uri(config_json['database'])
+async_json = config_json.get('async', {})
+similarity.configure_indexes(config_json.get('indexes', {}))
+
+CONCURRENCY = async_json.get('concurrency', DEFAULT_CONCURRENCY)
+ANN_THREADS = async_json.get('ann_threads', DEFAULT_ANN_THREADS)
+DB_POOL_SIZE = async_json.get('db_pool_size', DEFAULT_DB_POOL_SIZE)
+
+# Synchronous sessions are used at startup, for index refreshes, by index queries that need the categories of items
+# missing from the catalog, which all run outside the event loop, and for every query of databases other than MySQL
+engine = create_engine(DATABASE_URI)
+SyncSession = scoped_session(sessionmaker(bind=engine))
+
+try:
+    similarity.add_missing_columns(SyncSession(), USERS)
+    similarity.migrate_packed_embeddings(SyncSession())
+    similarity.load_primary_indexes(SyncSession())
+    similarity.load_catalog(SyncSession())
+    similarity.warm_up_indexes()
+finally:
+    SyncSession.remove()
+# Workers are forked after the app is loaded, and open their own connections
+engine.dispose()
+thumbnails.load_thumbnails()
+
+session_cache = FileSystemCache(SESSION_FILE_DIR, threshold=SESSION_FILE_THRESHOLD, mode=0o600)
+
+
+def session_user_id(request: web.Request) -> Optional[int]:
+    sid = request.cookies.get(SESSION_COOKIE_NAME)
+    if not sid:
+        return None
+
+    data = session_cache.get(SESSION_KEY_PREFIX + sid)
+    return data.get(USER_ID_KEY) if data else None
+
+
+def require_user_id(request: web.Request) -> int:
+    user_id = session_user_id(request)
+    if user_id is None:
+        raise web.HTTPForbidden()
+
+    return user_id
+
+
+async def request_json(request: web.Request) -> Dict:
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+
+    return json_object(body)
+
+
+class MySQLDatabase:
+    # Statements are compiled by SQLAlchemy's MySQL dialect and run on a pool of aiomysql connections
+    def __init__(self, pool: aiomysql.Pool):
+        self.pool = pool
+
+    async def fetch_all(self, statement: ClauseElement) -> List[Tuple]:
+        compiled = statement.compile(dialect=engine.dialect)
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(str(compiled), compiled.params)
+                return await cur.fetchall()
+
+    async def execute_atomically(self, statements: List[ClauseElement]) -> bool:
+        # Runs the statements in one transaction, which is rolled back when any of them changes no rows
+        async with self.pool.acquire() as conn:
+            await conn.begin()
+            try:
+                async with conn.cursor() as cur:
+                    for statement in statements:
+                        compiled = statement.compile(dialect=engine.dialect)
+                        if await cur.execute(str(compiled), compiled.params) == 0:
+                            await conn.rollback()
+                            return False
+                await conn.commit()
+                return True
+            except BaseException:
+                await conn.rollback()
+                raise
+
+    async def close(self):
+        self.pool.close()
+        await self.pool.wait_closed()
+
+
+class ThreadedDatabase:
+    # Statements run on the synchronous engine, in threads of their own so they don't wait behind index queries
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(DB_POOL_SIZE)
+
+    def fetch_all_sync(self, statement: ClauseElement) -> List[Tuple]:
+        with engine.connect() as conn:
+            return [tuple(row) for row in conn.execute(statement)]
+
+    def execute_atomically_sync(self, statements: List[ClauseElement]) -> bool:
+        with engine.connect() as conn:
+            with conn.begin() as transaction:
+                for statement in statements:
+                    if conn.execute(statement).rowcount == 0:
+                        transaction.rollback()
+                        return False
+        return True
+
+    async def fetch_all(self, statement: ClauseElement) -> List[Tuple]:
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self.fetch_all_sync, statement)
+
+    async def execute_atomically(self, statements: List[ClauseElement]) -> bool:
+        return await asyncio.get_event_loop().run_in_executor(self.executor, self.execute_atomically_sync, statements)
+
+    async def close(self):
+        self.executor.shutdown()
+
+
+async def connect_database():
+    url = make_url(DATABASE_URI)
+    if url.get_backend_name() != 'mysql':
+        return ThreadedDatabase()
+
+    return MySQLDatabase(await aiomysql.create_pool(
+        host=url.host,
+        port=url.port or 3306,
+        user=url.username,
+        password=url.password or '',
+        db=url.database,
+        maxsize=DB_POOL_SIZE,
+        autocommit=True
+    ))
+
+
+def item_from_row(row: Tuple) -> FashionItem:
+    return FashionItem(**{c.name: value for c, value in zip(ITEM_COLUMNS, row)})
+
+
+async def fetch_item(db, item_id: int) -> Optional[FashionItem]:
+    rows = await db.fetch_all(select(ITEM_COLUMNS).where(ITEMS.c.id == item_id))
+    return item_from_row(rows[0]) if len(rows) > 0 else None
+
+
+async def fetch_wardrobe_ids(db, user_id: int) -> List[int]:
+    rows = await db.fetch_all(select([user_items.c.item_id]).where(user_items.c.user_id == user_id))
+    return [r[0] for r in rows]
+
+
+async def fetch_wardrobe_items(db, user_id: int) -> List[FashionItem]:
+    rows = await db.fetch_all(select(ITEM_COLUMNS)
+                              .select_from(ITEMS.join(user_items, user_items.c.item_id == ITEMS.c.id))
+                              .where(user_items.c.user_id == user_id))
+    return [item_from_row(r) for r in rows]
+
+
+def bump_wardrobe_version(user_id: int) -> ClauseElement:
+    # Run after the change itself and in the same transaction, so a snapshot loaded with the new version always
+    # includes it, and a saved change always has a new version
+    return USERS.update().where(USERS.c.id == user_id).values(wardrobe_version=USERS.c.wardrobe_version + 1)
+
+
+async def hydrate_items(db, item_ids: List[int]) -> Dict[int, similarity.Item]:
+    result_items: Dict[int, similarity.Item] = {}
+    if similarity.CATALOG is not None:
+        result_items.update(similarity.CATALOG.items(item_ids))
+        item_ids = [item_id for item_id in item_ids if item_id not in result_items]
+
+    if len(item_ids) > 0:
+        rows = await db.fetch_all(select([ITEMS.c.id, ITEMS.c.name, ITEMS.c.category, ITEMS.c.semantic_category])
+                                  .where(ITEMS.c.id.in_(item_ids)))
+        result_items.update({r[0]: CatalogItem(r[0], r[1], r[2], r[3], merge_category(r[3])) for r in rows})
+
+    return result_items
+
+
+def search_in_session(search: Callable[..., similarity.CategoryResults]) -> similarity.CategoryResults:
+    try:
+        return search(session=SyncSession())
+    finally:
+        SyncSession.remove()
+
+
+def recommendations_json(results: Dict[str, List[Tuple[similarity.Item, float]]],
+                         wardrobe_id_set: set) -> List[Dict]:
+    return [{
+        'id': item.id,
+        'path': item.get_path(),
+        'thumbnail': thumbnails.thumbnail_url(item, 'small'),
+        'category': item.merged_category(),
+        'in_wardrobe': item.id in wardrobe_id_set
+    } for cat_results in results.values() for item, score in cat_results]
+
+
+async def api_recommend(request: web.Request) -> web.Response:
+    user_id = require_user_id(request)
+    query_json = await request_json(request)
+    item_id = int_field(query_json, 'item_id')
+    wardrobe = wardrobe_scope(query_json)
+    results_per_category = random.randrange(1, 3)
+    weights = mask_weights(query_json)
+    mmr_lambda = diversity_lambda(query_json)
+
+    db = request.app['db']
+    loop = asyncio.get_event_loop()
+
+    query_item, wardrobe_ids = await asyncio.gather(
+        fetch_item(db, item_id),
+        fetch_wardrobe_ids(db, user_id)
+    )
+    if query_item is None:
+        raise InvalidRequest('Unknown item.')
+
+    mask_i = random.randrange(1, 5)
+    if wardrobe:
+        indexes = similarity.cached_wardrobe_indexes(user_id, wardrobe_ids)
+        if indexes is None:
+            wardrobe_items = await fetch_wardrobe_items(db, user_id)
+            indexes = await loop.run_in_executor(
+                request.app['executor'], similarity.cache_wardrobe_indexes, user_id, wardrobe_ids, wardrobe_items)
+    else:
+        indexes = similarity.PRIMARY_CATEGORY_INDEXES
+
+    # Precomputed catalog results are a lookup that doesn't need a thread
+    results = None
+    if weights is not None:
+        search = partial(similarity.get_fused_nn_ids_by_category, indexes=indexes, query=query_item, weights=weights,
+                         results_per_category=results_per_category,
+                         num_neighbors=min(similarity.FUSED_NUM_NEIGHBORS, len(wardrobe_ids)) if wardrobe
+                         else similarity.FUSED_NUM_NEIGHBORS,
+                         mmr_lambda=mmr_lambda)
+    elif wardrobe:
+        search = partial(similarity.get_nn_ids_by_category, index=indexes[mask_i], query=query_item,
+                         results_per_category=results_per_category, num_neighbors=min(1000, len(wardrobe_ids)),
+                         mmr_lambda=mmr_lambda)
+    else:
+        if mmr_lambda is None:
+            results = neighbors.get_table_nn_ids_by_category(query_item, mask_i, results_per_category)
+        search = partial(similarity.get_catalog_nn_ids_by_category, mask=mask_i, query=query_item,
+                         results_per_category=results_per_category, mmr_lambda=mmr_lambda)
+
+    if results is None:
+        results = await loop.run_in_executor(request.app['executor'], search_in_session, search)
+    result_items = await hydrate_items(db, similarity.result_ids(results))
+
+    return web.json_response({
+        'results': recommendations_json(similarity.hydrate_results(results, result_items), set(wardrobe_ids))
+    })
+
+
+async def api_add_wardrobe_item(request: web.Request) -> web.Response:
+    user_id = require_user_id(request)
+    item_id = int_field(await request_json(request), 'item_id')
+    db = request.app['db']
+
+    # Checks that the item exists and isn't in the wardrobe yet in one round trip
+    rows = await db.fetch_all(select([user_items.c.item_id])
+                              .select_from(ITEMS.outerjoin(user_items, (user_items.c.item_id == ITEMS.c.id) &
+                                                           (user_items.c.user_id == user_id)))
+                              .where(ITEMS.c.id == item_id))
+    if len(rows) == 0 or rows[0][0] is not None:
+        raise web.HTTPBadRequest()
+
+    try:
+        await db.execute_atomically([user_items.insert().values(user_id=user_id, item_id=item_id),
+                                     bump_wardrobe_version(user_id)])
+    except (IntegrityError, aiomysql.IntegrityError):
+        # Added by a concurrent request since the check
+        raise web.HTTPBadRequest()
+    similarity.invalidate_wardrobe_indexes(user_id)
+
+    return web.json_response({
+        'success': True,
+        'item_id': item_id
+    })
+
+
+async def api_remove_wardrobe_item(request: web.Request) -> web.Response:
+    user_id = require_user_id(request)
+    item_id = int_field(await request_json(request), 'item_id')
+    db = request.app['db']
+
+    deleted = await db.execute_atomically([user_items.delete().where((user_items.c.user_id == user_id) &
+                                                                     (user_items.c.item_id == item_id)),
+                                           bump_wardrobe_version(user_id)])
+    if not deleted:
+        raise web.HTTPBadRequest()
+
+    similarity.invalidate_wardrobe_indexes(user_id)
+
+    return web.json_response({
+        'success': True,
+        'item_id': item_id
+    })
+
+
+@web.middleware
+async def limit_concurrency(request: web.Request, handler):
+    async with request.app['request_semaphore']:
+        return await handler(request)
+
+
+@web.middleware
+async def invalid_requests(request: web.Request, handler):
+    try:
+        return await handler(request)
+    except InvalidRequest as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+
+def refresh_indexes_sync():
+    try:
+        similarity.refresh_indexes(SyncSession())
+    finally:
+        SyncSession.remove()
+
+
+async def refresh_indexes(app: web.Application):
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(similarity.DELTA_REFRESH_SECONDS)
+
+        try:
+            await loop.run_in_executor(app['executor'], refresh_indexes_sync)
+        except Exception as e:
+            print('Failed to refresh indexes: {}'.format(e))
+
+
+# Started per worker, since pools, threads and tasks created before a fork don't exist in the workers
+async def start_worker(app: web.Application):
+    app['executor'] = ThreadPoolExecutor(ANN_THREADS)
+    app['request_semaphore'] = asyncio.Semaphore(CONCURRENCY)
+    app['db'] = await connect_database()
+    app['refresh_task'] = asyncio.get_event_loop().create_task(refresh_indexes(app))
+
+
+async def stop_worker(app: web.Application):
+    app['refresh_task'].cancel()
+    await app['db'].close()
+    app['executor'].shutdown()
+
+
+application = web.Application(middlewares=[limit_concurrency, invalid_requests])
+application.on_startup.append(start_worker)
+application.on_cleanup.append(stop_worker)
+application.add_routes([
+    web.post('/api/recommend', api_recommend),
+    web.post('/api/add_wardrobe_item', api_add_wardrobe_item),
+    web.post('/api/remove_wardrobe_item', api_remove_wardrobe_item)
+])
+
+if __name__ == '__main__':
+    web.run_app(application, port=int(os.environ.get('PORT', '8001')))
@@ -0,0 +1,219 @@
+import json
+import os
+import platform
+import tempfile
+import time
+from argparse import ArgumentParser
+from typing import List, Dict, Optional
+
+import numpy as np
+from annoy.annoylib import Annoy
+
+import quantized
+from similarity import EMBEDDING_SIZE, DISTANCE_FUNCTION, NUM_MASKS, NUM_TREES, EMBEDDINGS_DIR, INDEX_NAMES, \
+    merge_embedding_files, build_annoy
+
+DEFAULT_NUM_TREES = [5, NUM_TREES, 20, 50]
+DEFAULT_SEARCH_K = [-1, 1000, 5000, 20000]
+DEFAULT_RERANK = [0, 50, 100, 200]
+
+
+def load_embeddings(embeddings_dir: str, count: Optional[int]) -> List[np.ndarray]:
+    # Rows are numbered in file order, the same way load_all_items assigns item ids
+    paths = ['full_embeddings.csv'] + ['mask_{}_embeddings.csv'.format(i + 1) for i in range(NUM_MASKS)]
+    rows: List[List[np.ndarray]] = [[] for _ in paths]
+
+    for i, (_, embeddings) in enumerate(merge_embedding_files([os.path.join(embeddings_dir, p) for p in paths])):
+        if count is not None and i >= count:
+            break
+        for mask_rows, em in zip(rows, embeddings):
+            mask_rows.append(np.array(em.split(','), dtype=np.float32))
+
+    return [np.stack(mask_rows) for mask_rows in rows]
+
+
+def synthetic_embeddings(count: int, num_clusters: int, seed: int) -> List[np.ndarray]:
+    # Clustered Gaussian vectors, closer to the structure of learned embeddings than uniform noise
+    rng = np.random.RandomState(seed)
+    matrices = []
+    for _ in range(NUM_MASKS + 1):
+        centers = rng.normal(size=(num_clusters, EMBEDDING_SIZE)).astype(np.float32)
+        assignments = rng.randint(num_clusters, size=count)
+        matrices.append(centers[assignments] + 0.5 * rng.normal(size=(count, EMBEDDING_SIZE)).astype(np.float32))
+
+    return matrices
+
+
+def exact_neighbors(vectors: np.ndarray, query_rows: np.ndarray, k: int) -> np.ndarray:
+    normalized = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    neighbors = np.empty((len(query_rows), k), dtype=np.int64)
+
+    # Batched so the similarity matrix stays small for large item counts
+    for start in range(0, len(query_rows), 256):
+        similarities = normalized[query_rows[start:start + 256]] @ normalized.T
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(similarities, top, axis=1), axis=1, kind='stable')
+        neighbors[start:start + 256] = np.take_along_axis(top, order, axis=1)
+
+    return neighbors
+
+
+def benchmark_index(vectors: np.ndarray, query_rows: np.ndarray, ground_truth: np.ndarray, k: int,
+                    num_trees_values: List[int], search_k_values: List[int]) -> List[Dict]:
+    results = []
+    for num_trees in num_trees_values:
+        ind = Annoy(EMBEDDING_SIZE, DISTANCE_FUNCTION)
+        for row, vec in enumerate(vectors):
+            ind.add_item(row, vec)
+
+        start_time = time.time()
+        build_annoy(ind, num_trees)
+        build_seconds = time.time() - start_time
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index_path = os.path.join(tmp_dir, 'index.ann')
+            ind.save(index_path)
+            index_bytes = os.path.getsize(index_path)
+
+            for search_k in search_k_values:
+                latencies = np.empty(len(query_rows))
+                recalls = np.empty(len(query_rows))
+                for i, (row, truth) in enumerate(zip(query_rows.tolist(), ground_truth)):
+                    query_start_time = time.perf_counter()
+                    found = ind.get_nns_by_item(row, k, search_k=search_k)
+                    latencies[i] = time.perf_counter() - query_start_time
+                    recalls[i] = len(set(found).intersection(truth.tolist())) / k
+
+                results.append({
+                    'num_trees': num_trees,
+                    'search_k': search_k,
+                    'recall': float(recalls.mean()),
+                    'recall_min': float(recalls.min()),
+                    'p50_ms': float(np.percentile(latencies, 50) * 1000),
+                    'p99_ms': float(np.percentile(latencies, 99) * 1000),
+                    'build_seconds': build_seconds,
+                    'index_bytes': index_bytes
+                })
+                print('{:>6} trees {:>7} search_k  recall@{} {:.4f}  p50 {:.3f}ms  p99 {:.3f}ms'.format(
+                    num_trees, search_k, k, results[-1]['recall'], results[-1]['p50_ms'], results[-1]['p99_ms']))
+
+            ind.unload()
+
+    return results
+
+
+def benchmark_quantized(vectors: np.ndarray, query_rows: np.ndarray, ground_truth: np.ndarray, k: int,
+                        methods: List[str], num_subspaces: int, rerank_values: List[int], seed: int) -> List[Dict]:
+    results = []
+    float_bytes = len(vectors) * EMBEDDING_SIZE * 4
+    normalized = quantized.normalize(vectors)
+
+    for method in methods:
+        start_time = time.time()
+        quantizer = quantized.train_quantizer(vectors, method, num_subspaces, seed=seed)
+        codes = quantizer.encode(normalized)
+        build_seconds = time.time() - start_time
+        mse, mean_cosine = quantized.reconstruction_error(quantizer, vectors[query_rows])
+
+        for rerank in rerank_values:
+            ind = quantized.QuantizedIndex(quantizer, codes, normalized, rerank)
+            latencies = np.empty(len(query_rows))
+            recalls = np.empty(len(query_rows))
+            for i, (row, truth) in enumerate(zip(query_rows.tolist(), ground_truth)):
+                query_start_time = time.perf_counter()
+                found = ind.get_nns_by_vector(normalized[row], k)
+                latencies[i] = time.perf_counter() - query_start_time
+                recalls[i] = len(set(found).intersection(truth.tolist())) / k
+
+            results.append({
+                'method': method,
+                'num_subspaces': num_subspaces if method == 'pq' else None,
+                'rerank': rerank,
+                'recall': float(recalls.mean()),
+                'recall_min': float(recalls.min()),
+                'p50_ms': float(np.percentile(latencies, 50) * 1000),
+                'p99_ms': float(np.percentile(latencies, 99) * 1000),
+                'build_seconds': build_seconds,
+                'reconstruction_mse': mse,
+                'reconstruction_cosine': mean_cosine,
+                # Resident bytes: the re-ranking vectors stay on disk and only re-ranked rows are read
+                'index_bytes': ind.nbytes,
+                'float32_bytes': float_bytes,
+                'compression': float_bytes / ind.nbytes
+            })
+            print('{:>6} {:>5} rerank  recall@{} {:.4f}  p50 {:.3f}ms  p99 {:.3f}ms  {:.1f} MB ({:.1f}x)'.format(
+                method, rerank, k, results[-1]['recall'], results[-1]['p50_ms'], results[-1]['p99_ms'],
+                ind.nbytes / (1024 * 1024), results[-1]['compression']))
+
+    return results
+
+
+def run_benchmark(matrices: List[np.ndarray], num_queries: int, k: int, num_trees_values: List[int],
+                  search_k_values: List[int], masks: List[int], seed: int, quantization_methods: List[str] = (),
+                  num_subspaces: int = quantized.DEFAULT_NUM_SUBSPACES, rerank_values: List[int] = ()) -> Dict:
+    rng = np.random.RandomState(seed)
+    num_items = len(matrices[0])
+    query_rows = rng.choice(num_items, size=min(num_queries, num_items), replace=False)
+
+    report = {
+        'num_items': num_items,
+        'num_queries': len(query_rows),
+        'k': k,
+        'seed': seed,
+        'platform': platform.platform(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'indexes': {},
+        'quantized': {}
+    }
+
+    for mask in masks:
+        print('Benchmarking {}.'.format(INDEX_NAMES[mask]))
+        ground_truth = exact_neighbors(matrices[mask], query_rows, k)
+        report['indexes'][INDEX_NAMES[mask]] = benchmark_index(
+            matrices[mask], query_rows, ground_truth, k, num_trees_values, search_k_values)
+        if len(quantization_methods) > 0:
+            report['quantized'][INDEX_NAMES[mask]] = benchmark_quantized(
+                matrices[mask], query_rows, ground_truth, k, quantization_methods, num_subspaces, rerank_values, seed)
+
+    return report
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Measure recall and latency of the Annoy indexes against exact search.')
+    parser.add_argument('--embeddings-dir', '-e', type=str, default=EMBEDDINGS_DIR,
+                        help='Directory containing the embedding files.')
+    parser.add_argument('--synthetic', '-s', action='store_true', help='Use synthetic embeddings.')
+    parser.add_argument('--count', '-c', type=int, default=None,
+                        help='Number of items to index (default: all items, or 100000 synthetic items).')
+    parser.add_argument('--num-clusters', type=int, default=200)
+    parser.add_argument('--num-queries', '-q', type=int, default=1000)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--num-trees', '-t', type=int, nargs='+', default=DEFAULT_NUM_TREES)
+    parser.add_argument('--search-k', '-sk', type=int, nargs='+', default=DEFAULT_SEARCH_K)
+    parser.add_argument('--masks', '-m', type=int, nargs='+', default=list(range(NUM_MASKS + 1)),
+                        help='Masks to benchmark, 0 being the full embeddings.')
+    parser.add_argument('--quantization', '-qm', type=str, nargs='*', choices=quantized.QUANTIZATION_METHODS,
+                        default=quantized.QUANTIZATION_METHODS,
+                        help='Quantized stores to compare against Annoy, none to only benchmark Annoy.')
+    parser.add_argument('--num-subspaces', type=int, default=quantized.DEFAULT_NUM_SUBSPACES)
+    parser.add_argument('--rerank', '-r', type=int, nargs='+', default=DEFAULT_RERANK,
+                        help='Numbers of quantized candidates re-ranked with full-precision vectors.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', '-o', type=str, default='benchmark_similarity.json')
+
+    args = parser.parse_args()
+    print(args)
+
+    if args.synthetic:
+        matrices = synthetic_embeddings(args.count or 100000, args.num_clusters, args.seed)
+    else:
+        matrices = load_embeddings(args.embeddings_dir, args.count)
+    print('Loaded {} items.'.format(len(matrices[0])))
+
+    benchmark_report = run_benchmark(matrices, args.num_queries, args.k, args.num_trees, args.search_k, args.masks,
+                                     args.seed, args.quantization, args.num_subspaces, args.rerank)
+    benchmark_report['source'] = 'synthetic' if args.synthetic else args.embeddings_dir
+
+    with open(args.output, 'w') as output_file:
+        json.dump(benchmark_report, output_file, indent=2)
+    print('Saved results to {}'.format(args.output))
@@ -0,0 +1,151 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, NamedTuple, Optional, Tuple
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    entries: int
+    size_bytes: int
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+
+class LRUCache:
+    def __init__(self, max_entries: int, max_bytes: Optional[int] = None, ttl_seconds: Optional[float] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+
+        # Values with their size and expiry time
+        self._entries: 'OrderedDict[Hashable, Tuple[Any, int, Optional[float]]]' = OrderedDict()
+        self._size_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, size_bytes: int = 0):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            # Values larger than the whole budget are not worth caching
+            if self.max_bytes is not None and size_bytes > self.max_bytes:
+                return
+
+            expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds is not None else None
+            self._entries[key] = (value, size_bytes, expires_at)
+            self._size_bytes += size_bytes
+
+            while len(self._entries) > self.max_entries or \
+                    (self.max_bytes is not None and self._size_bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def remove(self, key: Hashable):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def remove_where(self, predicate: Callable[[Hashable], bool]):
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size_bytes = 0
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(self.hits, self.misses, self.evictions, len(self._entries), self._size_bytes)
+
+    def _remove(self, key: Hashable):
+        _, size_bytes, _ = self._entries.pop(key)
+        self._size_bytes -= size_bytes
+
+
+class DiskCache:
+    # String values in a SQLite file, shared by every process that opens the same path. Each value is stored with a
+    # version, so values of outdated versions can be dropped together.
+    def __init__(self, path: str, ttl_seconds: Optional[float] = None):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+
+        self.hits = 0
+        self.misses = 0
+
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, version INTEGER, expires_at REAL)')
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            row = self._connection().execute(
+                'SELECT value FROM entries WHERE key = ? AND (expires_at IS NULL OR expires_at >= ?)',
+                (key, time.time())).fetchone()
+        except sqlite3.OperationalError:
+            # Locked by another process for longer than the timeout, which a cache can treat as a miss
+            row = None
+
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return row[0]
+
+    def put(self, key: str, value: str, version: int = 0):
+        expires_at = time.time() + self.ttl_seconds if self.ttl_seconds is not None else None
+        try:
+            self._connection().execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                                       (key, value, version, expires_at))
+        except sqlite3.OperationalError:
+            pass
+
+    def remove_other_versions(self, version: int):
+        self._connection().execute('DELETE FROM entries WHERE version != ? OR expires_at < ?', (version, time.time()))
+
+    def clear(self):
+        self._connection().execute('DELETE FROM entries')
+
+    def stats(self) -> CacheStats:
+        entries = self._connection().execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+        size_bytes = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        return CacheStats(self.hits, self.misses, 0, entries, size_bytes)
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections can't be shared between threads, or carried over into forked processes
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+
+        return self._local.connection
@@ -0,0 +1,148 @@
+import json
+import mmap
+import os
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+import numpy as np
+
+from tables import item_path, merge_category
+
+CODES_FILE = 'codes.json'
+NAMES_FILE = 'names.bin'
+NAME_OFFSETS_FILE = 'name_offsets.npy'
+CATEGORY_CODES_FILE = 'category_codes.npy'
+SEMANTIC_CATEGORY_CODES_FILE = 'semantic_category_codes.npy'
+MERGED_CATEGORY_CODES_FILE = 'merged_category_codes.npy'
+
+# Code stored for ids that have no item
+MISSING_CODE = -1
+
+TMP_EXT = '.tmp'
+
+
+class CatalogItem(NamedTuple):
+    id: int
+    name: str
+    category: str
+    semantic_category: str
+    merged: str
+
+    def get_path(self) -> str:
+        return item_path(self.name)
+
+    def merged_category(self) -> str:
+        return self.merged
+
+
+def catalog_exists(catalog_dir: str) -> bool:
+    # The codes file is written last, so its presence means the catalog was compiled completely
+    return os.path.exists(os.path.join(catalog_dir, CODES_FILE))
+
+
+def compile_catalog(catalog_dir: str, rows: Iterable[Tuple[int, str, str, str]], num_ids: int,
+                    merged_categories: List[str]):
+    if not os.path.exists(catalog_dir):
+        os.makedirs(catalog_dir)
+
+    rows = sorted(rows)
+    categories = sorted({r[2] for r in rows})
+    semantic_categories = sorted({r[3] for r in rows})
+    merged_categories = list(merged_categories) + sorted(
+        {merge_category(r[3]) for r in rows} - set(merged_categories))
+
+    category_codes = {c: i for i, c in enumerate(categories)}
+    semantic_category_codes = {c: i for i, c in enumerate(semantic_categories)}
+    merged_category_codes = {c: i for i, c in enumerate(merged_categories)}
+
+    name_lengths = np.zeros(num_ids, dtype=np.int64)
+    category_array = np.full(num_ids, MISSING_CODE, dtype=np.int16)
+    semantic_category_array = np.full(num_ids, MISSING_CODE, dtype=np.int16)
+    merged_category_array = np.full(num_ids, MISSING_CODE, dtype=np.int16)
+
+    def tmp_path(file_name: str) -> str:
+        return os.path.join(catalog_dir, file_name + TMP_EXT)
+
+    with open(tmp_path(NAMES_FILE), 'wb') as names_file:
+        for item_id, name, cat, semantic_cat in rows:
+            encoded_name = name.encode('utf-8')
+            names_file.write(encoded_name)
+
+            name_lengths[item_id] = len(encoded_name)
+            category_array[item_id] = category_codes[cat]
+            semantic_category_array[item_id] = semantic_category_codes[semantic_cat]
+            merged_category_array[item_id] = merged_category_codes[merge_category(semantic_cat)]
+
+    name_offsets = np.zeros(num_ids + 1, dtype=np.int64)
+    np.cumsum(name_lengths, out=name_offsets[1:])
+
+    for file_name, array in ((NAME_OFFSETS_FILE, name_offsets),
+                             (CATEGORY_CODES_FILE, category_array),
+                             (SEMANTIC_CATEGORY_CODES_FILE, semantic_category_array),
+                             (MERGED_CATEGORY_CODES_FILE, merged_category_array)):
+        with open(tmp_path(file_name), 'wb') as array_file:
+            np.save(array_file, array)
+
+    with open(tmp_path(CODES_FILE), 'w') as codes_file:
+        json.dump({
+            'categories': categories,
+            'semantic_categories': semantic_categories,
+            'merged_categories': merged_categories
+        }, codes_file, indent=2)
+
+    # Files are moved into place only once all of them are written, so processes that have the previous catalog
+    # mapped keep valid mappings of it
+    for file_name in (NAMES_FILE, NAME_OFFSETS_FILE, CATEGORY_CODES_FILE, SEMANTIC_CATEGORY_CODES_FILE,
+                      MERGED_CATEGORY_CODES_FILE, CODES_FILE):
+        os.replace(tmp_path(file_name), os.path.join(catalog_dir, file_name))
+
+
+class Catalog:
+    def __init__(self, catalog_dir: str):
+        with open(os.path.join(catalog_dir, CODES_FILE)) as codes_file:
+            codes_json = json.load(codes_file)
+
+        self.categories: List[str] = codes_json['categories']
+        self.semantic_categories: List[str] = codes_json['semantic_categories']
+        self.merged_categories: List[str] = codes_json['merged_categories']
+
+        self.files = [os.path.join(catalog_dir, f) for f in (
+            NAMES_FILE, NAME_OFFSETS_FILE, CATEGORY_CODES_FILE, SEMANTIC_CATEGORY_CODES_FILE, MERGED_CATEGORY_CODES_FILE
+        )]
+
+        def load(file_name: str) -> np.ndarray:
+            return np.load(os.path.join(catalog_dir, file_name), mmap_mode='r')
+
+        self.name_offsets = load(NAME_OFFSETS_FILE)
+        self.category_codes = load(CATEGORY_CODES_FILE)
+        self.semantic_category_codes = load(SEMANTIC_CATEGORY_CODES_FILE)
+        self.merged_category_codes = load(MERGED_CATEGORY_CODES_FILE)
+
+        with open(os.path.join(catalog_dir, NAMES_FILE), 'rb') as names_file:
+            if self.name_offsets[-1] > 0:
+                self.names = mmap.mmap(names_file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.names = b''
+
+    def __len__(self) -> int:
+        return len(self.category_codes)
+
+    def __contains__(self, item_id: int) -> bool:
+        return 0 <= item_id < len(self.category_codes) and self.category_codes[item_id] != MISSING_CODE
+
+    def name(self, item_id: int) -> str:
+        return self.names[self.name_offsets[item_id]:self.name_offsets[item_id + 1]].decode('utf-8')
+
+    def merged_category(self, item_id: int) -> str:
+        return self.merged_categories[self.merged_category_codes[item_id]]
+
+    def item(self, item_id: int) -> CatalogItem:
+        return CatalogItem(
+            id=int(item_id),
+            name=self.name(item_id),
+            category=self.categories[self.category_codes[item_id]],
+            semantic_category=self.semantic_categories[self.semantic_category_codes[item_id]],
+            merged=self.merged_categories[self.merged_category_codes[item_id]]
+        )
+
+    def items(self, item_ids: Iterable[int]) -> Dict[int, CatalogItem]:
+        return {item_id: self.item(item_id) for item_id in item_ids if item_id in self}
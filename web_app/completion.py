@@ -0,0 +1,124 @@
+# Completes a partial outfit with one item for every empty merged category. Candidates are scored against all outfit
+# items at once through a pairwise similarity matrix of their weighted embeddings, and a small beam search picks the
+# combination of candidates that fit the outfit and each other best.
+import time
+from typing import AbstractSet, Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+import metrics
+import similarity
+
+COMPLETION_CANDIDATES = 50
+# Candidates of a slot expanded per beam, in order of their similarity to the outfit
+COMPLETION_EXPANSIONS = 16
+COMPLETION_BEAM_WIDTH = 8
+COMPLETION_BUDGET_SECONDS = 0.05
+
+
+def weighted_embeddings(stacked: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    # Dot products of the flattened rows are the weighted sums of the per-mask cosine similarities
+    return (stacked * np.sqrt(weights / weights.sum())[None, :, None]).reshape(len(stacked), -1)
+
+
+def catalog_candidates(outfit_embeddings: np.ndarray, weights: np.ndarray,
+                       categories: List[str]) -> Dict[str, List[int]]:
+    # One query per category with the mean outfit vector of the most weighted mask
+    mask = int(np.argmax(weights))
+    query = outfit_embeddings[:, mask].mean(axis=0)
+    index = similarity.PRIMARY_CATEGORY_INDEXES[mask]
+
+    return {cat: index.get_nns_by_vector(cat, query, COMPLETION_CANDIDATES)[0] for cat in categories}
+
+
+def beam_search(base: np.ndarray, pairwise: np.ndarray, slots: List[np.ndarray], deadline: float) -> List[int]:
+    # Each beam is a total score and the chosen candidate row per slot so far. Adding a candidate adds its similarity
+    # to the outfit and to the candidates already chosen.
+    beams: List[Tuple[float, List[int]]] = [(0.0, [])]
+
+    for slot_rows in slots:
+        expansions = slot_rows[np.argsort(-base[slot_rows], kind='stable')[:COMPLETION_EXPANSIONS]]
+
+        # Past the deadline, the remaining slots take their best candidate for the outfit alone
+        if time.monotonic() > deadline:
+            beams = [(score + float(base[expansions[0]]), chosen + [int(expansions[0])]) for score, chosen in beams]
+            continue
+
+        scored = []
+        for score, chosen in beams:
+            scores = score + base[expansions] + pairwise[np.ix_(expansions, chosen)].sum(axis=1)
+            scored += [(float(s), chosen + [int(row)]) for s, row in zip(scores, expansions)]
+
+        scored.sort(key=lambda b: -b[0])
+        beams = scored[:COMPLETION_BEAM_WIDTH]
+
+    return beams[0][1]
+
+
+@metrics.timed('complete_outfit')
+def complete_outfit(session: Session, outfit_ids: List[int], weights: List[float],
+                    wardrobe_by_category: Optional[Dict[str, AbstractSet[int]]] = None,
+                    budget_seconds: float = COMPLETION_BUDGET_SECONDS) -> similarity.CategoryResults:
+    # Searches the wardrobe when its items by category are given and the catalog otherwise. Results hold the chosen
+    # item of each empty category with a distance like the other category results: the angular distance of its mean
+    # similarity to the rest of the completed outfit.
+    deadline = time.monotonic() + budget_seconds
+    mask_weights = np.asarray(weights, dtype=np.float32)
+
+    outfit_categories = similarity.item_merged_categories(session, outfit_ids)
+    if len(outfit_categories) != len(set(outfit_ids)):
+        raise ValueError('Unknown outfit items')
+
+    empty_categories = [c for c in similarity.MERGED_CATEGORIES if c not in outfit_categories.values()]
+    outfit_embeddings = similarity.stacked_embeddings(session, outfit_ids)
+
+    with metrics.timed('candidates'):
+        if wardrobe_by_category is not None:
+            candidates = {cat: sorted(wardrobe_by_category.get(cat, ())) for cat in empty_categories}
+        else:
+            candidates = catalog_candidates(outfit_embeddings, mask_weights, empty_categories)
+
+        outfit_id_set = set(outfit_ids)
+        candidates = {cat: [i for i in ids if i not in outfit_id_set] for cat, ids in candidates.items()}
+        candidate_ids = [i for cat in empty_categories for i in candidates[cat]]
+
+    results: similarity.CategoryResults = {}
+    if len(candidate_ids) == 0:
+        return results
+
+    with metrics.timed('scoring'):
+        outfit_vectors = weighted_embeddings(outfit_embeddings, mask_weights)
+        candidate_vectors = weighted_embeddings(similarity.stacked_embeddings(session, candidate_ids), mask_weights)
+
+        base = (candidate_vectors @ outfit_vectors.T).mean(axis=1)
+
+        # Wardrobes can hold many items of a category, of which only the best fits for the outfit are searched
+        selected, filled, start = [], [], 0
+        for cat in empty_categories:
+            rows = np.arange(start, start + len(candidates[cat]))
+            start += len(rows)
+            if len(rows) == 0:
+                continue
+
+            rows = rows[np.argsort(-base[rows], kind='stable')[:COMPLETION_CANDIDATES]]
+            filled.append((cat, np.arange(len(rows)) + sum(len(r) for r in selected)))
+            selected.append(rows)
+
+        selected = np.concatenate(selected)
+        candidate_ids = [candidate_ids[row] for row in selected.tolist()]
+        base = base[selected]
+        candidate_vectors = candidate_vectors[selected]
+        pairwise = candidate_vectors @ candidate_vectors.T
+
+    with metrics.timed('beam_search'):
+        chosen = beam_search(base, pairwise, [rows for _, rows in filled], deadline)
+
+    num_items = len(outfit_ids) + len(chosen)
+    for (cat, _), row in zip(filled, chosen):
+        # Similarity to the original items and to the other chosen items, without the item itself
+        total = base[row] * len(outfit_ids) + pairwise[row, chosen].sum() - pairwise[row, row]
+        mean_similarity = total / max(num_items - 1, 1)
+        results[cat] = [(candidate_ids[row], float(np.sqrt(max(2 - 2 * mean_similarity, 0))))]
+
+    return results
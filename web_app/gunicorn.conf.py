@@ -0,0 +1,19 @@
+# gunicorn -c gunicorn.conf.py app:application
+import os
+
+from memory import process_memory, format_memory
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', '8000'))
+workers = int(os.environ.get('WEB_CONCURRENCY', '4'))
+
+# Import the app, and with it load and warm up the memory-mapped indexes and catalog, once in the master before
+# forking, so every worker shares the same page-cache pages instead of mapping and faulting them in separately
+preload_app = True
+
+
+def when_ready(server):
+    server.log.info('Master {} memory: {}'.format(os.getpid(), format_memory(process_memory())))
+
+
+def post_worker_init(worker):
+    worker.log.info('Worker {} memory: {}'.format(os.getpid(), format_memory(process_memory())))
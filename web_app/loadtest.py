@@ -0,0 +1,416 @@
+# Load generator for the app. Seeds users with random wardrobes through the app's own sign-up and randomize routes,
+# then has every user drive a mix of recommendation, wardrobe and outfit requests concurrently, and saves throughput
+# and latency percentiles per endpoint as JSON, so runs before and after a change can be compared.
+#
+# Against a running deployment:
+# python loadtest.py --url http://localhost:8000 --users 50 --duration 60
+#
+# Against a local stand-in, started with gunicorn on a SQLite copy of the catalog (loaded by the app's item loader, which
+# reads the embedding files). The stand-in runs in data/loadtest with indexes, catalog and sessions of its own:
+# python loadtest.py --serve --users 50 --duration 60
+#
+# With --async, the routes async_app.py serves are sent to it instead, started next to the app when serving a stand-in:
+# python loadtest.py --serve --async --users 50 --duration 60
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from argparse import ArgumentParser
+from http.cookiejar import CookieJar
+from typing import Dict, List, Optional, Tuple
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import HTTPCookieProcessor, Request, build_opener
+
+import numpy as np
+
+DEFAULT_URL = 'http://localhost:8000'
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+# Working directory of the stand-in, where the data files the app writes go instead of next to those of the app
+STANDIN_DIR = 'data/loadtest'
+STANDIN_DB_FILE_PATH = os.path.join(STANDIN_DIR, 'standin.sqlite')
+STANDIN_CONFIG_FILE_PATH = os.path.join(STANDIN_DIR, 'config.json')
+# Inputs of the item loader and the images, linked into the stand-in's directory
+STANDIN_SHARED_PATHS = ['data/embeddings', 'data/categories.csv', 'data/item_metadata.json', 'static']
+STANDIN_PORT = 8050
+STANDIN_ASYNC_PORT = 8051
+SERVER_START_SECONDS = 600
+
+REQUEST_TIMEOUT_SECONDS = 30
+MAX_OUTFIT_ITEMS = 4
+
+# Relative weights of the actions every user picks from
+DEFAULT_MIX = {
+    'recommend': 60,
+    'recommend_batch': 10,
+    'add_wardrobe_item': 10,
+    'remove_wardrobe_item': 10,
+    'create_outfit': 5,
+    'delete_outfit': 5
+}
+
+# Routes async_app.py serves
+ASYNC_PATHS = ('/api/recommend', '/api/add_wardrobe_item', '/api/remove_wardrobe_item')
+
+CSRF_TOKEN_PATTERN = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+        self.statuses: Dict[str, Dict[int, int]] = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint: str, seconds: float, status: int):
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            endpoint_statuses = self.statuses.setdefault(endpoint, {})
+            endpoint_statuses[status] = endpoint_statuses.get(status, 0) + 1
+
+    def report(self, duration: float) -> Dict:
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            ms = np.asarray(latencies) * 1000
+            statuses = self.statuses[endpoint]
+            endpoints[endpoint] = {
+                'requests': len(ms),
+                'errors': sum(n for status, n in statuses.items() if not 200 <= status < 400),
+                'statuses': {str(status): n for status, n in sorted(statuses.items())},
+                'throughput_rps': len(ms) / duration,
+                'mean_ms': float(ms.mean()),
+                'p50_ms': float(np.percentile(ms, 50)),
+                'p95_ms': float(np.percentile(ms, 95)),
+                'p99_ms': float(np.percentile(ms, 99)),
+                'max_ms': float(ms.max())
+            }
+
+        num_requests = sum(e['requests'] for e in endpoints.values())
+        return {
+            'requests': num_requests,
+            'errors': sum(e['errors'] for e in endpoints.values()),
+            'throughput_rps': num_requests / duration,
+            'endpoints': endpoints
+        }
+
+
+class Client:
+    # One user, with its own session cookie and what it knows about its wardrobe and outfits
+    def __init__(self, base_url: str, recorder: Recorder, async_url: Optional[str] = None):
+        self.base_url = base_url.rstrip('/')
+        self.async_url = async_url.rstrip('/') if async_url is not None else None
+        self.recorder = recorder
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()))
+
+        self.wardrobe_ids: List[int] = []
+        self.seen_ids: List[int] = []
+        self.outfit_ids: List[int] = []
+
+    def request(self, endpoint: str, path: str, data: Optional[bytes] = None,
+                headers: Dict[str, str] = None) -> Tuple[int, bytes]:
+        url = self.async_url if self.async_url is not None and path in ASYNC_PATHS else self.base_url
+        request = Request(url + path, data=data, headers=headers or {})
+        start_time = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=REQUEST_TIMEOUT_SECONDS) as response:
+                status, body = response.status, response.read()
+        except HTTPError as e:
+            status, body = e.code, e.read()
+        except (URLError, OSError):
+            # Connection errors and timeouts
+            status, body = 0, b''
+
+        self.recorder.record(endpoint, time.perf_counter() - start_time, status)
+        return status, body
+
+    def post_json(self, endpoint: str, path: str, body: Dict) -> Tuple[int, Optional[Dict]]:
+        status, response_body = self.request(endpoint, path, json.dumps(body).encode(),
+                                             {'Content-Type': 'application/json'})
+        return status, json.loads(response_body) if status == 200 else None
+
+    def sign_up(self, username: str) -> bool:
+        _, body = self.request('signup_form', '/signup')
+        token = CSRF_TOKEN_PATTERN.search(body.decode())
+        if token is None:
+            return False
+
+        form = urlencode({'csrf_token': token.group(1), 'username': username, 'submit': 'Sign Up'}).encode()
+        status, _ = self.request('signup', '/signup', form, {'Content-Type': 'application/x-www-form-urlencoded'})
+        return status == 200
+
+    def randomize_wardrobe(self):
+        self.request('randomize_wardrobe', '/randomize-wardrobe')
+
+        cursors = {}
+        status, body = self.request('api_wardrobe', '/api/wardrobe?limit=200')
+        while status == 200:
+            for page in json.loads(body)['results']:
+                self.wardrobe_ids += [item['id'] for item in page['items']]
+                if page['next_cursor'] is not None:
+                    cursors[page['category']] = page['next_cursor']
+
+            if len(cursors) == 0:
+                break
+            category, cursor = cursors.popitem()
+            status, body = self.request('api_wardrobe', '/api/wardrobe?' + urlencode(
+                {'category': category, 'cursor': cursor, 'limit': 200}))
+
+    def recommend(self):
+        query_ids = self.wardrobe_ids + self.seen_ids
+        if len(query_ids) == 0:
+            return
+
+        status, response_json = self.post_json('recommend', '/api/recommend', {
+            'item_id': random.choice(query_ids),
+            'wardrobe': 'random'
+        })
+        if status == 200:
+            self.remember([item for item in response_json['results'] if not item['in_wardrobe']])
+
+    def recommend_batch(self):
+        if len(self.wardrobe_ids) == 0:
+            return
+
+        status, response_json = self.post_json('recommend_batch', '/api/recommend_batch', {
+            'queries': [{'item_id': i, 'scope': 'random'}
+                        for i in random.sample(self.wardrobe_ids, min(3, len(self.wardrobe_ids)))]
+        })
+        if status == 200:
+            self.remember([item for q in response_json['results'] for item in q['results'] if not item['in_wardrobe']])
+
+    def remember(self, items: List[Dict]):
+        self.seen_ids = (self.seen_ids + [item['id'] for item in items])[-100:]
+
+    def add_wardrobe_item(self):
+        candidates = [i for i in self.seen_ids if i not in self.wardrobe_ids]
+        if len(candidates) == 0:
+            return self.recommend()
+
+        item_id = random.choice(candidates)
+        status, _ = self.post_json('add_wardrobe_item', '/api/add_wardrobe_item', {'item_id': item_id})
+        if status == 200:
+            self.wardrobe_ids.append(item_id)
+
+    def remove_wardrobe_item(self):
+        if len(self.wardrobe_ids) == 0:
+            return
+
+        item_id = random.choice(self.wardrobe_ids)
+        status, _ = self.post_json('remove_wardrobe_item', '/api/remove_wardrobe_item', {'item_id': item_id})
+        if status == 200:
+            self.wardrobe_ids.remove(item_id)
+
+    def create_outfit(self):
+        if len(self.wardrobe_ids) == 0:
+            return
+
+        status, response_json = self.post_json('create_outfit', '/api/create_outfit', {
+            'items': random.sample(self.wardrobe_ids, min(MAX_OUTFIT_ITEMS, len(self.wardrobe_ids))),
+            'name': 'Load test'
+        })
+        if status == 200:
+            self.outfit_ids.append(response_json['outfit_id'])
+
+    def delete_outfit(self):
+        if len(self.outfit_ids) == 0:
+            return self.create_outfit()
+
+        outfit_id = self.outfit_ids.pop(random.randrange(len(self.outfit_ids)))
+        self.post_json('delete_outfit', '/api/delete_outfit', {'outfit_id': outfit_id})
+
+
+def seed_users(base_url: str, num_users: int, recorder: Recorder, async_url: Optional[str] = None) -> List[Client]:
+    # Usernames are unique per run, so runs against the same database don't collide
+    run_id = uuid.uuid4().hex[:6]
+    clients = [Client(base_url, recorder, async_url) for _ in range(num_users)]
+
+    def seed(i: int):
+        if clients[i].sign_up('lt{}-{}'.format(run_id, i)):
+            clients[i].randomize_wardrobe()
+
+    threads = [threading.Thread(target=seed, args=(i,)) for i in range(num_users)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return clients
+
+
+def run_user(client: Client, mix: Dict[str, int], deadline: float, think_seconds: float, seed: int):
+    rng = random.Random(seed)
+    actions = list(mix)
+    weights = [mix[a] for a in actions]
+
+    while time.monotonic() < deadline:
+        getattr(client, rng.choices(actions, weights)[0])()
+        if think_seconds > 0:
+            time.sleep(rng.expovariate(1 / think_seconds))
+
+
+def run_load(clients: List[Client], mix: Dict[str, int], duration: float, think_seconds: float,
+             seed: int) -> float:
+    start_time = time.monotonic()
+    deadline = start_time + duration
+    threads = [threading.Thread(target=run_user, args=(client, mix, deadline, think_seconds, seed + i))
+               for i, client in enumerate(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    return time.monotonic() - start_time
+
+
+def prepare_standin():
+    # A SQLite copy of the catalog, loaded by the app's own item loader, which resumes an unfinished load and skips a
+    # finished one
+    os.makedirs(os.path.join(STANDIN_DIR, 'data'), exist_ok=True)
+    for path in STANDIN_SHARED_PATHS:
+        link_path = os.path.join(STANDIN_DIR, path)
+        if os.path.exists(path) and not os.path.lexists(link_path):
+            os.symlink(os.path.abspath(path), link_path)
+
+    with open('config.json') as config_file:
+        config_json = json.load(config_file)
+    config_json['database'] = {'uri': 'sqlite:///' + os.path.abspath(STANDIN_DB_FILE_PATH)}
+    with open(STANDIN_CONFIG_FILE_PATH, 'w') as config_file:
+        json.dump(config_json, config_file, indent=2)
+
+    print('Loading stand-in database {}.'.format(STANDIN_DB_FILE_PATH))
+    subprocess.run([sys.executable, os.path.join(APP_DIR, 'app.py')], cwd=STANDIN_DIR, env=standin_env(),
+                   check=True)
+
+
+def standin_env(**env) -> Dict[str, str]:
+    # Run in the stand-in's directory, with the app's modules importable from there
+    return dict(os.environ, CONFIG_FILE='config.json', PYTHONPATH=APP_DIR, **env)
+
+
+def start_server(port: int, workers: int, app: str = 'app:application', worker_class: str = 'sync',
+                 ready_path: str = '/login') -> subprocess.Popen:
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(APP_DIR, 'gunicorn.conf.py'), '--worker-class',
+         worker_class, app],
+        cwd=STANDIN_DIR,
+        env=standin_env(PORT=str(port), WEB_CONCURRENCY=str(workers))
+    )
+
+    # Indexes are loaded and warmed up before the first request is served
+    url = 'http://localhost:{}{}'.format(port, ready_path)
+    deadline = time.monotonic() + SERVER_START_SECONDS
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('Server exited with code {}'.format(server.returncode))
+        try:
+            with build_opener().open(url, timeout=5):
+                return server
+        except HTTPError:
+            # Any response means the server is up
+            return server
+        except (URLError, OSError):
+            time.sleep(1)
+
+    server.terminate()
+    raise RuntimeError('Server did not start within {}s'.format(SERVER_START_SECONDS))
+
+
+def parse_mix(mix: str) -> Dict[str, int]:
+    # e.g. "recommend=80,add_wardrobe_item=10,remove_wardrobe_item=10"
+    parsed = {}
+    for part in mix.split(','):
+        action, weight = part.split('=')
+        if action not in DEFAULT_MIX:
+            raise ValueError('Unknown action {}, expected one of {}'.format(action, ', '.join(DEFAULT_MIX)))
+        parsed[action] = int(weight)
+
+    return parsed
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Measure throughput and latency of the app under concurrent users.')
+    parser.add_argument('--url', type=str, default=None, help='Base URL of a running app (default: {}).'.format(
+        DEFAULT_URL))
+    parser.add_argument('--serve', action='store_true',
+                        help='Start the app with gunicorn against a local SQLite stand-in database.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Gunicorn workers of the stand-in, split between both servers with --async.')
+    parser.add_argument('--async', dest='async_app', action='store_true',
+                        help='Send the routes of async_app.py to it, started next to the stand-in server with --serve.')
+    parser.add_argument('--async-url', type=str, default=None,
+                        help='Base URL of a running async_app.py (default: the stand-in async server).')
+    parser.add_argument('--users', '-u', type=int, default=20)
+    parser.add_argument('--duration', '-d', type=float, default=60, help='Seconds to run the mix for.')
+    parser.add_argument('--think', type=float, default=0.0, help='Mean pause between the requests of a user.')
+    parser.add_argument('--mix', type=str, default=None,
+                        help='Action weights, e.g. recommend=80,add_wardrobe_item=10,remove_wardrobe_item=10.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', '-o', type=str, default='loadtest.json')
+
+    args = parser.parse_args()
+    print(args)
+
+    action_mix = parse_mix(args.mix) if args.mix is not None else DEFAULT_MIX
+    base_url = args.url or DEFAULT_URL
+    async_url = args.async_url
+    standin_servers = []
+    # With the async server, both servers together get the same number of workers as the app alone, so runs with and
+    # without --async compare at the same worker count
+    async_workers = max(args.workers // 2, 1) if args.serve and args.async_app and async_url is None else 0
+    try:
+        if args.serve:
+            prepare_standin()
+            standin_servers.append(start_server(STANDIN_PORT, max(args.workers - async_workers, 1)))
+            base_url = args.url or 'http://localhost:{}'.format(STANDIN_PORT)
+
+            if async_workers > 0:
+                standin_servers.append(start_server(STANDIN_ASYNC_PORT, async_workers, 'async_app:application',
+                                                    'aiohttp.GunicornWebWorker', ASYNC_PATHS[0]))
+                async_url = 'http://localhost:{}'.format(STANDIN_ASYNC_PORT)
+
+        seed_recorder = Recorder()
+        seed_start_time = time.monotonic()
+        users = seed_users(base_url, args.users, seed_recorder, async_url)
+        seed_duration = time.monotonic() - seed_start_time
+        print('Seeded {} users with {} wardrobe items (took {:.2f}s)'.format(
+            len(users), sum(len(u.wardrobe_ids) for u in users), seed_duration))
+
+        load_recorder = Recorder()
+        for u in users:
+            u.recorder = load_recorder
+        load_duration = run_load(users, action_mix, args.duration, args.think, args.seed)
+    finally:
+        for server in standin_servers:
+            server.terminate()
+            server.wait()
+
+    load_report = load_recorder.report(load_duration)
+    for name, e in load_report['endpoints'].items():
+        print('{:<22} {:>7} req {:>6} err {:>8.1f} rps  p50 {:>8.2f}ms  p95 {:>8.2f}ms  p99 {:>8.2f}ms'.format(
+            name, e['requests'], e['errors'], e['throughput_rps'], e['p50_ms'], e['p95_ms'], e['p99_ms']))
+    print('Total {} requests, {} errors, {:.1f} rps'.format(
+        load_report['requests'], load_report['errors'], load_report['throughput_rps']))
+
+    with open(args.output, 'w') as output_file:
+        json.dump({
+            'url': base_url,
+            'async_url': async_url,
+            'standin': args.serve,
+            'users': args.users,
+            'workers': args.workers,
+            'async_workers': async_workers,
+            'duration_seconds': load_duration,
+            'think_seconds': args.think,
+            'mix': action_mix,
+            'seed': args.seed,
+            'platform': platform.platform(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'seeding': dict(seed_recorder.report(seed_duration), seconds=seed_duration),
+            'load': load_report
+        }, output_file, indent=2)
+    print('Saved results to {}'.format(args.output))
@@ -0,0 +1,42 @@
+import os
+import resource
+from typing import Dict
+
+SMAPS_ROLLUP_PATH = '/proc/self/smaps_rollup'
+STATUS_PATH = '/proc/self/status'
+
+SMAPS_FIELDS = {
+    'Rss': 'rss',
+    'Pss': 'pss',
+    'Shared_Clean': 'shared_clean',
+    'Shared_Dirty': 'shared_dirty',
+    'Private_Clean': 'private_clean',
+    'Private_Dirty': 'private_dirty'
+}
+
+
+def process_memory() -> Dict[str, int]:
+    # Sizes in bytes. On Linux, pss and the shared/private split show whether memory-mapped index pages are really
+    # shared between workers; elsewhere only the peak RSS is available.
+    if os.path.exists(SMAPS_ROLLUP_PATH):
+        memory: Dict[str, int] = {}
+        with open(SMAPS_ROLLUP_PATH) as smaps_file:
+            for line in smaps_file:
+                field, _, value = line.partition(':')
+                if field in SMAPS_FIELDS:
+                    memory[SMAPS_FIELDS[field]] = int(value.split()[0]) * 1024
+        return memory
+
+    if os.path.exists(STATUS_PATH):
+        with open(STATUS_PATH) as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return {'rss': int(line.split()[1]) * 1024}
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'max_rss': max_rss if os.uname().sysname == 'Darwin' else max_rss * 1024}
+
+
+def format_memory(memory: Dict[str, int]) -> str:
+    return ', '.join('{} {:.1f} MB'.format(k, v / (1024 * 1024)) for k, v in memory.items())
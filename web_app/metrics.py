@@ -0,0 +1,161 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+from flask import Flask, g, request, has_request_context, current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+METRIC_PREFIX = 'fashionapp_'
+
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+QUERY_COUNT_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50, 100]
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: List[float]):
+        self.buckets = buckets
+        # The last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+HISTOGRAM_HELP = {
+    'request_seconds': 'Request latency by route.',
+    'stage_seconds': 'Latency of request stages by route and stage.',
+    'db_queries': 'Database queries per request by route.'
+}
+
+HISTOGRAMS: Dict[str, Dict[Labels, Histogram]] = {name: {} for name in HISTOGRAM_HELP}
+HISTOGRAM_BUCKETS = {
+    'request_seconds': LATENCY_BUCKETS,
+    'stage_seconds': LATENCY_BUCKETS,
+    'db_queries': QUERY_COUNT_BUCKETS
+}
+HISTOGRAMS_LOCK = threading.Lock()
+
+# Gauges are read from their sources when the metrics are rendered
+GaugeSource = Callable[[], List[Tuple[Dict[str, str], float]]]
+GAUGES: Dict[str, Tuple[str, GaugeSource]] = {}
+
+# Maximum database queries per request by route, enforced in testing mode
+QUERY_BUDGETS: Dict[str, int] = {}
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def observe(name: str, value: float, **labels: str):
+    key = tuple(sorted(labels.items()))
+    with HISTOGRAMS_LOCK:
+        histogram = HISTOGRAMS[name].get(key)
+        if histogram is None:
+            histogram = HISTOGRAMS[name][key] = Histogram(HISTOGRAM_BUCKETS[name])
+        histogram.observe(value)
+
+
+def current_route() -> str:
+    if has_request_context() and request.endpoint is not None:
+        return request.endpoint
+
+    return 'none'
+
+
+@contextmanager
+def timed(stage: str):
+    # Usable both around a block and as a function decorator
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('stage_seconds', time.perf_counter() - start_time, route=current_route(), stage=stage)
+
+
+def register_gauge(name: str, help_text: str, source: GaugeSource):
+    GAUGES[name] = (help_text, source)
+
+
+def set_query_budgets(budgets: Dict[str, int]):
+    QUERY_BUDGETS.update(budgets)
+
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'db_queries' in g:
+        g.db_queries += 1
+
+
+def start_request():
+    g.request_start_time = time.perf_counter()
+    g.db_queries = 0
+
+
+def finish_request(response):
+    if 'request_start_time' in g:
+        route = current_route()
+        observe('request_seconds', time.perf_counter() - g.request_start_time, route=route)
+        observe('db_queries', g.db_queries, route=route)
+
+        budget = QUERY_BUDGETS.get(route)
+        if current_app.testing and budget is not None and g.db_queries > budget:
+            raise QueryBudgetExceeded('{} ran {} queries, over its budget of {}'.format(route, g.db_queries, budget))
+
+    return response
+
+
+def init_app(application: Flask):
+    event.listen(Engine, 'before_cursor_execute', count_query)
+    application.before_request(start_request)
+    application.after_request(finish_request)
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if len(labels) == 0:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels.items()) + '}'
+
+
+def format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def render_metrics() -> str:
+    # Prometheus text exposition format
+    lines = []
+
+    with HISTOGRAMS_LOCK:
+        for name, histograms in HISTOGRAMS.items():
+            metric = METRIC_PREFIX + name
+            lines.append('# HELP {} {}'.format(metric, HISTOGRAM_HELP[name]))
+            lines.append('# TYPE {} histogram'.format(metric))
+
+            for key, histogram in sorted(histograms.items()):
+                labels = dict(key)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + [float('inf')], histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else format_value(bound)
+                    lines.append('{}_bucket{} {}'.format(metric, format_labels(dict(labels, le=le)), cumulative))
+                lines.append('{}_sum{} {}'.format(metric, format_labels(labels), format_value(histogram.sum)))
+                lines.append('{}_count{} {}'.format(metric, format_labels(labels), histogram.count))
+
+    for name, (help_text, source) in GAUGES.items():
+        metric = METRIC_PREFIX + name
+        lines.append('# HELP {} {}'.format(metric, help_text))
+        lines.append('# TYPE {} gauge'.format(metric))
+        for labels, value in source():
+            lines.append('{}{} {}'.format(metric, format_labels(labels), format_value(value)))
+
+    return '\n'.join(lines) + '\n'
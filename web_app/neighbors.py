@@ -0,0 +1,206 @@
+# Precomputes the nearest neighbours of every catalog item in every merged category for every mask, so catalog
+# recommendations are served with an array lookup instead of index queries. Run after the indexes are built, and
+# again after each compaction, since a table is only used with the index generation it was computed from:
+#
+# python neighbors.py --processes 8 -k 4
+import json
+import multiprocessing
+import os
+import time
+from argparse import ArgumentParser
+from typing import List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy.orm import Session
+
+import metrics
+import similarity
+from tables import FashionItem
+
+NEIGHBORS_DIR = os.path.join(similarity.INDEXES_DIR, 'neighbors')
+# (item ids, masks, categories, k) arrays of neighbour ids, -1 where a category has fewer than k items, and distances
+IDS_FILE_PATH = os.path.join(NEIGHBORS_DIR, 'ids.npy')
+DISTANCES_FILE_PATH = os.path.join(NEIGHBORS_DIR, 'distances.npy')
+META_FILE_PATH = os.path.join(NEIGHBORS_DIR, 'meta.json')
+
+DEFAULT_K = 4
+CHUNK_SIZE = 1000
+MISSING_ID = -1
+
+# How often workers look for a table of the current generation while theirs is missing or stale
+TABLE_CHECK_SECONDS = 60
+
+worker_indexes: List[similarity.PartitionedIndex] = []
+worker_store: Optional[np.ndarray] = None
+
+
+def init_worker():
+    global worker_indexes
+    global worker_store
+
+    worker_indexes = similarity.load_category_indexes()
+    worker_store = np.load(similarity.EMBEDDINGS_FILE_PATH, mmap_mode='r')
+
+
+def compute_chunk(task: Tuple[np.ndarray, int]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    item_ids, k = task
+    shape = (len(item_ids), similarity.NUM_MASKS + 1, len(similarity.MERGED_CATEGORIES), k)
+    ids = np.full(shape, MISSING_ID, dtype=np.int32)
+    distances = np.full(shape, np.inf, dtype=np.float16)
+
+    vectors = np.asarray(worker_store[item_ids], dtype=np.float32)
+    for row, item_id in enumerate(item_ids.tolist()):
+        for mask, index in enumerate(worker_indexes):
+            for c, cat in enumerate(similarity.MERGED_CATEGORIES):
+                # One extra result in case the item is in this category
+                cat_ids, cat_distances = index.get_nns_by_vector(cat, vectors[row, mask], k + 1)
+                cat_results = [r for r in zip(cat_ids, cat_distances) if r[0] != item_id][0:k]
+                ids[row, mask, c, :len(cat_results)] = [r[0] for r in cat_results]
+                distances[row, mask, c, :len(cat_results)] = [r[1] for r in cat_results]
+
+    return item_ids, ids, distances
+
+
+def build_neighbor_table(k: int = DEFAULT_K, processes: int = os.cpu_count(), chunk_size: int = CHUNK_SIZE):
+    os.makedirs(NEIGHBORS_DIR, exist_ok=True)
+    generation = similarity.read_index_generation()
+    store = np.load(similarity.EMBEDDINGS_FILE_PATH, mmap_mode='r')
+
+    # Ids without an item have no embeddings
+    item_ids = np.flatnonzero(np.any(store[:, 0] != 0, axis=1))
+    shape = (len(store), similarity.NUM_MASKS + 1, len(similarity.MERGED_CATEGORIES), k)
+    ids = np.lib.format.open_memmap(IDS_FILE_PATH + '.tmp', mode='w+', dtype=np.int32, shape=shape)
+    distances = np.lib.format.open_memmap(DISTANCES_FILE_PATH + '.tmp', mode='w+', dtype=np.float16, shape=shape)
+    ids[:] = MISSING_ID
+    distances[:] = np.inf
+
+    print('Computing {} neighbours per category of {} items.'.format(k, len(item_ids)))
+    start_time = time.time()
+    tasks = ((item_ids[start:start + chunk_size], k) for start in range(0, len(item_ids), chunk_size))
+    num_done = 0
+    with multiprocessing.Pool(processes, initializer=init_worker) as pool:
+        for chunk_ids, chunk_neighbor_ids, chunk_distances in pool.imap_unordered(compute_chunk, tasks):
+            ids[chunk_ids] = chunk_neighbor_ids
+            distances[chunk_ids] = chunk_distances
+            num_done += len(chunk_ids)
+            print('\r{} / {} ({:.2f}s)'.format(num_done, len(item_ids), time.time() - start_time), end='')
+    print()
+
+    ids.flush()
+    distances.flush()
+    del ids, distances
+    os.replace(IDS_FILE_PATH + '.tmp', IDS_FILE_PATH)
+    os.replace(DISTANCES_FILE_PATH + '.tmp', DISTANCES_FILE_PATH)
+
+    # The metadata is written last, so workers never load a partially written table
+    with open(META_FILE_PATH + '.tmp', 'w') as meta_file:
+        json.dump({
+            'generation': generation,
+            'k': k,
+            'categories': similarity.MERGED_CATEGORIES,
+            'num_items': len(item_ids),
+            'build_seconds': time.time() - start_time
+        }, meta_file, indent=2)
+    os.replace(META_FILE_PATH + '.tmp', META_FILE_PATH)
+
+    print('Saved neighbour table of generation {} (took {:.2f}s)'.format(generation, time.time() - start_time))
+
+
+class NeighborTable:
+    def __init__(self):
+        with open(META_FILE_PATH) as meta_file:
+            meta_json = json.load(meta_file)
+
+        self.generation: int = meta_json['generation']
+        self.k: int = meta_json['k']
+        self.categories: List[str] = meta_json['categories']
+        self.ids = np.load(IDS_FILE_PATH, mmap_mode='r')
+        self.distances = np.load(DISTANCES_FILE_PATH, mmap_mode='r')
+
+    def lookup(self, item_id: int, mask: int, results_per_category: int) -> Optional[similarity.CategoryResults]:
+        if results_per_category > self.k or not 0 <= item_id < len(self.ids):
+            return None
+
+        ids = np.asarray(self.ids[item_id, mask, :, :results_per_category])
+        # Items that weren't in the catalog when the table was computed have no neighbours at all
+        if np.all(ids == MISSING_ID):
+            return None
+
+        distances = np.asarray(self.distances[item_id, mask, :, :results_per_category], dtype=np.float32)
+        return {
+            cat: [(i, d) for i, d in zip(ids[c].tolist(), distances[c].tolist()) if i != MISSING_ID]
+            for c, cat in enumerate(self.categories)
+        }
+
+
+NEIGHBOR_TABLE: Optional[NeighborTable] = None
+last_table_check: Optional[float] = None
+
+
+def current_table() -> Optional[NeighborTable]:
+    global NEIGHBOR_TABLE
+    global last_table_check
+
+    table = NEIGHBOR_TABLE
+    if table is not None and table.generation == similarity.INDEX_GENERATION:
+        return table
+
+    now = time.monotonic()
+    if last_table_check is not None and now - last_table_check < TABLE_CHECK_SECONDS:
+        return None
+    last_table_check = now
+
+    NEIGHBOR_TABLE = NeighborTable() if os.path.exists(META_FILE_PATH) else None
+    if NEIGHBOR_TABLE is None or NEIGHBOR_TABLE.generation != similarity.INDEX_GENERATION:
+        return None
+
+    return NEIGHBOR_TABLE
+
+
+def get_table_nn_ids_by_category(query: FashionItem, mask: int,
+                                 results_per_category: int) -> Optional[similarity.CategoryResults]:
+    table = current_table()
+    results = table.lookup(query.id, mask, results_per_category) if table is not None else None
+    if results is None:
+        return None
+
+    # Items added since the table was computed are only in the delta index
+    partitioned = similarity.PRIMARY_CATEGORY_INDEXES[mask]
+    if partitioned.delta is not None and partitioned.delta.get_n_items() > 0:
+        vector = query.embeddings()[mask]
+        for cat, cat_results in results.items():
+            ids, distances = partitioned.merge_delta(cat, vector, results_per_category + 1,
+                                                     [r[0] for r in cat_results], [r[1] for r in cat_results])
+            results[cat] = [r for r in zip(ids, distances) if r[0] != query.id][0:results_per_category]
+
+    return results
+
+
+def catalog_nn_ids_by_category(session: Session, mask: int, query: FashionItem, results_per_category: int,
+                               mmr_lambda: Optional[float] = None) -> similarity.CategoryResults:
+    # Diversified results need a larger pool than the table holds, so they are always searched
+    if mmr_lambda is None:
+        with metrics.timed('neighbor_table'):
+            results = get_table_nn_ids_by_category(query, mask, results_per_category)
+        if results is not None:
+            return results
+
+    return similarity.get_catalog_nn_ids_by_category(session, mask, query, results_per_category,
+                                                     mmr_lambda=mmr_lambda)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-k', type=int, default=DEFAULT_K, help='Neighbours stored per item, mask and category.')
+    parser.add_argument('--processes', '-p', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--config', type=str, default='config.json')
+
+    args = parser.parse_args()
+    print(args)
+
+    # Loads the same kind of category indexes as the app
+    with open(args.config) as config_file:
+        similarity.configure_indexes(json.load(config_file).get('indexes', {}))
+
+    build_neighbor_table(args.k, args.processes, args.chunk_size)
@@ -0,0 +1,227 @@
+# Compressed storage and search for normalized embeddings. Vectors are encoded either with per-dimension 8-bit scalar
+# quantization (4x smaller than float32) or with product quantization, which splits them into subspaces and stores the
+# nearest of 256 trained centroids per subspace (one byte per subspace, 16x smaller at the defaults).
+#
+# Queries are scored with asymmetric distance computation: the query stays in full precision and is compared against
+# the codes through per-query lookup tables, so codes are never decompressed. The best candidates can then be
+# re-ranked exactly against full-precision vectors, which are memory-mapped and only read for those rows.
+from typing import Optional, Tuple, Union
+
+import numpy as np
+
+QUANTIZATION_METHODS = ['int8', 'pq']
+NUM_CENTROIDS = 256
+DEFAULT_NUM_SUBSPACES = 16
+DEFAULT_RERANK = 100
+KMEANS_ITERATIONS = 20
+# Codebooks are trained on a sample, which is plenty for 256 centroids per subspace
+TRAIN_SIZE = 100000
+# Rows scored per step, which bounds the temporary arrays of large partitions
+SCORE_BATCH_SIZE = 65536
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def training_sample(vectors: np.ndarray, train_size: int, seed: int) -> np.ndarray:
+    if len(vectors) <= train_size:
+        return normalize(vectors)
+
+    rows = np.sort(np.random.RandomState(seed).choice(len(vectors), size=train_size, replace=False))
+    return normalize(vectors[rows])
+
+
+def kmeans(x: np.ndarray, k: int, iterations: int, rng: np.random.RandomState) -> np.ndarray:
+    centroids = x[rng.choice(len(x), size=k, replace=len(x) < k)].copy()
+
+    for _ in range(iterations):
+        assignments = nearest_centroids(x, centroids)
+        counts = np.bincount(assignments, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, x)
+
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Empty clusters are restarted from random points instead of being wasted
+        centroids[empty] = x[rng.choice(len(x), size=int(empty.sum()))]
+
+    return centroids
+
+
+def nearest_centroids(x: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    # argmin |x - c|^2 = argmin |c|^2 - 2 x.c, since |x|^2 is the same for every centroid
+    assignments = np.empty(len(x), dtype=np.int64)
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    for start in range(0, len(x), SCORE_BATCH_SIZE):
+        batch = x[start:start + SCORE_BATCH_SIZE]
+        assignments[start:start + SCORE_BATCH_SIZE] = np.argmin(centroid_norms - 2 * batch @ centroids.T, axis=1)
+
+    return assignments
+
+
+class ScalarQuantizer:
+    # Each dimension is mapped linearly from its trained range onto the 256 values of a byte
+    method = 'int8'
+
+    def __init__(self, low: np.ndarray, scale: np.ndarray):
+        self.low = low.astype(np.float32)
+        self.scale = scale.astype(np.float32)
+
+    @staticmethod
+    def train(vectors: np.ndarray) -> 'ScalarQuantizer':
+        low = vectors.min(axis=0)
+        high = vectors.max(axis=0)
+        return ScalarQuantizer(low, np.maximum(high - low, 1e-12) / (NUM_CENTROIDS - 1))
+
+    @property
+    def nbytes(self) -> int:
+        return self.low.nbytes + self.scale.nbytes
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.rint((normalize(vectors) - self.low) / self.scale)
+        return np.clip(codes, 0, NUM_CENTROIDS - 1).astype(np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) * self.scale + self.low
+
+    def similarities(self, query: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        # q.x = sum_d q_d * (low_d + scale_d * code_d), so the query is scaled once instead of decoding every code
+        weights = query * self.scale
+        offset = float(query @ self.low)
+        return np.concatenate([codes[start:start + SCORE_BATCH_SIZE].astype(np.float32) @ weights + offset
+                               for start in range(0, len(codes), SCORE_BATCH_SIZE)] or [np.zeros(0, np.float32)])
+
+    def save(self, path: str):
+        np.savez(path, method=self.method, low=self.low, scale=self.scale)
+
+
+class ProductQuantizer:
+    method = 'pq'
+
+    def __init__(self, centroids: np.ndarray):
+        # (subspaces, centroids, subspace dimensions)
+        self.centroids = centroids.astype(np.float32)
+
+    @staticmethod
+    def train(vectors: np.ndarray, num_subspaces: int = DEFAULT_NUM_SUBSPACES, iterations: int = KMEANS_ITERATIONS,
+              seed: int = 0) -> 'ProductQuantizer':
+        if vectors.shape[1] % num_subspaces != 0:
+            raise ValueError('{} dimensions can\'t be split into {} subspaces'.format(vectors.shape[1], num_subspaces))
+
+        rng = np.random.RandomState(seed)
+        return ProductQuantizer(np.stack([kmeans(np.ascontiguousarray(sub), NUM_CENTROIDS, iterations, rng)
+                                          for sub in np.split(vectors, num_subspaces, axis=1)]))
+
+    @property
+    def num_subspaces(self) -> int:
+        return len(self.centroids)
+
+    @property
+    def nbytes(self) -> int:
+        return self.centroids.nbytes
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        # Codes are stored column-major, so the lookups of each subspace read contiguous memory
+        subspaces = np.split(normalize(vectors), self.num_subspaces, axis=1)
+        return np.asfortranarray(np.stack([nearest_centroids(np.ascontiguousarray(sub), centroids)
+                                           for sub, centroids in zip(subspaces, self.centroids)], axis=1), np.uint8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return np.concatenate([self.centroids[m][codes[:, m]] for m in range(self.num_subspaces)], axis=1)
+
+    def similarities(self, query: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        # tables[m, c] is the dot product of the query's subspace m with centroid c of that subspace
+        tables = np.einsum('mcd,md->mc', self.centroids, query.reshape(self.num_subspaces, -1))
+        similarities = np.zeros(len(codes), dtype=np.float32)
+        for m in range(self.num_subspaces):
+            similarities += tables[m].take(codes[:, m])
+
+        return similarities
+
+    def save(self, path: str):
+        np.savez(path, method=self.method, centroids=self.centroids)
+
+
+Quantizer = Union[ScalarQuantizer, ProductQuantizer]
+
+
+def train_quantizer(vectors: np.ndarray, method: str, num_subspaces: int = DEFAULT_NUM_SUBSPACES,
+                    train_size: int = TRAIN_SIZE, seed: int = 0) -> Quantizer:
+    sample = training_sample(vectors, train_size, seed)
+    if method == 'int8':
+        return ScalarQuantizer.train(sample)
+    if method == 'pq':
+        return ProductQuantizer.train(sample, num_subspaces, seed=seed)
+
+    raise ValueError('Unknown quantization method {}'.format(method))
+
+
+def load_quantizer(path: str) -> Quantizer:
+    with np.load(path) as data:
+        method = str(data['method'])
+        if method == 'int8':
+            return ScalarQuantizer(data['low'], data['scale'])
+        if method == 'pq':
+            return ProductQuantizer(data['centroids'])
+
+    raise ValueError('Unknown quantization method {} in {}'.format(method, path))
+
+
+class QuantizedIndex:
+    # Answers get_nns_by_vector like an angular Annoy index over positions 0..n-1, so it can be used as a partition of
+    # a PartitionedIndex
+    def __init__(self, quantizer: Quantizer, codes: np.ndarray, vectors: Optional[np.ndarray] = None,
+                 rerank: int = DEFAULT_RERANK):
+        self.quantizer = quantizer
+        self.codes = codes
+        self.vectors = vectors
+        self.rerank = rerank if vectors is not None else 0
+
+    @property
+    def nbytes(self) -> int:
+        # Full-precision vectors are only paged in for re-ranked rows, so they aren't counted
+        return self.codes.nbytes + self.quantizer.nbytes
+
+    def get_n_items(self) -> int:
+        return len(self.codes)
+
+    def get_nns_by_vector(self, vector, n: int, search_k: int = -1, include_distances: bool = False):
+        # Imported here since similarity imports this module
+        from similarity import angular_distance
+
+        # search_k is accepted for compatibility with Annoy; the number of re-ranked candidates sets the accuracy
+        query = normalize(vector)
+        similarities = self.quantizer.similarities(query, self.codes)
+
+        candidates = top_rows(similarities, max(n, self.rerank))
+        if self.rerank > 0:
+            # Sorted rows read the memory-mapped vectors in file order
+            candidates = np.sort(candidates)
+            similarities = self.vectors[candidates] @ query
+        else:
+            similarities = similarities[candidates]
+
+        order = np.argsort(-similarities, kind='stable')[:n]
+        if not include_distances:
+            return candidates[order].tolist()
+
+        return candidates[order].tolist(), angular_distance(similarities[order]).tolist()
+
+
+def top_rows(similarities: np.ndarray, n: int) -> np.ndarray:
+    if n >= len(similarities):
+        return np.arange(len(similarities))
+
+    return np.argpartition(-similarities, n - 1)[:n]
+
+
+def reconstruction_error(quantizer: Quantizer, vectors: np.ndarray) -> Tuple[float, float]:
+    # Mean squared error and mean cosine between normalized vectors and their decoded codes
+    vectors = normalize(vectors)
+    decoded = quantizer.decode(quantizer.encode(vectors))
+    cosines = (vectors * normalize(decoded)).sum(axis=1)
+    return float(((vectors - decoded) ** 2).sum(axis=1).mean()), float(cosines.mean())
+
@@ -1,27 +1,88 @@
+import fcntl
+import itertools
 import json
+import multiprocessing
 import os
+import shutil
 import time
-from typing import Tuple, List, Dict
+from typing import Tuple, List, Dict, Callable, Iterable, Iterator, Union, Optional, NamedTuple
 
+import numpy as np
 from annoy import AnnoyIndex
 from annoy.annoylib import Annoy
+from sqlalchemy import Table, inspect, bindparam
 from sqlalchemy.orm import Session, defer
+from sqlalchemy.schema import CreateColumn
 
-from tables import FashionItem
+import metrics
+import quantized
+from cache import LRUCache, DiskCache
+from catalog import Catalog, CatalogItem, catalog_exists, compile_catalog
+from tables import FashionItem, IngestState, pack_embedding, merge_category
 
 NUM_MASKS = 4
 EMBEDDING_SIZE = 64
 DISTANCE_FUNCTION = 'angular'
 NUM_TREES = 10
 
+# Indexes are built in parallel processes, each of which uses Annoy's own build threads where supported
+INDEX_BUILD_PROCESSES = NUM_MASKS + 1
+INDEX_BUILD_THREADS = -1
+
+# Map index files with MAP_POPULATE so the first queries of every worker don't stall on page faults
+INDEX_PREFAULT = True
+WARMUP_READ_SIZE = 16 * 1024 * 1024
+
+# Annoy's default search_k (n * trees) is far too small for the few results requested per category
+CATEGORY_SEARCH_K = NUM_TREES * 100
+
+# Item sets smaller than this are searched exactly with NumPy instead of building Annoy trees
+EXACT_SEARCH_THRESHOLD = 5000
+
+# New catalog items are searched exactly until this many have accumulated, then folded into rebuilt primary indexes
+DELTA_COMPACTION_THRESHOLD = 2000
+DELTA_REFRESH_SECONDS = 60
+
 IMAGES_DIR = 'static/images'
 EMBEDDINGS_DIR = 'data/embeddings'
 INDEXES_DIR = 'data/annoy_indexes'
+CATEGORY_INDEXES_DIR = os.path.join(INDEXES_DIR, 'categories')
+GENERATION_FILE_PATH = os.path.join(INDEXES_DIR, 'generation')
+BUILD_DIR = os.path.join(INDEXES_DIR, 'build')
+BUILD_REPORT_FILE_PATH = os.path.join(INDEXES_DIR, 'build_report.json')
+EMBEDDINGS_FILE_PATH = os.path.join(INDEXES_DIR, 'embeddings.npy')
+COMPACTION_LOCK_FILE_PATH = os.path.join(INDEXES_DIR, 'compaction.lock')
 ANNOY_EXT = '.ann'
+IDS_EXT = '.npy'
+CODES_EXT = '.codes.npy'
+VECTORS_EXT = '.vectors.npy'
+QUANTIZER_EXT = '.quantizer.npz'
 IMAGE_EXT = '.jpg'
 
+MIGRATION_BATCH_SIZE = 5000
+INGEST_BATCH_SIZE = 2000
+
+WARDROBE_CACHE_MAX_ENTRIES = 1024
+WARDROBE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Normalized embeddings of every mask by item id, used to re-score candidates. Half precision halves the file and
+# changes cosine similarities by less than 1e-3.
+EMBEDDING_STORE_DTYPE = np.float16
+
+# Neighbours per category re-ranked for diversity, as a multiple of the results requested
+MMR_POOL_FACTOR = 5
+MMR_MIN_POOL_SIZE = 10
+
+# Candidates gathered from each index of a fused query, per category for partitioned indexes
+FUSED_CANDIDATES_PER_CATEGORY = 20
+FUSED_NUM_NEIGHBORS = 200
+
+RESULT_CACHE_MAX_ENTRIES = 100000
+RESULT_CACHE_TTL_SECONDS = 3600
+
 ITEM_METADATA_FILE_PATH = 'data/item_metadata.json'
 CATEGORIES_FILE_PATH = 'data/categories.csv'
+CATALOG_DIR = 'data/catalog'
 
 MERGED_CATEGORIES = [
     'hats',
@@ -42,8 +103,10 @@ MERGED_CATEGORIES_DISPLAY = [
     'Accessories'
 ]
 
-def load_all_items(session: Session):
-    print('Loading all items.')
+Item = Union[FashionItem, CatalogItem]
+
+
+def read_item_categories() -> Dict[str, Tuple[str, str]]:
     categories: Dict[int, str] = {}
 
     with open(CATEGORIES_FILE_PATH) as categories_file:
@@ -53,7 +116,7 @@ def load_all_items(session: Session):
 
             categories[cat_id] = name
 
-    items: Dict[str, Tuple[str, str, List[str]]] = {}
+    item_categories: Dict[str, Tuple[str, str]] = {}
 
     with open(ITEM_METADATA_FILE_PATH) as metadata_file:
         metadata_json: Dict = json.load(metadata_file)
@@ -62,57 +125,287 @@ def load_all_items(session: Session):
             cat = categories[int(item_json['category_id'])]
             semantic_cat = item_json['semantic_category']
 
-            items[item_name] = (cat, semantic_cat, [])
+            item_categories[item_name] = (cat, semantic_cat)
 
-    embeddings_paths = ['full_embeddings.csv'] + ['mask_{}_embeddings.csv'.format(i + 1) for i in range(NUM_MASKS)]
-    embeddings_paths = [os.path.join(EMBEDDINGS_DIR, p) for p in embeddings_paths]
+    return item_categories
+
+
+def merge_embedding_files(paths: List[str]) -> Iterator[Tuple[str, List[str]]]:
+    # Reads the embedding files in lockstep and yields each item once it has been seen in all of them. When the files
+    # list items in the same order, only a line per file is held in memory at a time.
+    files = [open(p) for p in paths]
+    pending: List[Dict[str, str]] = [{} for _ in paths]
+
+    try:
+        for lines in itertools.zip_longest(*files):
+            names = []
+            for file_pending, line in zip(pending, lines):
+                if line is None:
+                    continue
 
-    for em_path in embeddings_paths:
-        with open(em_path) as embeddings_file:
-            for line in embeddings_file:
                 sp = line.strip('\n').split(', ')
                 n = sp[0].strip(IMAGE_EXT)
-                v = ','.join(sp[1:])
-
-                try:
-                    items[n][2].append(v)
-                except KeyError:
-                    pass
-
-    print('Creating ORM objects.')
-    db_items = []
-    for name, (cat, semantic_cat, embeddings) in items.items():
-        db_items.append(FashionItem(
-            name=name,
-            category=cat,
-            semantic_category=semantic_cat,
-            full_embedding=embeddings[0],
-            mask_1_embedding=embeddings[1],
-            mask_2_embedding=embeddings[2],
-            mask_3_embedding=embeddings[3],
-            mask_4_embedding=embeddings[4]
-        ))
-
-    print('Inserting items.')
+                file_pending[n] = ','.join(sp[1:])
+                names.append(n)
+
+            for n in names:
+                if all(n in file_pending for file_pending in pending):
+                    yield n, [file_pending.pop(n) for file_pending in pending]
+    finally:
+        for f in files:
+            f.close()
+
+
+def load_all_items(session: Session, batch_size: int = INGEST_BATCH_SIZE):
+    # Items are inserted in a deterministic order and committed per batch, so the number of rows already in the table
+    # is exactly the number of merged items to skip when resuming
+    table = FashionItem.__table__
+    num_committed = session.execute(table.count()).scalar()
+
+    # A finished ingest only counts while the table still holds its items, which a truncated or recreated table doesn't.
+    # Items added to the catalog after the ingest only add to the count.
+    state = session.query(IngestState).first()
+    if state is not None and num_committed >= state.num_items:
+        print('All items already loaded.')
+        return
+
+    if num_committed > 0:
+        print('Resuming after {} loaded items.'.format(num_committed))
+    else:
+        print('Loading all items.')
+
+    item_categories = read_item_categories()
+
+    embeddings_paths = ['full_embeddings.csv'] + ['mask_{}_embeddings.csv'.format(i + 1) for i in range(NUM_MASKS)]
+    embeddings_paths = [os.path.join(EMBEDDINGS_DIR, p) for p in embeddings_paths]
+
+    insert = table.insert()
+    packed_columns = ['full_embedding_packed'] + ['mask_{}_embedding_packed'.format(i + 1) for i in range(NUM_MASKS)]
+
+    num_merged = 0
+    num_inserted = 0
+    rows = []
     start_time = time.time()
-    session.bulk_save_objects(db_items)
+
+    def insert_rows():
+        nonlocal num_inserted
+
+        batch_start_time = time.time()
+        session.execute(insert, rows)
+        session.commit()
+        num_inserted += len(rows)
+
+        print('Inserted {} items ({:.0f} rows/s, {:.0f} rows/s overall)'.format(
+            num_committed + num_inserted,
+            len(rows) / max(time.time() - batch_start_time, 1e-6),
+            num_inserted / max(time.time() - start_time, 1e-6)))
+        rows.clear()
+
+    for name, embeddings in merge_embedding_files(embeddings_paths):
+        if name not in item_categories:
+            continue
+
+        num_merged += 1
+        if num_merged <= num_committed:
+            continue
+
+        cat, semantic_cat = item_categories[name]
+        row = {
+            'name': name,
+            'category': cat,
+            'semantic_category': semantic_cat
+        }
+        for column, em in zip(packed_columns, embeddings):
+            row[column] = pack_embedding(em)
+        rows.append(row)
+
+        if len(rows) >= batch_size:
+            insert_rows()
+
+    if len(rows) > 0:
+        insert_rows()
+
+    session.query(IngestState).delete()
+    session.add(IngestState(num_items=num_committed + num_inserted))
     session.commit()
+
     print('Finished inserting items (took {:.2f}s)'.format(time.time() - start_time))
 
 
-def create_indexes(items: List[FashionItem]):
+def add_missing_columns(session: Session, table: Table):
+    # db.create_all() does not alter existing tables, so tables created before a column existed need it added here
+    engine = session.get_bind()
+    existing_columns = {c['name'] for c in inspect(engine).get_columns(table.name)}
+    for c in table.columns:
+        if c.name not in existing_columns:
+            print('Adding column {}.'.format(c.name))
+            session.execute('ALTER TABLE {} ADD COLUMN {}'.format(
+                table.name, CreateColumn(c).compile(dialect=engine.dialect)))
+    session.commit()
+
+
+def relax_not_null_columns(session: Session, table: Table):
+    # Columns that became nullable, like the legacy embeddings that new rows no longer write, stay NOT NULL in tables
+    # created before, which rejects inserts without them
+    engine = session.get_bind()
+    existing_columns = {c['name']: c for c in inspect(engine).get_columns(table.name)}
+    for c in table.columns:
+        if not c.nullable or c.name not in existing_columns or existing_columns[c.name]['nullable']:
+            continue
+
+        print('Making column {} nullable.'.format(c.name))
+        if engine.dialect.name == 'mysql':
+            session.execute('ALTER TABLE {} MODIFY {}'.format(
+                table.name, CreateColumn(c).compile(dialect=engine.dialect)))
+        elif engine.dialect.name == 'postgresql':
+            session.execute('ALTER TABLE {} ALTER COLUMN {} DROP NOT NULL'.format(table.name, c.name))
+        else:
+            raise RuntimeError('Column {}.{} has to be made nullable, which {} tables only allow by recreating them.'
+                               .format(table.name, c.name, engine.dialect.name))
+    session.commit()
+
+
+def migrate_packed_embeddings(session: Session, batch_size: int = MIGRATION_BATCH_SIZE):
+    table = FashionItem.__table__
+    text_columns = [table.c.full_embedding] + [table.c['mask_{}_embedding'.format(i + 1)] for i in range(NUM_MASKS)]
+    packed_columns = [table.c[c.name + '_packed'] for c in text_columns]
+
+    add_missing_columns(session, table)
+    relax_not_null_columns(session, table)
+
+    update = table.update()\
+        .where(table.c.id == bindparam('_id'))\
+        .values({c.name: bindparam(c.name) for c in packed_columns})
+
+    num_migrated = 0
+    start_time = time.time()
+    while True:
+        rows = session.execute(
+            table.select()
+                .with_only_columns([table.c.id] + text_columns)
+                .where(table.c.full_embedding_packed.is_(None))
+                .order_by(table.c.id)
+                .limit(batch_size)
+        ).fetchall()
+        if len(rows) == 0:
+            break
+
+        session.execute(update, [
+            dict(_id=row[0], **{c.name: pack_embedding(em) for c, em in zip(packed_columns, row[1:])})
+            for row in rows
+        ])
+        session.commit()
+
+        num_migrated += len(rows)
+        print('Packed embeddings for {} items.'.format(num_migrated))
+
+    if num_migrated > 0:
+        print('Finished packing embeddings (took {:.2f}s)'.format(time.time() - start_time))
+
+
+def angular_distance(cosines: np.ndarray) -> np.ndarray:
+    # Same distance Annoy reports for angular indexes, clipped since rounding can push cosines of unit vectors above 1
+    return np.sqrt(np.maximum(2 - 2 * cosines, 0))
+
+
+class ExactIndex:
+    def __init__(self, ids: np.ndarray, vectors: np.ndarray, mask: int, categories: Optional[np.ndarray] = None):
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+
+        self.ids = ids.astype(np.int64)
+        self.vectors = (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+        self.mask = mask
+        self.categories = categories
+        self.rows: Dict[int, int] = {item_id: row for row, item_id in enumerate(self.ids.tolist())}
+
+    def __contains__(self, item_id: int) -> bool:
+        return item_id in self.rows
+
+    @property
+    def nbytes(self) -> int:
+        return self.ids.nbytes + self.vectors.nbytes
+
+    def get_n_items(self) -> int:
+        return len(self.ids)
+
+    def get_item_vector(self, item_id: int) -> List[float]:
+        return self.vectors[self.rows[item_id]].tolist()
+
+    def get_nns_by_item(self, item_id: int, n: int, search_k: int = -1, include_distances: bool = False):
+        return self._search(self.vectors[self.rows[item_id]], n, include_distances)
+
+    def get_nns_by_vector(self, vector, n: int, search_k: int = -1, include_distances: bool = False):
+        return self._search(self._normalize(vector), n, include_distances)
+
+    def get_nns_by_vector_in_category(self, category: str, vector, n: int) -> Tuple[List[int], List[float]]:
+        rows = np.flatnonzero(self.categories == category)
+        return self._search(self._normalize(vector), n, True, rows)
+
+    def merged(self, other: 'ExactIndex') -> 'ExactIndex':
+        categories = None
+        if self.categories is not None and other.categories is not None:
+            categories = np.concatenate([self.categories, other.categories])
+
+        return ExactIndex(np.concatenate([self.ids, other.ids]), np.concatenate([self.vectors, other.vectors]),
+                          self.mask, categories)
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _search(self, vector: np.ndarray, n: int, include_distances: bool, rows: np.ndarray = None):
+        if rows is None:
+            similarities = self.vectors @ vector
+        else:
+            similarities = self.vectors[rows] @ vector
+        n = min(n, len(similarities))
+
+        if n < len(similarities):
+            top = np.argpartition(-similarities, n - 1)[:n]
+        else:
+            top = np.arange(len(similarities))
+        top = top[np.argsort(-similarities[top], kind='stable')]
+
+        ids = self.ids[top if rows is None else rows[top]].tolist()
+        if not include_distances:
+            return ids
+
+        distances = angular_distance(similarities[top]).tolist()
+        return ids, distances
+
+
+Index = Union[Annoy, ExactIndex]
+
+
+def create_exact_indexes(items: List[FashionItem]) -> List[ExactIndex]:
+    ids = np.array([item.id for item in items], dtype=np.int64)
+    categories = np.array([item.merged_category() for item in items], dtype=object)
+    embeddings = [item.embeddings() for item in items]
+
+    indexes = []
+    for mask in range(NUM_MASKS + 1):
+        if len(embeddings) > 0:
+            vectors = np.stack([em[mask] for em in embeddings])
+        else:
+            vectors = np.zeros((0, EMBEDDING_SIZE), dtype=np.float32)
+        indexes.append(ExactIndex(ids, vectors, mask, categories))
+
+    return indexes
+
+
+def create_indexes(items: List[FashionItem]) -> List[Index]:
+    if len(items) < EXACT_SEARCH_THRESHOLD:
+        return create_exact_indexes(items)
+
+    return create_annoy_indexes(items)
+
+
+def create_annoy_indexes(items: List[FashionItem]) -> List[Annoy]:
     indexes: List[Annoy] = [Annoy(EMBEDDING_SIZE, DISTANCE_FUNCTION) for i in range(NUM_MASKS + 1)]
 
     for item in items:
-        em_l = [
-            item.full_embedding,
-            item.mask_1_embedding,
-            item.mask_2_embedding,
-            item.mask_3_embedding,
-            item.mask_4_embedding
-        ]
-        for ind, em in zip(indexes, em_l):
-            vec = [float(v) for v in em.split(',')]
+        for ind, vec in zip(indexes, item.embeddings()):
             ind.add_item(item.id, vec)
 
     for ind in indexes:
@@ -121,35 +414,554 @@ def create_indexes(items: List[FashionItem]):
     return indexes
 
 
+def estimate_index_bytes(indexes: List[Index]) -> int:
+    num_bytes = 0
+    for ind in indexes:
+        if isinstance(ind, ExactIndex):
+            num_bytes += ind.nbytes
+        else:
+            # Annoy stores a (12 + 4 * f)-byte node per item plus roughly as many split nodes for the trees
+            num_bytes += ind.get_n_items() * (12 + 4 * EMBEDDING_SIZE) * 2
+
+    return num_bytes
+
+
+WARDROBE_INDEX_CACHE = LRUCache(WARDROBE_CACHE_MAX_ENTRIES, WARDROBE_CACHE_MAX_BYTES)
+
+
+def wardrobe_version(item_ids: Iterable[int]) -> int:
+    return hash(frozenset(item_ids))
+
+
+def cached_wardrobe_indexes(user_id: int, item_ids: List[int]) -> Optional[List[Index]]:
+    return WARDROBE_INDEX_CACHE.get((user_id, wardrobe_version(item_ids)))
+
+
+def cache_wardrobe_indexes(user_id: int, item_ids: List[int], items: List[FashionItem]) -> List[Index]:
+    indexes = create_indexes(items)
+
+    invalidate_wardrobe_indexes(user_id)
+    WARDROBE_INDEX_CACHE.put((user_id, wardrobe_version(item_ids)), indexes, estimate_index_bytes(indexes))
+    return indexes
+
+
+def get_wardrobe_indexes(user_id: int, item_ids: List[int],
+                         load_items: Callable[[], List[FashionItem]]) -> List[Index]:
+    indexes = cached_wardrobe_indexes(user_id, item_ids)
+    if indexes is None:
+        indexes = cache_wardrobe_indexes(user_id, item_ids, load_items())
+
+    return indexes
+
+
+def invalidate_wardrobe_indexes(user_id: int):
+    WARDROBE_INDEX_CACHE.remove_where(lambda key: key[0] == user_id)
+
+
+class PartitionedIndex:
+    # One Annoy or quantized index per merged category. Each partition numbers its items 0..n-1 and maps them back to
+    # item ids with an id array, since Annoy allocates storage for every id up to the largest one it contains.
+    # Items added after the partitions were built are kept in an exact delta index and merged into the results.
+    def __init__(self, mask: int, partitions: Dict[str, Tuple[Union[Annoy, quantized.QuantizedIndex], np.ndarray]],
+                 search_k: int = -1,
+                 delta: Optional[ExactIndex] = None):
+        self.mask = mask
+        self.partitions = partitions
+        self.search_k = search_k
+        self.delta = delta
+
+    def get_nns_by_vector(self, category: str, vector, n: int) -> Tuple[List[int], List[float]]:
+        ids, distances = [], []
+        if category in self.partitions:
+            index, partition_ids = self.partitions[category]
+            positions, distances = index.get_nns_by_vector(vector, n, search_k=self.search_k, include_distances=True)
+            ids = partition_ids[positions].tolist()
+
+        return self.merge_delta(category, vector, n, ids, distances)
+
+    def merge_delta(self, category: str, vector, n: int, ids: List[int],
+                    distances: List[float]) -> Tuple[List[int], List[float]]:
+        delta = self.delta
+        if delta is None or delta.get_n_items() == 0:
+            return ids, distances
+
+        delta_ids, delta_distances = delta.get_nns_by_vector_in_category(category, vector, n)
+        results = sorted(zip(ids + delta_ids, distances + delta_distances), key=lambda r: r[1])[0:n]
+        return [r[0] for r in results], [r[1] for r in results]
+
+
+INDEX_NAMES = ['full_index'] + ['mask_{}_index'.format(i + 1) for i in range(NUM_MASKS)]
+
+
+class IndexConfig(NamedTuple):
+    num_trees: int = NUM_TREES
+    search_k: int = -1
+    # Build straight into the index file instead of in memory, for builds larger than the available RAM
+    on_disk_build: bool = False
+
+
+# Keyed by index name. Category indexes are configured per mask, and share the config across categories.
+INDEX_CONFIGS: Dict[str, IndexConfig] = {name: IndexConfig() for name in INDEX_NAMES}
+CATEGORY_INDEX_CONFIGS: Dict[str, IndexConfig] = {name: IndexConfig(search_k=CATEGORY_SEARCH_K) for name in INDEX_NAMES}
+
+
+class QuantizationConfig(NamedTuple):
+    # 'int8' or 'pq' to store the category partitions as quantized codes instead of Annoy trees
+    method: Optional[str] = None
+    num_subspaces: int = quantized.DEFAULT_NUM_SUBSPACES
+    # Candidates re-ranked with full-precision vectors, 0 to rank by the codes alone
+    rerank: int = quantized.DEFAULT_RERANK
+    train_size: int = quantized.TRAIN_SIZE
+
+
+QUANTIZATION_CONFIG = QuantizationConfig()
+
+
+def configure_indexes(config_json: Dict):
+    # Overrides from the 'indexes' section of config.json, e.g. {"full_index": {"num_trees": 20}}
+    global QUANTIZATION_CONFIG
+
+    for configs, section in ((INDEX_CONFIGS, config_json.get('primary', {})),
+                             (CATEGORY_INDEX_CONFIGS, config_json.get('category', {}))):
+        for name, overrides in section.items():
+            configs[name] = configs[name]._replace(**overrides)
+
+    QUANTIZATION_CONFIG = QUANTIZATION_CONFIG._replace(**config_json.get('quantization', {}))
+    if QUANTIZATION_CONFIG.method not in [None] + quantized.QUANTIZATION_METHODS:
+        raise ValueError('Unknown quantization method {}'.format(QUANTIZATION_CONFIG.method))
+
+
 PRIMARY_INDEXES: List[Annoy] = []
+PRIMARY_CATEGORY_INDEXES: List[PartitionedIndex] = []
+# (item ids, masks, dimensions), memory-mapped
+EMBEDDING_STORE: Optional[np.ndarray] = None
+
+# Incremented every time the primary indexes are rebuilt, so other processes know to reload them
+INDEX_GENERATION = 0
+
+# Files that are memory-mapped by the loaded indexes
+MAPPED_FILES: List[str] = []
+
+
+def primary_index_path(mask: int) -> str:
+    return os.path.join(INDEXES_DIR, INDEX_NAMES[mask] + ANNOY_EXT)
+
+
+def category_index_path(mask: int, cat: str, ext: str) -> str:
+    return os.path.join(CATEGORY_INDEXES_DIR, '{}_{}{}'.format(INDEX_NAMES[mask], cat, ext))
+
+
+def quantizer_path(mask: int) -> str:
+    return os.path.join(CATEGORY_INDEXES_DIR, INDEX_NAMES[mask] + QUANTIZER_EXT)
+
+
+def category_index_exts() -> List[str]:
+    if QUANTIZATION_CONFIG.method is not None:
+        return [CODES_EXT, VECTORS_EXT, IDS_EXT]
+
+    return [ANNOY_EXT, IDS_EXT]
+
+
+def load_annoy_index(path: str) -> Annoy:
+    ind = AnnoyIndex(EMBEDDING_SIZE, DISTANCE_FUNCTION)
+    ind.load(path, prefault=INDEX_PREFAULT)
+    MAPPED_FILES.append(path)
+    return ind
+
+
+def save_array(array: np.ndarray, path: str):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as array_file:
+        np.save(array_file, array)
+    os.replace(tmp_path, path)
+
+
+def load_array(path: str) -> np.ndarray:
+    array = np.load(path, mmap_mode='r')
+    MAPPED_FILES.append(path)
+    return array
+
+
+def read_index_generation() -> int:
+    if not os.path.exists(GENERATION_FILE_PATH):
+        return 0
+
+    with open(GENERATION_FILE_PATH) as generation_file:
+        return int(generation_file.read().strip() or 0)
+
+
+class IndexBuildTask(NamedTuple):
+    name: str
+    path: str
+    mask: int
+    category: Optional[str]
+    config: IndexConfig
+    quantization: Optional[QuantizationConfig] = None
+
+
+class IndexBuildReport(NamedTuple):
+    name: str
+    num_items: int
+    num_trees: int
+    build_seconds: float
+    file_bytes: int
+
+
+def build_matrix_path(name: str) -> str:
+    return os.path.join(BUILD_DIR, name + IDS_EXT)
+
+
+def build_annoy(ind: Annoy, num_trees: int):
+    try:
+        # Multi-threaded builds are only available in newer versions of Annoy
+        ind.build(num_trees, n_jobs=INDEX_BUILD_THREADS)
+    except TypeError:
+        ind.build(num_trees)
+
+
+def build_index(task: IndexBuildTask) -> IndexBuildReport:
+    start_time = time.time()
+
+    vectors = np.load(build_matrix_path('mask_{}'.format(task.mask)), mmap_mode='r')
+    if task.category is None:
+        rows = np.arange(len(vectors))
+        annoy_ids = np.load(build_matrix_path('ids'), mmap_mode='r')
+    else:
+        categories = np.load(build_matrix_path('categories'), mmap_mode='r')
+        rows = np.flatnonzero(categories == MERGED_CATEGORIES.index(task.category))
+        annoy_ids = np.arange(len(rows))
+
+        ids = np.load(build_matrix_path('ids'), mmap_mode='r')
+        save_array(np.array(ids[rows]), category_index_path(task.mask, task.category, IDS_EXT))
+
+        if task.quantization is not None:
+            return build_quantized_index(task, vectors, rows, start_time)
+
+    # Written under a temporary name and moved into place, so processes that have the old file mapped keep a valid
+    # mapping of the old contents
+    tmp_path = task.path + '.tmp'
+    ind = Annoy(EMBEDDING_SIZE, DISTANCE_FUNCTION)
+    if task.config.on_disk_build:
+        ind.on_disk_build(tmp_path)
+
+    for annoy_id, row in zip(annoy_ids.tolist(), rows.tolist()):
+        ind.add_item(annoy_id, vectors[row])
+    build_annoy(ind, task.config.num_trees)
+
+    if not task.config.on_disk_build:
+        ind.save(tmp_path)
+    ind.unload()
+    os.replace(tmp_path, task.path)
+
+    return IndexBuildReport(
+        name=os.path.splitext(os.path.basename(task.path))[0],
+        num_items=len(rows),
+        num_trees=task.config.num_trees,
+        build_seconds=time.time() - start_time,
+        file_bytes=os.path.getsize(task.path)
+    )
+
+
+def train_quantizer(task: Tuple[int, QuantizationConfig]) -> float:
+    start_time = time.time()
+    mask, config = task
+
+    vectors = np.load(build_matrix_path('mask_{}'.format(mask)), mmap_mode='r')
+    quantizer = quantized.train_quantizer(vectors, config.method, config.num_subspaces, config.train_size)
+
+    tmp_path = quantizer_path(mask) + '.tmp'
+    with open(tmp_path, 'wb') as quantizer_file:
+        quantizer.save(quantizer_file)
+    os.replace(tmp_path, quantizer_path(mask))
+
+    return time.time() - start_time
+
+
+def build_quantized_index(task: IndexBuildTask, vectors: np.ndarray, rows: np.ndarray,
+                          start_time: float) -> IndexBuildReport:
+    quantizer = quantized.load_quantizer(quantizer_path(task.mask))
+    codes_path = category_index_path(task.mask, task.category, CODES_EXT)
+
+    # Normalized full-precision vectors are kept on disk for re-ranking
+    normalized = quantized.normalize(vectors[rows])
+    save_array(normalized, category_index_path(task.mask, task.category, VECTORS_EXT))
+    save_array(quantizer.encode(normalized), codes_path)
+
+    return IndexBuildReport(
+        name=os.path.splitext(os.path.basename(task.path))[0] + '_' + quantizer.method,
+        num_items=len(rows),
+        num_trees=0,
+        build_seconds=time.time() - start_time,
+        file_bytes=os.path.getsize(codes_path)
+    )
+
+
+def build_embedding_store(num_ids: int):
+    # Filled from the build matrices, one mask at a time
+    ids = np.load(build_matrix_path('ids'), mmap_mode='r')
+    tmp_path = EMBEDDINGS_FILE_PATH + '.tmp'
+    store = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=EMBEDDING_STORE_DTYPE,
+                                      shape=(num_ids, NUM_MASKS + 1, EMBEDDING_SIZE))
+    for mask in range(NUM_MASKS + 1):
+        store[ids, mask] = quantized.normalize(np.load(build_matrix_path('mask_{}'.format(mask)), mmap_mode='r'))
+
+    store.flush()
+    del store
+    os.replace(tmp_path, EMBEDDINGS_FILE_PATH)
+
+
+def map_tasks(fn: Callable, tasks: List, processes: int) -> List:
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            return pool.map(fn, tasks)
+
+    return [fn(task) for task in tasks]
+
+
+def build_indexes(items: List[FashionItem], processes: int = INDEX_BUILD_PROCESSES) -> List[IndexBuildReport]:
+    print('Creating primary and category indexes.')
+    start_time = time.time()
+
+    # Build processes read the vectors from memory-mapped files instead of receiving them pickled
+    if not os.path.exists(BUILD_DIR):
+        os.mkdir(BUILD_DIR)
+
+    embeddings = [item.embeddings() for item in items]
+    for mask in range(NUM_MASKS + 1):
+        vectors = np.stack([em[mask] for em in embeddings]) if len(embeddings) > 0 \
+            else np.zeros((0, EMBEDDING_SIZE), dtype=np.float32)
+        np.save(build_matrix_path('mask_{}'.format(mask)), vectors)
+    del embeddings
+
+    np.save(build_matrix_path('ids'), np.array([item.id for item in items], dtype=np.int64))
+    np.save(build_matrix_path('categories'), np.array(
+        [MERGED_CATEGORIES.index(item.merged_category()) for item in items], dtype=np.int16))
+
+    tasks = [IndexBuildTask(name, primary_index_path(mask), mask, None, INDEX_CONFIGS[name])
+             for mask, name in enumerate(INDEX_NAMES)]
+    quantization = QUANTIZATION_CONFIG if QUANTIZATION_CONFIG.method is not None else None
+    tasks += [IndexBuildTask(name, category_index_path(mask, cat, ANNOY_EXT), mask, cat, CATEGORY_INDEX_CONFIGS[name],
+                             quantization)
+              for mask, name in enumerate(INDEX_NAMES) for cat in MERGED_CATEGORIES]
+
+    try:
+        # Quantizers are trained on all items of a mask before its partitions are encoded
+        if quantization is not None:
+            train_seconds = map_tasks(train_quantizer, [(mask, quantization) for mask in range(NUM_MASKS + 1)],
+                                      processes)
+            print('Trained {} quantizers (took {:.2f}s)'.format(quantization.method, max(train_seconds)))
+
+        reports = map_tasks(build_index, tasks, processes)
+        build_embedding_store(max([item.id + 1 for item in items] + [0]))
+    finally:
+        shutil.rmtree(BUILD_DIR)
+
+    with open(BUILD_REPORT_FILE_PATH, 'w') as report_file:
+        json.dump({
+            'build_seconds': time.time() - start_time,
+            'processes': processes,
+            'indexes': [r._asdict() for r in reports]
+        }, report_file, indent=2)
+
+    for r in reports:
+        print('{:<40} {:>8} items {:>4} trees {:>8.2f}s {:>10.1f} MB'.format(
+            r.name, r.num_items, r.num_trees, r.build_seconds, r.file_bytes / (1024 * 1024)))
+    print('Saved indexes (took {:.2f}s)'.format(time.time() - start_time))
+
+    return reports
 
 
 def load_primary_indexes(session: Session):
-    if not os.path.exists(INDEXES_DIR):
-        os.mkdir(INDEXES_DIR)
+    for d in (INDEXES_DIR, CATEGORY_INDEXES_DIR):
+        if not os.path.exists(d):
+            os.mkdir(d)
 
     global PRIMARY_INDEXES
-    save_names = ['full_index'] + ['mask_{}_index'.format(i + 1) for i in range(NUM_MASKS)]
-    save_paths = [os.path.join(INDEXES_DIR, n + ANNOY_EXT) for n in save_names]
-
-    if False not in [os.path.exists(p) for p in save_paths]:
-        print('Loading primary indexes.')
-        PRIMARY_INDEXES = [AnnoyIndex(EMBEDDING_SIZE, DISTANCE_FUNCTION) for i in range(NUM_MASKS + 1)]
-        for ind, p in zip(PRIMARY_INDEXES, save_paths):
-            ind.load(p)
+    global PRIMARY_CATEGORY_INDEXES
+    global EMBEDDING_STORE
+    global INDEX_GENERATION
+    global MAPPED_FILES
+    items: List[FashionItem] = []
+
+    def load_items() -> List[FashionItem]:
+        if len(items) == 0:
+            items.extend(session.query(FashionItem).order_by(FashionItem.id).all())
+            print('Loaded items.')
+        return items
+
+    primary_paths = [primary_index_path(mask) for mask in range(NUM_MASKS + 1)]
+    category_paths = [category_index_path(mask, cat, ext) for mask in range(NUM_MASKS + 1)
+                      for cat in MERGED_CATEGORIES for ext in category_index_exts()]
+    if QUANTIZATION_CONFIG.method is not None:
+        category_paths += [quantizer_path(mask) for mask in range(NUM_MASKS + 1)]
+
+    if False in [os.path.exists(p) for p in primary_paths + category_paths + [EMBEDDINGS_FILE_PATH]]:
+        build_indexes(load_items())
+
+    generation = read_index_generation()
+    MAPPED_FILES = []
+
+    print('Loading primary indexes.')
+    primary_indexes = [load_annoy_index(p) for p in primary_paths]
+
+    print('Loading category indexes.')
+    category_indexes = load_category_indexes()
+
+    # Annoy sizes an index by its largest item id, so any item with a larger id was added after the build
+    delta_items = session.query(FashionItem)\
+        .filter(FashionItem.id >= primary_indexes[0].get_n_items())\
+        .order_by(FashionItem.id).all()
+    add_delta_items(category_indexes, delta_items)
+
+    PRIMARY_INDEXES = primary_indexes
+    PRIMARY_CATEGORY_INDEXES = category_indexes
+    EMBEDDING_STORE = load_array(EMBEDDINGS_FILE_PATH)
+    INDEX_GENERATION = generation
+
+    # Cached results are keyed by generation, but results of replaced indexes are never read again
+    RESULT_CACHE.clear()
+    if RESULT_DISK_CACHE is not None:
+        RESULT_DISK_CACHE.remove_other_versions(generation)
+
+
+def load_category_indexes() -> List[PartitionedIndex]:
+    category_indexes = []
+    for mask in range(NUM_MASKS + 1):
+        partitions = {}
+        quantizer = quantized.load_quantizer(quantizer_path(mask)) if QUANTIZATION_CONFIG.method is not None else None
+        for cat in MERGED_CATEGORIES:
+            if quantizer is not None:
+                # The full-precision vectors are left out of MAPPED_FILES, so only re-ranked rows are ever paged in
+                index = quantized.QuantizedIndex(quantizer, load_array(category_index_path(mask, cat, CODES_EXT)),
+                                                 np.load(category_index_path(mask, cat, VECTORS_EXT), mmap_mode='r'),
+                                                 QUANTIZATION_CONFIG.rerank)
+            else:
+                index = load_annoy_index(category_index_path(mask, cat, ANNOY_EXT))
+            partitions[cat] = (index, load_array(category_index_path(mask, cat, IDS_EXT)))
+        category_indexes.append(PartitionedIndex(mask, partitions, CATEGORY_INDEX_CONFIGS[INDEX_NAMES[mask]].search_k))
+
+    return category_indexes
+
+
+def add_delta_items(category_indexes: List[PartitionedIndex], items: List[FashionItem]):
+    if len(items) == 0:
         return
 
-    print('Creating primary indexes.')
-    items: List[FashionItem] = session.query(FashionItem).order_by(FashionItem.id).all()
-    print('Loaded items.')
+    # A new delta index replaces the old one, so concurrent queries always see a complete index
+    for partitioned, added in zip(category_indexes, create_exact_indexes(items)):
+        partitioned.delta = added if partitioned.delta is None else partitioned.delta.merged(added)
 
-    indexes = create_indexes(items)
+    print('Added {} items to the delta index ({} total).'.format(len(items), category_indexes[0].delta.get_n_items()))
+
+
+def delta_item_count() -> int:
+    delta = PRIMARY_CATEGORY_INDEXES[0].delta if len(PRIMARY_CATEGORY_INDEXES) > 0 else None
+    return delta.get_n_items() if delta is not None else 0
+
+
+def refresh_delta_items(session: Session):
+    delta = PRIMARY_CATEGORY_INDEXES[0].delta
+    first_new_id = PRIMARY_INDEXES[0].get_n_items()
+    if delta is not None and delta.get_n_items() > 0:
+        first_new_id = max(first_new_id, int(delta.ids.max()) + 1)
+
+    items = session.query(FashionItem).filter(FashionItem.id >= first_new_id).order_by(FashionItem.id).all()
+    add_delta_items(PRIMARY_CATEGORY_INDEXES, items)
+
+
+def compact_indexes(session: Session) -> bool:
+    # Only one process rebuilds at a time; the others pick up the new files through the generation file
+    with open(COMPACTION_LOCK_FILE_PATH, 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+
+        if read_index_generation() != INDEX_GENERATION:
+            return False
+
+        print('Compacting {} delta items into the primary indexes.'.format(delta_item_count()))
+        start_time = time.time()
+
+        items = session.query(FashionItem).order_by(FashionItem.id).all()
+        build_indexes(items)
+        del items
+
+        compile_item_catalog(session)
+
+        with open(GENERATION_FILE_PATH + '.tmp', 'w') as generation_file:
+            generation_file.write(str(INDEX_GENERATION + 1))
+        os.replace(GENERATION_FILE_PATH + '.tmp', GENERATION_FILE_PATH)
+
+        print('Finished compaction (took {:.2f}s)'.format(time.time() - start_time))
+
+    reload_indexes(session)
+    return True
+
+
+def reload_indexes(session: Session):
+    load_primary_indexes(session)
+    load_catalog(session)
+    warm_up_indexes()
+
+
+def refresh_indexes(session: Session):
+    if read_index_generation() != INDEX_GENERATION:
+        print('Reloading rebuilt primary indexes.')
+        reload_indexes(session)
+        return
+
+    refresh_delta_items(session)
+    if delta_item_count() >= DELTA_COMPACTION_THRESHOLD:
+        compact_indexes(session)
+
+
+CATALOG: Optional[Catalog] = None
+
+
+def compile_item_catalog(session: Session):
+    print('Compiling item catalog.')
+    item_categories = read_item_categories()
+
+    # Items added to the database after the metadata file was written use their stored categories
+    rows = []
+    for item_id, name, cat, semantic_cat in session.query(
+            FashionItem.id, FashionItem.name, FashionItem.category, FashionItem.semantic_category):
+        rows.append((item_id, name) + item_categories.get(name, (cat, semantic_cat)))
+
+    # Cover every id the primary indexes can return, even if its item is missing
+    num_ids = max([r[0] + 1 for r in rows] + [ind.get_n_items() for ind in PRIMARY_INDEXES] + [0])
+    compile_catalog(CATALOG_DIR, rows, num_ids, MERGED_CATEGORIES)
+    print('Compiled catalog of {} items.'.format(len(rows)))
+
+
+def load_catalog(session: Session):
+    global CATALOG
+
+    if not catalog_exists(CATALOG_DIR):
+        compile_item_catalog(session)
 
-    for ind, path in zip(indexes, save_paths):
-        ind.save(path)
+    CATALOG = Catalog(CATALOG_DIR)
 
-    PRIMARY_INDEXES = indexes
-    print('Saved primary indexes.')
+
+def warm_up_indexes():
+    # Reading every mapped file once pulls it into the page cache, which all workers share. Pages that were not
+    # prefaulted then only cost a minor fault on first access instead of a disk read.
+    paths = MAPPED_FILES + (CATALOG.files if CATALOG is not None else [])
+
+    start_time = time.time()
+    buffer = bytearray(WARMUP_READ_SIZE)
+    num_bytes = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            while True:
+                num_read = f.readinto(buffer)
+                if num_read == 0:
+                    break
+                num_bytes += num_read
+
+    print('Warmed up {} files ({:.1f} MB, took {:.2f}s)'.format(
+        len(paths), num_bytes / (1024 * 1024), time.time() - start_time))
 
 
 def load_categories() -> Tuple[List[str], Dict[str, str]]:
@@ -171,44 +983,313 @@ def load_categories() -> Tuple[List[str], Dict[str, str]]:
     return cat, item_categories_dict
 
 
-def get_nn_paths(session: Session, index: Annoy, query: FashionItem,
-                 num_results: int) -> List[Tuple[FashionItem, float]]:
+def index_search_k(index: Index) -> int:
+    for mask, ind in enumerate(PRIMARY_INDEXES):
+        if ind is index:
+            return INDEX_CONFIGS[INDEX_NAMES[mask]].search_k
+
+    return -1
+
+
+def query_index(index: Index, query: FashionItem, num_results: int) -> Tuple[List[int], List[float]]:
+    if isinstance(index, ExactIndex) and query.id not in index:
+        # Wardrobe indexes only contain wardrobe items, so other query items are searched by their vector
+        return index.get_nns_by_vector(query.embeddings()[index.mask], num_results, include_distances=True)
+
+    return index.get_nns_by_item(query.id, num_results, search_k=index_search_k(index), include_distances=True)
+
+
+def get_nn_ids(index: Index, query: FashionItem, num_results: int) -> List[Tuple[int, float]]:
     # The nearest neighbor search often includes the item itself as the first result,
     # so an extra result is included and the query item is removed from the results
-    results = index.get_nns_by_item(query.id, num_results + 1, include_distances=True)
+    results = query_index(index, query, num_results + 1)
     results = [r for r in zip(*results) if r[0] != query.id]
-    results = results[0:num_results]  # Slice the results in case the query item was not included
-    result_ids = [r[0] for r in results]
+    return results[0:num_results]  # Slice the results in case the query item was not included
 
-    result_items = session.query(FashionItem).filter(FashionItem.id.in_(result_ids))\
+
+@metrics.timed('get_nn_paths')
+def get_nn_paths(session: Session, index: Index, query: FashionItem,
+                 num_results: int) -> List[Tuple[Item, float]]:
+    results = get_nn_ids(index, query, num_results)
+
+    result_items = hydrate_items(session, [r[0] for r in results])
+    return [(result_items[item_id], score) for item_id, score in results if item_id in result_items]
+
+
+@metrics.timed('hydration')
+def hydrate_items(session: Session, item_ids: List[int]) -> Dict[int, Item]:
+    result_items: Dict[int, Item] = {}
+    if CATALOG is not None:
+        result_items.update(CATALOG.items(item_ids))
+        # Items added after the catalog was compiled are still read from the database
+        item_ids = [item_id for item_id in item_ids if item_id not in result_items]
+
+    if len(item_ids) == 0:
+        return result_items
+
+    db_items = session.query(FashionItem).filter(FashionItem.id.in_(item_ids))\
         .options(
-            defer(FashionItem.full_embedding),
-            defer(FashionItem.mask_1_embedding),
-            defer(FashionItem.mask_2_embedding),
-            defer(FashionItem.mask_3_embedding),
-            defer(FashionItem.mask_4_embedding)
+            defer(FashionItem.full_embedding_packed),
+            defer(FashionItem.mask_1_embedding_packed),
+            defer(FashionItem.mask_2_embedding_packed),
+            defer(FashionItem.mask_3_embedding_packed),
+            defer(FashionItem.mask_4_embedding_packed)
         ).all()
 
-    return list(zip(result_items, [r[1] for r in results]))
+    result_items.update({item.id: item for item in db_items})
+    return result_items
+
+
+def item_merged_categories(session: Session, item_ids: List[int]) -> Dict[int, str]:
+    categories: Dict[int, str] = {}
+    if CATALOG is not None:
+        categories.update({item_id: CATALOG.merged_category(item_id) for item_id in item_ids if item_id in CATALOG})
+        item_ids = [item_id for item_id in item_ids if item_id not in categories]
+
+    if len(item_ids) > 0:
+        rows = session.query(FashionItem.id, FashionItem.semantic_category).filter(FashionItem.id.in_(item_ids))
+        categories.update({item_id: merge_category(c) for item_id, c in rows})
 
+    return categories
 
-def get_nns_by_category(session: Session, index: Annoy, query: FashionItem, results_per_category: int,
-                        num_neighbors: int = 1000,
-                        for_categories: List[str] = None) -> Dict[str, List[Tuple[FashionItem, float]]]:
+
+CategoryResults = Dict[str, List[Tuple[int, float]]]
+
+
+def mmr_pool_size(results_per_category: int) -> int:
+    return max(results_per_category * MMR_POOL_FACTOR, MMR_MIN_POOL_SIZE)
+
+
+def mmr_rows(relevance: np.ndarray, vectors: np.ndarray, num_results: int, mmr_lambda: float) -> List[int]:
+    # Maximal marginal relevance: each step picks the candidate with the best trade-off between its relevance and its
+    # similarity to the closest candidate already picked. Similarities between all candidates are computed up front,
+    # so every step is a single vectorized update.
+    similarities = vectors @ vectors.T
+    max_similarity = np.zeros(len(relevance), dtype=np.float32)
+    available = np.ones(len(relevance), dtype=bool)
+
+    rows = []
+    for _ in range(min(num_results, len(relevance))):
+        scores = np.where(available, mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity, -np.inf)
+        row = int(np.argmax(scores))
+        rows.append(row)
+        available[row] = False
+        max_similarity = np.maximum(max_similarity, similarities[row]) if len(rows) > 1 else similarities[row]
+
+    return rows
+
+
+@metrics.timed('diversify')
+def diversify_results(session: Session, results: CategoryResults, results_per_category: int,
+                      mmr_lambda: float) -> CategoryResults:
+    # Re-ranks the candidate pool of every category, comparing candidates over all masks so that items which look
+    # alike in any way count as near-duplicates. Relevance is the cosine similarity behind the returned distances.
+    candidate_ids = result_ids(results)
+    if len(candidate_ids) == 0:
+        return results
+
+    stacked = stacked_embeddings(session, candidate_ids)
+    vectors = stacked.reshape(len(stacked), -1) / np.sqrt(NUM_MASKS + 1)
+
+    diversified: CategoryResults = {}
+    start = 0
+    for cat, cat_results in results.items():
+        rows = np.arange(start, start + len(cat_results))
+        start += len(cat_results)
+
+        relevance = 1 - np.square(np.asarray([d for _, d in cat_results], dtype=np.float32)) / 2
+        picked = mmr_rows(relevance, vectors[rows], results_per_category, mmr_lambda)
+        diversified[cat] = [cat_results[i] for i in picked]
+
+    return diversified
+
+
+def get_nn_ids_by_category(session: Session, index: Union[Index, PartitionedIndex], query: FashionItem,
+                           results_per_category: int, num_neighbors: int = 1000,
+                           for_categories: List[str] = None, mmr_lambda: Optional[float] = None) -> CategoryResults:
+    # With mmr_lambda, a larger pool of neighbours per category is re-ranked for diversity, from 0 for the most
+    # diverse results to 1 for plain nearest neighbours
     if for_categories is None:
         for_categories = MERGED_CATEGORIES
 
-    results: Dict[str, List[Tuple[FashionItem, float]]] = {c: [] for c in for_categories}
-    num_filled = 0
+    results: CategoryResults = {c: [] for c in for_categories}
+    num_results = results_per_category if mmr_lambda is None else mmr_pool_size(results_per_category)
 
-    for item, score in get_nn_paths(session, index, query, num_neighbors):
-        if num_filled >= len(for_categories):
-            break
+    if isinstance(index, PartitionedIndex):
+        query_vector = query.embeddings()[index.mask]
+        with metrics.timed('nn_query'):
+            for cat in for_categories:
+                # One extra result in case the query item is in this category
+                ids, distances = index.get_nns_by_vector(cat, query_vector, num_results + 1)
+                results[cat] = [r for r in zip(ids, distances) if r[0] != query.id][0:num_results]
+    else:
+        with metrics.timed('nn_query'):
+            neighbors = get_nn_ids(index, query, num_neighbors)
+        with metrics.timed('categorize'):
+            categories = item_merged_categories(session, [r[0] for r in neighbors])
+        num_filled = 0
+
+        for item_id, score in neighbors:
+            if num_filled >= len(for_categories):
+                break
+
+            c_list = results.get(categories.get(item_id))
+            if c_list is None:
+                continue
+
+            if len(c_list) < num_results:
+                c_list.append((item_id, score))
+                if len(c_list) >= num_results:
+                    num_filled += 1
 
-        c_list = results[item.merged_category()]
-        if len(c_list) < results_per_category:
-            c_list.append((item, score))
-            if len(c_list) >= results_per_category:
-                num_filled += 1
+    if mmr_lambda is not None:
+        results = diversify_results(session, results, results_per_category, mmr_lambda)
 
     return results
+
+
+# Catalog results by (index generation, delta size, query id, mask, results per category, number of neighbours,
+# diversity lambda)
+RESULT_CACHE = LRUCache(RESULT_CACHE_MAX_ENTRIES, ttl_seconds=RESULT_CACHE_TTL_SECONDS)
+# Optionally shared by the workers of a host
+RESULT_DISK_CACHE: Optional[DiskCache] = None
+
+
+def configure_result_cache(config_json: Dict):
+    # From the 'result_cache' section of config.json, e.g. {"disk_path": "data/result_cache.sqlite"}
+    global RESULT_CACHE
+    global RESULT_DISK_CACHE
+
+    ttl_seconds = config_json.get('ttl_seconds', RESULT_CACHE_TTL_SECONDS)
+    RESULT_CACHE = LRUCache(config_json.get('max_entries', RESULT_CACHE_MAX_ENTRIES), ttl_seconds=ttl_seconds)
+    if 'disk_path' in config_json:
+        RESULT_DISK_CACHE = DiskCache(config_json['disk_path'], ttl_seconds)
+
+
+def get_catalog_nn_ids_by_category(session: Session, mask: int, query: FashionItem, results_per_category: int,
+                                   num_neighbors: int = 1000, mmr_lambda: Optional[float] = None) -> CategoryResults:
+    # Catalog results only change when the indexes are swapped or new items are added to the delta
+    key = (INDEX_GENERATION, delta_item_count(), query.id, mask, results_per_category, num_neighbors, mmr_lambda)
+
+    results = RESULT_CACHE.get(key)
+    if results is not None:
+        return results
+
+    disk_key = json.dumps(key)
+    if RESULT_DISK_CACHE is not None:
+        cached = RESULT_DISK_CACHE.get(disk_key)
+        if cached is not None:
+            results = {cat: [tuple(r) for r in cat_results] for cat, cat_results in json.loads(cached).items()}
+            RESULT_CACHE.put(key, results)
+            return results
+
+    results = get_nn_ids_by_category(session, PRIMARY_CATEGORY_INDEXES[mask], query, results_per_category,
+                                     num_neighbors, mmr_lambda=mmr_lambda)
+
+    RESULT_CACHE.put(key, results)
+    if RESULT_DISK_CACHE is not None:
+        RESULT_DISK_CACHE.put(disk_key, json.dumps(results), INDEX_GENERATION)
+
+    return results
+
+
+def stacked_embeddings(session: Session, item_ids: List[int]) -> np.ndarray:
+    # Normalized embeddings of all masks as an (items, masks, dimensions) array. Items added after the store was
+    # built are read from the delta index, or from the database if they haven't been added to it yet.
+    stacked = np.zeros((len(item_ids), NUM_MASKS + 1, EMBEDDING_SIZE), dtype=np.float32)
+    store = EMBEDDING_STORE
+    num_stored = len(store) if store is not None else 0
+
+    ids = np.asarray(item_ids, dtype=np.int64)
+    in_store = ids < num_stored
+    if in_store.any():
+        stacked[in_store] = store[ids[in_store]]
+
+    positions = {item_id: i for i, item_id in enumerate(item_ids) if item_id >= num_stored}
+    delta = PRIMARY_CATEGORY_INDEXES[0].delta if len(PRIMARY_CATEGORY_INDEXES) > 0 else None
+    if delta is not None:
+        for item_id in [item_id for item_id in positions if item_id in delta]:
+            for mask, partitioned in enumerate(PRIMARY_CATEGORY_INDEXES):
+                stacked[positions[item_id], mask] = partitioned.delta.vectors[partitioned.delta.rows[item_id]]
+            positions.pop(item_id)
+
+    if len(positions) > 0:
+        for item in session.query(FashionItem).filter(FashionItem.id.in_(list(positions))):
+            stacked[positions[item.id]] = quantized.normalize(np.stack(item.embeddings()))
+
+    return stacked
+
+
+@metrics.timed('fused_query')
+def get_fused_nn_ids_by_category(session: Session, indexes: List[Union[Index, PartitionedIndex]], query: FashionItem,
+                                 weights: List[float], results_per_category: int,
+                                 num_neighbors: int = FUSED_NUM_NEIGHBORS, for_categories: List[str] = None,
+                                 mmr_lambda: Optional[float] = None) -> CategoryResults:
+    # Scores items by the weighted sum of their cosine similarities to the query over all masks. Candidates are the
+    # union of the neighbours found in the index of every weighted mask, and are re-scored together in one pass.
+    if for_categories is None:
+        for_categories = MERGED_CATEGORIES
+
+    query_embeddings = query.embeddings()
+    candidate_categories: Dict[int, str] = {}
+    uncategorized = set()
+
+    with metrics.timed('nn_query'):
+        for index, weight in zip(indexes, weights):
+            if weight <= 0:
+                continue
+
+            if isinstance(index, PartitionedIndex):
+                for cat in for_categories:
+                    ids, _ = index.get_nns_by_vector(cat, query_embeddings[index.mask],
+                                                     max(results_per_category, FUSED_CANDIDATES_PER_CATEGORY) + 1)
+                    candidate_categories.update(dict.fromkeys(ids, cat))
+            else:
+                uncategorized.update(item_id for item_id, _ in get_nn_ids(index, query, num_neighbors))
+
+    with metrics.timed('categorize'):
+        candidate_categories.update(
+            item_merged_categories(session, [i for i in uncategorized if i not in candidate_categories]))
+
+    results: CategoryResults = {c: [] for c in for_categories}
+    candidates = [i for i, c in candidate_categories.items() if c in results and i != query.id]
+    if len(candidates) == 0:
+        return results
+
+    with metrics.timed('fused_rerank'):
+        mask_weights = np.asarray(weights, dtype=np.float32)
+        weighted_query = quantized.normalize(np.stack(query_embeddings)) * (mask_weights / mask_weights.sum())[:, None]
+        similarities = np.einsum('nmd,md->n', stacked_embeddings(session, candidates), weighted_query)
+
+    # Same scale as the angular distances of single-mask results
+    distances = angular_distance(similarities)
+    num_results = results_per_category if mmr_lambda is None else mmr_pool_size(results_per_category)
+    for i in np.argsort(distances, kind='stable').tolist():
+        c_list = results[candidate_categories[candidates[i]]]
+        if len(c_list) < num_results:
+            c_list.append((candidates[i], float(distances[i])))
+
+    if mmr_lambda is not None:
+        results = diversify_results(session, results, results_per_category, mmr_lambda)
+
+    return results
+
+
+def result_ids(results: CategoryResults) -> List[int]:
+    return [item_id for cat_results in results.values() for item_id, _ in cat_results]
+
+
+def hydrate_results(results: CategoryResults, items: Dict[int, Item]) -> Dict[str, List[Tuple[Item, float]]]:
+    return {
+        cat: [(items[item_id], score) for item_id, score in cat_results if item_id in items]
+        for cat, cat_results in results.items()
+    }
+
+
+@metrics.timed('get_nns_by_category')
+def get_nns_by_category(session: Session, index: Union[Index, PartitionedIndex], query: FashionItem,
+                        results_per_category: int, num_neighbors: int = 1000, for_categories: List[str] = None,
+                        mmr_lambda: Optional[float] = None) -> Dict[str, List[Tuple[Item, float]]]:
+    results = get_nn_ids_by_category(session, index, query, results_per_category, num_neighbors, for_categories,
+                                     mmr_lambda)
+    return hydrate_results(results, hydrate_items(session, result_ids(results)))
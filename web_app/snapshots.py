@@ -0,0 +1,75 @@
+import threading
+from typing import Callable, Dict, FrozenSet, NamedTuple, Optional
+
+from cache import LRUCache
+
+# Snapshots are kept per worker, stamped with the user's wardrobe version from the database. Every wardrobe change
+# bumps that version in its transaction, whichever worker or app serves it, so a read that finds a different version
+# reloads the snapshot.
+SNAPSHOT_MAX_ENTRIES = 10000
+
+
+class UserSnapshot(NamedTuple):
+    user_id: int
+    username: str
+    version: int
+    wardrobe_ids: FrozenSet[int]
+    wardrobe_by_category: Dict[str, FrozenSet[int]]
+
+    def with_wardrobe_item(self, item_id: int, category: str) -> 'UserSnapshot':
+        by_category = dict(self.wardrobe_by_category)
+        by_category[category] = by_category.get(category, frozenset()) | {item_id}
+        return self._replace(wardrobe_ids=self.wardrobe_ids | {item_id}, wardrobe_by_category=by_category)
+
+    def without_wardrobe_item(self, item_id: int) -> 'UserSnapshot':
+        by_category = {c: ids - {item_id} for c, ids in self.wardrobe_by_category.items()}
+        return self._replace(wardrobe_ids=self.wardrobe_ids - {item_id}, wardrobe_by_category=by_category)
+
+
+def create_snapshot(user_id: int, username: str, version: int, wardrobe_categories: Dict[int, str]) -> UserSnapshot:
+    by_category: Dict[str, set] = {}
+    for item_id, category in wardrobe_categories.items():
+        by_category.setdefault(category, set()).add(item_id)
+
+    return UserSnapshot(
+        user_id=user_id,
+        username=username,
+        version=version,
+        wardrobe_ids=frozenset(wardrobe_categories),
+        wardrobe_by_category={c: frozenset(ids) for c, ids in by_category.items()}
+    )
+
+
+SNAPSHOTS = LRUCache(SNAPSHOT_MAX_ENTRIES)
+# Snapshots are immutable and replaced whole, so readers never see a partial update
+SNAPSHOTS_LOCK = threading.Lock()
+
+
+def get_snapshot(user_id: int, version: int, load: Callable[[], UserSnapshot]) -> UserSnapshot:
+    snapshot = SNAPSHOTS.get(user_id)
+    if snapshot is None or snapshot.version != version:
+        snapshot = load()
+        SNAPSHOTS.put(user_id, snapshot)
+
+    return snapshot
+
+
+def update_snapshot(user_id: int, version: int,
+                    update: Callable[[UserSnapshot], UserSnapshot]) -> Optional[UserSnapshot]:
+    # Applies a change made with the given new version. The cached snapshot only reflects the state the change was
+    # made to if it has the version right before, otherwise it is left to be reloaded on its next read.
+    with SNAPSHOTS_LOCK:
+        snapshot = SNAPSHOTS.get(user_id)
+        if snapshot is None:
+            return None
+        if snapshot.version != version - 1:
+            SNAPSHOTS.remove(user_id)
+            return None
+
+        snapshot = update(snapshot)._replace(version=version)
+        SNAPSHOTS.put(user_id, snapshot)
+        return snapshot
+
+
+def invalidate_snapshot(user_id: int):
+    SNAPSHOTS.remove(user_id)
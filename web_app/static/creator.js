@@ -23,6 +23,7 @@ function createImg(itemId, itemPath, itemCategory, inWardrobe) {
     imgEl.setAttribute('data-id', itemId);
     imgEl.setAttribute('data-category', itemCategory);
     imgEl.src = itemPath;
+    imgEl.loading = 'lazy';
     imgEl.classList.add('creator-item');
     if (!inWardrobe) {
         imgEl.classList.add('not-in-wardrobe');
@@ -57,7 +58,7 @@ function addOutfitItem(element) {
     const inWardrobe = !element.classList.contains('not-in-wardrobe');
 
     if (addItem(itemId, itemPath, itemCategory, inWardrobe, outfitCategoryItems, outfitCategoryElements)) {
-        loadRecommendations(itemId);
+        loadRecommendations([itemId]);
     }
 }
 
@@ -97,13 +98,15 @@ function addRecommendationItem(itemId, itemPath, itemCategory, inWardrobe) {
     addItem(itemId, itemPath, itemCategory, inWardrobe, recommendCategoryItems, recommendCategoryElements, true);
 }
 
-async function loadRecommendations(itemId) {
+async function loadRecommendations(itemIds) {
     const body = {
-        'item_id': itemId,
-        'wardrobe': 'random'
+        'queries': itemIds.map(itemId => ({
+            'item_id': itemId,
+            'scope': 'random'
+        }))
     };
 
-    const response = await fetch('api/recommend', {
+    const response = await fetch('api/recommend_batch', {
         method: 'POST',
         body: JSON.stringify(body),
         headers: {
@@ -115,8 +118,10 @@ async function loadRecommendations(itemId) {
         const responseJson = await response.json();
         console.log(responseJson);
 
-        for (let item of responseJson['results']) {
-            addRecommendationItem(item['id'], item['path'], item['category'], item['in_wardrobe']);
+        for (let queryResults of responseJson['results']) {
+            for (let item of queryResults['results']) {
+                addRecommendationItem(item['id'], item['thumbnail'], item['category'], item['in_wardrobe']);
+            }
         }
     }
 }
@@ -155,6 +160,53 @@ document.getElementById('create-button').addEventListener('click', ev => {
     submitOutfit();
 });
 
+// Fills every empty category of the outfit with the wardrobe items that fit it best
+async function completeOutfit() {
+    let body = {
+        'items': [],
+        'scope': 'wardrobe'
+    };
+
+    for (let cat of categories) {
+        for (let itemId of outfitCategoryItems[cat]) {
+            body['items'].push(itemId)
+        }
+    }
+
+    if (body['items'].length === 0) {
+        return;
+    }
+
+    const response = await fetch('api/complete_outfit', {
+        method: 'POST',
+        body: JSON.stringify(body),
+        headers: {
+            'Content-Type': 'application/json'
+        }
+    });
+
+    if (response.ok) {
+        const responseJson = await response.json();
+
+        let itemIds = [];
+        for (let item of responseJson['results']) {
+            const itemId = String(item['id']);
+            if (addItem(itemId, item['thumbnail'], item['category'], item['in_wardrobe'], outfitCategoryItems,
+                        outfitCategoryElements)) {
+                itemIds.push(itemId);
+            }
+        }
+
+        if (itemIds.length > 0) {
+            loadRecommendations(itemIds);
+        }
+    }
+}
+
+document.getElementById('complete-button').addEventListener('click', ev => {
+    completeOutfit();
+});
+
 
 let wardrobeCategoryItems = document.querySelectorAll('.creator-wardrobe-category-items');
 
@@ -172,9 +224,59 @@ function collapseExcept(element) {
     }
 }
 
+// Only the first items of each category are rendered. The next page is fetched when the end of an open category's
+// list, marked by an empty element, scrolls into view; closed categories have no height, so theirs never does.
+async function loadWardrobePage(element, moreEl) {
+    const cursor = element.getAttribute('data-next-cursor');
+    if (!cursor || element.hasAttribute('data-loading')) {
+        return;
+    }
+
+    element.setAttribute('data-loading', '');
+    const params = new URLSearchParams({
+        'category': element.getAttribute('data-category'),
+        'cursor': cursor,
+        'size': 'small'
+    });
+
+    const response = await fetch('api/wardrobe?' + params.toString());
+    element.removeAttribute('data-loading');
+    if (!response.ok) {
+        return;
+    }
+
+    const page = (await response.json())['results'][0];
+    for (let item of page['items']) {
+        element.insertBefore(createImg(item['id'], item['thumbnail'], item['category'], true), moreEl);
+    }
+
+    const nextCursor = page['next_cursor'];
+    element.setAttribute('data-next-cursor', nextCursor === null ? '' : nextCursor);
+    moreObserver.unobserve(moreEl);
+    if (nextCursor === null) {
+        moreEl.remove();
+    } else {
+        // Observing again reports whether the end of the list is still in view
+        moreObserver.observe(moreEl);
+    }
+}
+
+const moreObserver = new IntersectionObserver(entries => {
+    for (let entry of entries) {
+        if (entry.isIntersecting) {
+            loadWardrobePage(entry.target.parentElement, entry.target);
+        }
+    }
+}, {rootMargin: '100px'});
+
 for (let el of wardrobeCategoryItems) {
     let name = el.parentElement.querySelector('.creator-wardrobe-category-name');
     name.addEventListener('click', evt => {
         collapseExcept(el);
     });
+
+    const moreEl = el.querySelector('.creator-wardrobe-more');
+    if (moreEl !== null) {
+        moreObserver.observe(moreEl);
+    }
 }
@@ -16,10 +16,84 @@ async function removeWardrobeItem(element) {
     }
 }
 
-for (let el of document.querySelectorAll('.wardrobe-item')) {
+function createWardrobeItem(item) {
+    const itemEl = document.createElement('div');
+    itemEl.classList.add('wardrobe-item');
+    itemEl.setAttribute('data-id', item['id']);
+    itemEl.setAttribute('data-category', item['category']);
+
+    const imgEl = document.createElement('img');
+    imgEl.classList.add('wardrobe-img');
+    imgEl.src = item['thumbnail'];
+    imgEl.loading = 'lazy';
+    imgEl.setAttribute('data-id', item['id']);
+    imgEl.setAttribute('data-category', item['category']);
+
+    const removeEl = document.createElement('button');
+    removeEl.classList.add('wardrobe-remove', 'link-btn', 'btn-danger', 'text-m', 'weight-bold');
+    removeEl.textContent = 'X';
+
+    itemEl.appendChild(imgEl);
+    itemEl.appendChild(removeEl);
+    return itemEl;
+}
+
+// The page only renders the first items of each category, the next page is fetched when the category's "Show more"
+// button scrolls into view or is clicked
+async function loadWardrobePage(itemsEl, moreEl) {
+    const cursor = itemsEl.getAttribute('data-next-cursor');
+    if (!cursor || moreEl.disabled) {
+        return;
+    }
+
+    moreEl.disabled = true;
+    const params = new URLSearchParams({
+        'category': itemsEl.getAttribute('data-category'),
+        'cursor': cursor,
+        'size': 'medium'
+    });
+
+    const response = await fetch('api/wardrobe?' + params.toString());
+    moreEl.disabled = false;
+    if (!response.ok) {
+        return;
+    }
+
+    const page = (await response.json())['results'][0];
+    for (let item of page['items']) {
+        itemsEl.appendChild(createWardrobeItem(item));
+    }
+
+    const nextCursor = page['next_cursor'];
+    itemsEl.setAttribute('data-next-cursor', nextCursor === null ? '' : nextCursor);
+    if (nextCursor === null) {
+        moreObserver.unobserve(moreEl);
+        moreEl.remove();
+    } else {
+        // Observing again reports whether the button is still in view, so a tall screen keeps filling up
+        moreObserver.unobserve(moreEl);
+        moreObserver.observe(moreEl);
+    }
+}
+
+const moreObserver = new IntersectionObserver(entries => {
+    for (let entry of entries) {
+        if (entry.isIntersecting) {
+            const moreEl = entry.target;
+            loadWardrobePage(moreEl.previousElementSibling, moreEl);
+        }
+    }
+}, {rootMargin: '200px'});
+
+for (let el of document.querySelectorAll('.wardrobe-category-items')) {
     el.addEventListener('click', evt => {
         if (evt.target.classList.contains('wardrobe-remove')) {
-            removeWardrobeItem(el);
+            removeWardrobeItem(evt.target.closest('.wardrobe-item'));
         }
-    })
+    });
+}
+
+for (let el of document.querySelectorAll('.wardrobe-more')) {
+    el.addEventListener('click', () => loadWardrobePage(el.previousElementSibling, el));
+    moreObserver.observe(el);
 }
@@ -1,9 +1,49 @@
 import os
+from typing import Dict, List
 
+import numpy as np
 from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
 
+EMBEDDING_DTYPE = np.float32
+PACKED_EMBEDDING_BYTES = 64 * np.dtype(EMBEDDING_DTYPE).itemsize
+
+
+def pack_embedding(embedding: str) -> bytes:
+    return np.array(embedding.split(','), dtype=EMBEDDING_DTYPE).tobytes()
+
+
+def unpack_embedding(packed: bytes) -> np.ndarray:
+    return np.frombuffer(packed, dtype=EMBEDDING_DTYPE)
+
+
+def database_uri(db_json: Dict) -> str:
+    # A full database URI, e.g. "sqlite:////tmp/loadtest.sqlite", takes the place of the MySQL settings
+    if 'uri' in db_json:
+        return db_json['uri']
+
+    return 'mysql+pymysql://{}:{}@{}:{}/{}'.format(
+        db_json['user'],
+        db_json['password'],
+        db_json['host'],
+        db_json['port'],
+        db_json['database']
+    )
+
+
+def item_path(name: str) -> str:
+    return os.path.join('static/images', name + '.jpg')
+
+
+def merge_category(semantic_category: str) -> str:
+    c = semantic_category
+    if c in ['scarves', 'sunglasses', 'jewellery']:
+        c = 'accessories'
+    elif c == 'outerwear':
+        c = 'tops'
+    return c
+
 
 user_items = db.Table(
     'user_items',
@@ -17,6 +57,8 @@ class User(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(20), unique=True, nullable=False)
+    # Bumped by every change to the wardrobe, so cached copies of it can be checked for staleness
+    wardrobe_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     wardrobe_items = db.relationship('FashionItem', secondary=user_items, lazy=True)
     outfits = db.relationship('Outfit', back_populates='user', lazy=True)
@@ -30,22 +72,43 @@ class FashionItem(db.Model):
     category = db.Column(db.String(100), nullable=False)
     semantic_category = db.Column(db.String(100), nullable=False)
 
-    full_embedding = db.Column(db.String(2000), nullable=False)
-    mask_1_embedding = db.Column(db.String(2000), nullable=False)
-    mask_2_embedding = db.Column(db.String(2000), nullable=False)
-    mask_3_embedding = db.Column(db.String(2000), nullable=False)
-    mask_4_embedding = db.Column(db.String(2000), nullable=False)
+    # Legacy comma-separated embeddings, only read for rows that have not been migrated to the packed columns
+    full_embedding = db.deferred(db.Column(db.String(2000)))
+    mask_1_embedding = db.deferred(db.Column(db.String(2000)))
+    mask_2_embedding = db.deferred(db.Column(db.String(2000)))
+    mask_3_embedding = db.deferred(db.Column(db.String(2000)))
+    mask_4_embedding = db.deferred(db.Column(db.String(2000)))
+
+    full_embedding_packed = db.Column(db.VARBINARY(PACKED_EMBEDDING_BYTES))
+    mask_1_embedding_packed = db.Column(db.VARBINARY(PACKED_EMBEDDING_BYTES))
+    mask_2_embedding_packed = db.Column(db.VARBINARY(PACKED_EMBEDDING_BYTES))
+    mask_3_embedding_packed = db.Column(db.VARBINARY(PACKED_EMBEDDING_BYTES))
+    mask_4_embedding_packed = db.Column(db.VARBINARY(PACKED_EMBEDDING_BYTES))
+
+    def embeddings(self) -> List[np.ndarray]:
+        packed = [
+            self.full_embedding_packed,
+            self.mask_1_embedding_packed,
+            self.mask_2_embedding_packed,
+            self.mask_3_embedding_packed,
+            self.mask_4_embedding_packed
+        ]
+        if None not in packed:
+            return [unpack_embedding(p) for p in packed]
+
+        return [np.array(em.split(','), dtype=EMBEDDING_DTYPE) for em in [
+            self.full_embedding,
+            self.mask_1_embedding,
+            self.mask_2_embedding,
+            self.mask_3_embedding,
+            self.mask_4_embedding
+        ]]
 
     def get_path(self) -> str:
-        return os.path.join('static/images', self.name + '.jpg')
+        return item_path(self.name)
 
     def merged_category(self) -> str:
-        c = self.semantic_category
-        if c in ['scarves', 'sunglasses', 'jewellery']:
-            c = 'accessories'
-        elif c == 'outerwear':
-            c = 'tops'
-        return c
+        return merge_category(self.semantic_category)
 
 
 outfit_items = db.Table(
@@ -65,3 +128,11 @@ class Outfit(db.Model):
 
     user = db.relationship('User', back_populates='outfits')
     items = db.relationship('FashionItem', secondary=outfit_items, lazy=False)
+
+
+class IngestState(db.Model):
+    # Written when an ingest of the embedding files finishes, so the marker lives and dies with the items it describes
+    __tablename__ = 'ingest_state'
+
+    id = db.Column(db.Integer, primary_key=True)
+    num_items = db.Column(db.Integer, nullable=False)
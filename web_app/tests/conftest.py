@@ -0,0 +1,69 @@
+# The app reads its data relative to the working directory, so tests run it in a temporary directory with a small
+# random catalog, ingested into SQLite and indexed by running app.py once, like a real install. Run from web_app with
+# pytest installed:
+#
+# python -m pytest tests
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+WEB_APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, WEB_APP_DIR)
+
+NUM_ITEMS = 300
+EMBEDDING_SIZE = 64
+SEMANTIC_CATEGORIES = ['hats', 'all-body', 'tops', 'outerwear', 'bottoms', 'shoes', 'bags', 'scarves', 'sunglasses',
+                       'jewellery']
+
+
+def write_catalog(data_dir: str, num_items: int, seed: int = 0):
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(data_dir, 'embeddings'))
+
+    with open(os.path.join(data_dir, 'categories.csv'), 'w') as categories_file:
+        for cat_id, cat in enumerate(SEMANTIC_CATEGORIES):
+            categories_file.write('{},{},x\n'.format(cat_id, cat))
+
+    names = ['item{:05d}'.format(i) for i in range(num_items)]
+    with open(os.path.join(data_dir, 'item_metadata.json'), 'w') as metadata_file:
+        json.dump({name: {'category_id': str(i % len(SEMANTIC_CATEGORIES)),
+                          'semantic_category': SEMANTIC_CATEGORIES[i % len(SEMANTIC_CATEGORIES)]}
+                   for i, name in enumerate(names)}, metadata_file)
+
+    for file_name in ['full_embeddings.csv'] + ['mask_{}_embeddings.csv'.format(i + 1) for i in range(4)]:
+        with open(os.path.join(data_dir, 'embeddings', file_name), 'w') as embeddings_file:
+            for name, vector in zip(names, rng.randn(num_items, EMBEDDING_SIZE)):
+                embeddings_file.write('{}.jpg, {}\n'.format(name, ', '.join('{:.6f}'.format(v) for v in vector)))
+
+
+@pytest.fixture(scope='session')
+def app_dir(tmp_path_factory):
+    root = str(tmp_path_factory.mktemp('app'))
+    write_catalog(os.path.join(root, 'data'), NUM_ITEMS)
+    with open(os.path.join(root, 'config.json'), 'w') as config_file:
+        json.dump({
+            'secret_key': 'test',
+            'database': {'uri': 'sqlite:///' + os.path.join(root, 'test.sqlite')}
+        }, config_file)
+
+    subprocess.run([sys.executable, os.path.join(WEB_APP_DIR, 'app.py')], cwd=root, check=True,
+                   env=dict(os.environ, CONFIG_FILE='config.json'), stdout=subprocess.DEVNULL)
+    return root
+
+
+@pytest.fixture(scope='session')
+def application(app_dir):
+    cwd = os.getcwd()
+    os.chdir(app_dir)
+    os.environ['CONFIG_FILE'] = 'config.json'
+    try:
+        import app
+        app.application.testing = True
+        app.application.config['WTF_CSRF_ENABLED'] = False
+        yield app.application
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,101 @@
+import pytest
+
+import cache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(cache.time, 'time', lambda: now[0])
+    return now
+
+
+def test_lru_evicts_least_recently_used():
+    lru = cache.LRUCache(2)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    assert lru.get('a') == 1
+
+    lru.put('c', 3)
+
+    assert lru.get('b') is None
+    assert (lru.get('a'), lru.get('c')) == (1, 3)
+    assert lru.stats().evictions == 1
+
+
+def test_lru_evicts_by_size():
+    lru = cache.LRUCache(10, max_bytes=10)
+    lru.put('a', 1, size_bytes=6)
+    lru.put('b', 2, size_bytes=6)
+    lru.put('huge', 3, size_bytes=11)
+
+    assert lru.get('a') is None
+    assert lru.get('huge') is None
+    assert lru.stats().size_bytes == 6
+
+
+def test_lru_replacing_a_value_updates_its_size():
+    lru = cache.LRUCache(10, max_bytes=10)
+    lru.put('a', 1, size_bytes=8)
+    lru.put('a', 2, size_bytes=2)
+    lru.put('b', 3, size_bytes=8)
+
+    assert (lru.get('a'), lru.get('b')) == (2, 3)
+    assert lru.stats().evictions == 0
+
+
+def test_lru_expires_values(clock):
+    lru = cache.LRUCache(10, ttl_seconds=60)
+    lru.put('a', 1, size_bytes=4)
+
+    clock[0] += 59
+    assert lru.get('a') == 1
+    clock[0] += 2
+    assert lru.get('a') is None
+    assert lru.stats() == cache.CacheStats(hits=1, misses=1, evictions=0, entries=0, size_bytes=0)
+
+
+def test_lru_remove_where():
+    lru = cache.LRUCache(10)
+    for key in [(1, 'a'), (1, 'b'), (2, 'a')]:
+        lru.put(key, key)
+
+    lru.remove_where(lambda k: k[0] == 1)
+
+    assert lru.stats().entries == 1
+    assert lru.get((2, 'a')) == (2, 'a')
+
+
+def test_disk_cache_is_shared_by_path(tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    cache.DiskCache(path).put('a', 'value')
+
+    disk_cache = cache.DiskCache(path)
+    assert disk_cache.get('a') == 'value'
+    assert disk_cache.get('b') is None
+    assert (disk_cache.hits, disk_cache.misses) == (1, 1)
+
+
+def test_disk_cache_removes_other_versions(tmp_path):
+    disk_cache = cache.DiskCache(str(tmp_path / 'cache.sqlite'))
+    disk_cache.put('old', 'value', version=1)
+    disk_cache.put('new', 'value', version=2)
+
+    disk_cache.remove_other_versions(2)
+
+    assert disk_cache.get('old') is None
+    assert disk_cache.get('new') == 'value'
+    assert disk_cache.stats().entries == 1
+
+
+def test_disk_cache_expires_values(tmp_path, clock):
+    disk_cache = cache.DiskCache(str(tmp_path / 'cache.sqlite'), ttl_seconds=60)
+    disk_cache.put('a', 'value', version=1)
+
+    clock[0] += 61
+    assert disk_cache.get('a') is None
+
+    # Expired values are pruned with other versions, even of the current version
+    disk_cache.remove_other_versions(1)
+    assert disk_cache.stats().entries == 0
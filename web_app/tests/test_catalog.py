@@ -0,0 +1,44 @@
+import pytest
+
+import catalog
+
+ROWS = [(3, 'item3', 'cat-b', 'scarves'), (1, 'item1', 'cat-a', 'tops'), (4, 'ítem4', 'cat-a', 'outerwear')]
+
+
+@pytest.fixture
+def catalog_dir(tmp_path):
+    path = str(tmp_path / 'catalog')
+    catalog.compile_catalog(path, ROWS, 6, ['tops', 'shoes'])
+    return path
+
+
+def test_catalog_reads_compiled_items(catalog_dir):
+    items_catalog = catalog.Catalog(catalog_dir)
+
+    assert catalog.catalog_exists(catalog_dir)
+    assert len(items_catalog) == 6
+    assert items_catalog.item(4) == catalog.CatalogItem(4, 'ítem4', 'cat-a', 'outerwear', 'tops')
+    assert items_catalog.item(3).get_path() == 'static/images/item3.jpg'
+    assert items_catalog.merged_category(3) == 'accessories'
+    assert items_catalog.merged_categories == ['tops', 'shoes', 'accessories']
+
+
+def test_catalog_skips_missing_ids(catalog_dir):
+    items_catalog = catalog.Catalog(catalog_dir)
+
+    assert [i for i in range(-1, 8) if i in items_catalog] == [1, 3, 4]
+    assert sorted(items_catalog.items([0, 1, 2, 3, 7])) == [1, 3]
+
+
+def test_recompiling_keeps_loaded_catalogs_valid(catalog_dir):
+    items_catalog = catalog.Catalog(catalog_dir)
+
+    catalog.compile_catalog(catalog_dir, [(1, 'renamed', 'cat-a', 'tops')], 2, ['tops'])
+
+    assert items_catalog.name(3) == 'item3'
+    assert catalog.Catalog(catalog_dir).name(1) == 'renamed'
+    assert 3 not in catalog.Catalog(catalog_dir)
+
+
+def test_incomplete_catalog_does_not_exist(tmp_path):
+    assert not catalog.catalog_exists(str(tmp_path))
@@ -0,0 +1,35 @@
+# Items added to the database go to the delta index on the next refresh, and into rebuilt primary indexes once the
+# delta reaches the compaction threshold.
+import similarity
+from tables import db, FashionItem
+
+
+def test_new_items_go_through_delta_and_compaction(application, monkeypatch):
+    with application.app_context():
+        original = db.session.query(FashionItem).filter(FashionItem.semantic_category == 'shoes').first()
+        item_id = db.session.query(db.func.max(FashionItem.id)).scalar() + 1
+        db.session.add(FashionItem(
+            id=item_id, name='added{:05d}'.format(item_id), category=original.category,
+            semantic_category=original.semantic_category,
+            **{c: getattr(original, c) for c in ['full_embedding_packed'] +
+               ['mask_{}_embedding_packed'.format(i + 1) for i in range(similarity.NUM_MASKS)]}))
+        db.session.commit()
+        vector = original.embeddings()[0]
+        generation = similarity.INDEX_GENERATION
+        delta_items = similarity.delta_item_count()
+
+        similarity.refresh_indexes(db.session)
+
+        assert similarity.delta_item_count() == delta_items + 1
+        ids, distances = similarity.PRIMARY_CATEGORY_INDEXES[0].get_nns_by_vector('shoes', vector, 2)
+        assert set(ids) == {original.id, item_id}
+        assert distances[1] < 1e-3
+
+        monkeypatch.setattr(similarity, 'DELTA_COMPACTION_THRESHOLD', 1)
+        similarity.refresh_indexes(db.session)
+
+        assert similarity.INDEX_GENERATION == similarity.read_index_generation() == generation + 1
+        assert similarity.delta_item_count() == 0
+        assert item_id in similarity.CATALOG
+        ids, _ = similarity.PRIMARY_CATEGORY_INDEXES[0].get_nns_by_vector('shoes', vector, 2)
+        assert set(ids) == {original.id, item_id}
@@ -0,0 +1,54 @@
+import time
+
+import numpy as np
+
+import completion
+
+
+def test_weighted_embeddings_give_weighted_cosines():
+    rng = np.random.RandomState(0)
+    stacked = rng.randn(2, 5, 8)
+    stacked /= np.linalg.norm(stacked, axis=2, keepdims=True)
+    weights = np.array([2, 0, 1, 0, 1], dtype=np.float32)
+
+    vectors = completion.weighted_embeddings(stacked, weights)
+    cosines = (stacked[0] * stacked[1]).sum(axis=1)
+
+    np.testing.assert_allclose(vectors[0] @ vectors[1], (weights * cosines).sum() / weights.sum(), atol=1e-6)
+
+
+def test_beam_search_prefers_candidates_that_fit_each_other():
+    # Candidate 0 fits the outfit best on its own, but candidates 1 and 2 fit each other much better
+    base = np.array([0.5, 0.4, 0.4], dtype=np.float32)
+    pairwise = np.array([[1, 0, -1],
+                         [0, 1, 0.9],
+                         [-1, 0.9, 1]], dtype=np.float32)
+    slots = [np.array([0, 1]), np.array([2])]
+
+    assert completion.beam_search(base, pairwise, slots, time.monotonic() + 10) == [1, 2]
+
+
+def test_beam_search_past_deadline_is_greedy():
+    base = np.array([0.5, 0.4, 0.4], dtype=np.float32)
+    pairwise = np.array([[1, 0, -1],
+                         [0, 1, 0.9],
+                         [-1, 0.9, 1]], dtype=np.float32)
+    slots = [np.array([0, 1]), np.array([2])]
+
+    assert completion.beam_search(base, pairwise, slots, time.monotonic() - 1) == [0, 2]
+
+
+def test_complete_outfit_fills_every_empty_category(application):
+    import similarity
+    from tables import db
+
+    with application.app_context():
+        outfit_ids = [1, 2]
+        results = completion.complete_outfit(db.session, outfit_ids, [1.0] * (similarity.NUM_MASKS + 1))
+        outfit_categories = similarity.item_merged_categories(db.session, outfit_ids)
+
+        assert set(results) == set(similarity.MERGED_CATEGORIES) - set(outfit_categories.values())
+        for cat, [(item_id, distance)] in results.items():
+            assert similarity.item_merged_categories(db.session, [item_id])[item_id] == cat
+            # Angular distances, like every other category result
+            assert 0 <= distance <= 2
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+import neighbors
+import similarity
+
+CATEGORIES = ['tops', 'shoes']
+
+
+@pytest.fixture
+def table(tmp_path, monkeypatch):
+    for name, file_name in (('IDS_FILE_PATH', 'ids.npy'), ('DISTANCES_FILE_PATH', 'distances.npy'),
+                            ('META_FILE_PATH', 'meta.json')):
+        monkeypatch.setattr(neighbors, name, str(tmp_path / file_name))
+
+    # Item 1 has two neighbours in tops and one in shoes, item 2 has none
+    ids = np.full((3, similarity.NUM_MASKS + 1, len(CATEGORIES), 2), neighbors.MISSING_ID, dtype=np.int32)
+    distances = np.full(ids.shape, np.inf, dtype=np.float16)
+    ids[1, 0] = [[5, 6], [7, neighbors.MISSING_ID]]
+    distances[1, 0] = [[0.25, 0.5], [0.75, np.inf]]
+    np.save(neighbors.IDS_FILE_PATH, ids)
+    np.save(neighbors.DISTANCES_FILE_PATH, distances)
+    with open(neighbors.META_FILE_PATH, 'w') as meta_file:
+        meta_file.write('{"generation": 3, "k": 2, "categories": ["tops", "shoes"]}')
+
+    return neighbors.NeighborTable()
+
+
+@pytest.fixture
+def indexes(monkeypatch, table):
+    monkeypatch.setattr(similarity, 'INDEX_GENERATION', table.generation)
+    monkeypatch.setattr(similarity, 'PRIMARY_CATEGORY_INDEXES',
+                        [similarity.PartitionedIndex(mask, {}) for mask in range(similarity.NUM_MASKS + 1)])
+    monkeypatch.setattr(similarity, 'get_catalog_nn_ids_by_category', lambda *args, **kwargs: 'searched')
+    monkeypatch.setattr(neighbors, 'NEIGHBOR_TABLE', table)
+
+
+class Query:
+    def __init__(self, item_id: int):
+        self.id = item_id
+
+
+def test_lookup(table):
+    assert table.lookup(1, 0, 2) == {'tops': [(5, 0.25), (6, 0.5)], 'shoes': [(7, 0.75)]}
+    assert table.lookup(1, 0, 1) == {'tops': [(5, 0.25)], 'shoes': [(7, 0.75)]}
+
+
+@pytest.mark.parametrize('item_id, results_per_category', [(2, 1), (3, 1), (-1, 1), (1, 3)])
+def test_lookup_misses(table, item_id, results_per_category):
+    assert table.lookup(item_id, 0, results_per_category) is None
+
+
+def test_catalog_results_come_from_the_table(indexes):
+    assert neighbors.catalog_nn_ids_by_category(None, 0, Query(1), 1) == {'tops': [(5, 0.25)], 'shoes': [(7, 0.75)]}
+
+
+def test_catalog_results_fall_back_to_search(indexes):
+    assert neighbors.catalog_nn_ids_by_category(None, 0, Query(2), 1) == 'searched'
+    assert neighbors.catalog_nn_ids_by_category(None, 0, Query(1), 3) == 'searched'
+    assert neighbors.catalog_nn_ids_by_category(None, 0, Query(1), 1, mmr_lambda=0.5) == 'searched'
+
+
+def test_table_of_another_generation_is_not_used(indexes, monkeypatch):
+    monkeypatch.setattr(similarity, 'INDEX_GENERATION', 4)
+    monkeypatch.setattr(neighbors, 'last_table_check', None)
+
+    assert neighbors.current_table() is None
+    assert neighbors.catalog_nn_ids_by_category(None, 0, Query(1), 1) == 'searched'
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+
+import quantized
+
+
+@pytest.fixture(scope='module')
+def vectors():
+    return quantized.normalize(np.random.RandomState(0).randn(2000, 64))
+
+
+def exact_neighbors(vectors: np.ndarray, query: np.ndarray, n: int) -> set:
+    return set(np.argsort(-(vectors @ query), kind='stable')[:n].tolist())
+
+
+@pytest.mark.parametrize('method', quantized.QUANTIZATION_METHODS)
+def test_reconstruction_keeps_directions(vectors, method):
+    quantizer = quantized.train_quantizer(vectors, method, num_subspaces=16)
+    _, mean_cosine = quantized.reconstruction_error(quantizer, vectors)
+
+    assert mean_cosine > (0.99 if method == 'int8' else 0.7)
+
+
+@pytest.mark.parametrize('method', quantized.QUANTIZATION_METHODS)
+def test_similarities_match_decoded_codes(vectors, method):
+    quantizer = quantized.train_quantizer(vectors, method, num_subspaces=16)
+    codes = quantizer.encode(vectors)
+    query = vectors[0]
+
+    np.testing.assert_allclose(quantizer.similarities(query, codes), quantizer.decode(codes) @ query, atol=1e-4)
+
+
+def test_product_quantizer_rejects_uneven_subspaces(vectors):
+    with pytest.raises(ValueError):
+        quantized.train_quantizer(vectors, 'pq', num_subspaces=10)
+
+
+def test_save_and_load(vectors, tmp_path):
+    for method in quantized.QUANTIZATION_METHODS:
+        quantizer = quantized.train_quantizer(vectors, method, num_subspaces=16)
+        path = str(tmp_path / '{}.npz'.format(method))
+        quantizer.save(path)
+        loaded = quantized.load_quantizer(path)
+
+        assert loaded.method == method
+        np.testing.assert_array_equal(loaded.encode(vectors[:10]), quantizer.encode(vectors[:10]))
+
+
+def test_reranked_index_returns_exact_neighbors(vectors):
+    quantizer = quantized.train_quantizer(vectors, 'pq', num_subspaces=16)
+    index = quantized.QuantizedIndex(quantizer, quantizer.encode(vectors), vectors, rerank=len(vectors))
+    query = vectors[7]
+
+    ids, distances = index.get_nns_by_vector(query, 10, include_distances=True)
+
+    assert ids[0] == 7
+    assert set(ids) == exact_neighbors(vectors, query, 10)
+    # Angular distances like Annoy's, sorted ascending
+    np.testing.assert_allclose(distances, np.sqrt(np.maximum(2 - 2 * (vectors[ids] @ query), 0)), atol=1e-5)
+    assert distances == sorted(distances)
+
+
+def test_index_without_vectors_ranks_by_codes(vectors):
+    quantizer = quantized.train_quantizer(vectors, 'int8')
+    index = quantized.QuantizedIndex(quantizer, quantizer.encode(vectors))
+
+    ids = index.get_nns_by_vector(vectors[3], 20)
+
+    assert index.rerank == 0
+    assert len(ids) == 20
+    assert len(set(ids) & exact_neighbors(vectors, vectors[3], 20)) >= 18
+
+
+def test_top_rows():
+    similarities = np.array([0.1, 0.9, 0.5, 0.7], dtype=np.float32)
+
+    assert set(quantized.top_rows(similarities, 2).tolist()) == {1, 3}
+    assert quantized.top_rows(similarities, 10).tolist() == [0, 1, 2, 3]
@@ -0,0 +1,77 @@
+# Every budgeted route is called in testing mode, where a request over its budget raises QueryBudgetExceeded. Cached
+# snapshots are dropped before each request, so routes are checked with the queries of a cold cache.
+import pytest
+
+import metrics
+import snapshots
+
+
+@pytest.fixture
+def client(application):
+    return application.test_client()
+
+
+def budgeted_routes():
+    return {dict(labels)['route'] for labels in metrics.HISTOGRAMS['db_queries']} & set(metrics.QUERY_BUDGETS)
+
+
+def call(client, method: str, path: str, expected_status: int = 200, **kwargs):
+    snapshots.SNAPSHOTS.clear()
+    response = client.open(path, method=method, **kwargs)
+    assert response.status_code == expected_status, response.get_data(as_text=True)
+    return response
+
+
+def sign_up(client, username: str):
+    call(client, 'GET', '/signup')
+    call(client, 'POST', '/signup', 302, data={'username': username, 'submit': 'Sign Up'})
+
+
+def test_routes_stay_within_query_budgets(application, client):
+    sign_up(client, 'budgets')
+    call(client, 'GET', '/randomize-wardrobe', 302)
+
+    # Items of every category, so wardrobe queries have results and completion has candidates
+    randomized_ids = {item['id'] for page in call(client, 'GET', '/api/wardrobe?limit=200').get_json()['results']
+                      for item in page['items']}
+    wardrobe_ids = list(range(1, 41))
+    for item_id in wardrobe_ids:
+        if item_id not in randomized_ids:
+            call(client, 'POST', '/api/add_wardrobe_item', json={'item_id': item_id})
+    call(client, 'POST', '/api/remove_wardrobe_item', json={'item_id': wardrobe_ids.pop()})
+
+    call(client, 'GET', '/wardrobe')
+    call(client, 'GET', '/creator')
+    call(client, 'GET', '/api/wardrobe?category=tops&cursor=0&limit=1')
+
+    outfit_id = call(client, 'POST', '/api/create_outfit',
+                     json={'items': wardrobe_ids[:3], 'name': 'Budget'}).get_json()['outfit_id']
+    call(client, 'GET', '/outfits')
+    call(client, 'POST', '/api/delete_outfit', json={'outfit_id': outfit_id})
+
+    for wardrobe in (True, False):
+        for options in ({}, {'mmr_lambda': 0.5}, {'weights': [1, 0, 0, 0.5, 0]},
+                        {'weights': [1, 1, 1, 1, 1], 'mmr_lambda': 0.3}):
+            call(client, 'POST', '/api/recommend', json=dict(item_id=wardrobe_ids[0], wardrobe=wardrobe, **options))
+
+    queries = [{'item_id': item_id, 'scope': ('wardrobe', 'catalog')[i % 2], 'mask': i % 5, 'results_per_category': 3,
+                'mmr_lambda': 0.5 if i % 3 == 0 else None}
+               for i, item_id in enumerate(range(100, 100 + 32))]
+    queries[-1]['weights'] = [1, 1, 0, 0, 0]
+    call(client, 'POST', '/api/recommend_batch', json={'queries': queries})
+
+    call(client, 'POST', '/api/complete_outfit', json={'items': wardrobe_ids[:2]})
+    call(client, 'POST', '/api/complete_outfit', json={'items': wardrobe_ids[:2], 'scope': 'catalog'})
+
+    call(client, 'GET', '/logout', 302)
+    call(client, 'POST', '/login', 302, data={'username': 'budgets', 'submit': 'Log In'})
+
+    assert budgeted_routes() == set(metrics.QUERY_BUDGETS)
+
+
+def test_exceeded_budget_fails_in_testing_mode(application, client, monkeypatch):
+    sign_up(client, 'overbudget')
+    monkeypatch.setitem(metrics.QUERY_BUDGETS, 'wardrobe', 0)
+
+    with pytest.raises(metrics.QueryBudgetExceeded):
+        client.get('/wardrobe')
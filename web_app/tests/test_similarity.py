@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+import similarity
+
+
+@pytest.fixture(scope='module')
+def index():
+    rng = np.random.RandomState(0)
+    ids = np.arange(100, 300)
+    categories = np.array(['tops', 'shoes'] * 100, dtype=object)
+    return similarity.ExactIndex(ids, rng.randn(len(ids), 16), mask=0, categories=categories)
+
+
+def test_exact_index_finds_brute_force_neighbors(index):
+    query = np.random.RandomState(1).randn(16)
+    cosines = index.vectors @ (query / np.linalg.norm(query))
+
+    ids, distances = index.get_nns_by_vector(query, 5, include_distances=True)
+
+    assert ids == index.ids[np.argsort(-cosines)[:5]].tolist()
+    np.testing.assert_allclose(distances, np.sqrt(2 - 2 * np.sort(cosines)[::-1][:5]), atol=1e-5)
+
+
+def test_exact_index_item_queries(index):
+    assert 150 in index
+    assert 50 not in index
+    assert index.get_nns_by_item(150, 1) == [150]
+    assert len(index.get_nns_by_vector(index.get_item_vector(150), 1000)) == index.get_n_items()
+
+
+def test_exact_index_category_search(index):
+    ids, _ = index.get_nns_by_vector_in_category('shoes', index.get_item_vector(101), 10)
+
+    assert ids[0] == 101
+    assert all(index.categories[index.rows[i]] == 'shoes' for i in ids)
+
+
+def test_merged_exact_index(index):
+    other = similarity.ExactIndex(np.array([1000]), np.ones((1, 16)), mask=0, categories=np.array(['bags']))
+    merged = index.merged(other)
+
+    assert merged.get_n_items() == index.get_n_items() + 1
+    assert merged.get_nns_by_vector_in_category('bags', np.ones(16), 5)[0] == [1000]
+
+
+def test_mmr_without_diversity_keeps_relevance_order():
+    rng = np.random.RandomState(0)
+    relevance = rng.rand(20).astype(np.float32)
+    vectors = similarity.ExactIndex._normalize(rng.randn(20, 8))
+
+    assert similarity.mmr_rows(relevance, vectors, 5, 1.0) == np.argsort(-relevance)[:5].tolist()
+
+
+def test_mmr_skips_near_duplicates():
+    # Rows 0 and 1 are the same item, row 2 is slightly less relevant but different
+    vectors = np.array([[1, 0], [1, 0], [0, 1]], dtype=np.float32)
+    relevance = np.array([1.0, 0.99, 0.9], dtype=np.float32)
+
+    assert similarity.mmr_rows(relevance, vectors, 2, 1.0) == [0, 1]
+    assert similarity.mmr_rows(relevance, vectors, 2, 0.5) == [0, 2]
+    assert similarity.mmr_rows(relevance, vectors, 5, 0.5) == [0, 2, 1]
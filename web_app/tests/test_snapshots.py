@@ -0,0 +1,55 @@
+import pytest
+
+import snapshots
+
+
+@pytest.fixture(autouse=True)
+def clear_snapshots():
+    snapshots.SNAPSHOTS.clear()
+    yield
+    snapshots.SNAPSHOTS.clear()
+
+
+def snapshot(version: int) -> snapshots.UserSnapshot:
+    return snapshots.create_snapshot(1, 'user', version, {10: 'tops', 11: 'tops', 12: 'shoes'})
+
+
+def test_snapshot_groups_wardrobe_by_category():
+    assert snapshot(0).wardrobe_by_category == {'tops': frozenset([10, 11]), 'shoes': frozenset([12])}
+
+    changed = snapshot(0).with_wardrobe_item(13, 'bags').without_wardrobe_item(10)
+    assert changed.wardrobe_ids == {11, 12, 13}
+    assert changed.wardrobe_by_category['tops'] == {11}
+    assert changed.wardrobe_by_category['bags'] == {13}
+
+
+def test_snapshot_is_reloaded_on_a_new_version():
+    loads = []
+
+    def load(version: int):
+        loads.append(version)
+        return snapshot(version)
+
+    snapshots.get_snapshot(1, 0, lambda: load(0))
+    snapshots.get_snapshot(1, 0, lambda: load(0))
+    assert snapshots.get_snapshot(1, 1, lambda: load(1)).version == 1
+    assert loads == [0, 1]
+
+
+def test_update_applies_to_the_previous_version():
+    snapshots.get_snapshot(1, 3, lambda: snapshot(3))
+
+    updated = snapshots.update_snapshot(1, 4, lambda s: s.with_wardrobe_item(13, 'bags'))
+
+    assert updated.version == 4
+    assert 13 in updated.wardrobe_ids
+    assert snapshots.SNAPSHOTS.get(1) is updated
+
+
+def test_update_of_a_stale_version_drops_the_snapshot():
+    snapshots.get_snapshot(1, 3, lambda: snapshot(3))
+
+    # Another worker made the change to version 4, so this snapshot misses it
+    assert snapshots.update_snapshot(1, 5, lambda s: s.with_wardrobe_item(13, 'bags')) is None
+    assert snapshots.SNAPSHOTS.get(1) is None
+    assert snapshots.update_snapshot(1, 6, lambda s: s) is None
@@ -0,0 +1,12 @@
+import thumbnails
+
+
+def test_file_names_change_with_settings():
+    content_hash = thumbnails.image_hash(b'image')
+    name = thumbnails.thumbnail_file_name('item', content_hash, 128, 'jpg', 80)
+
+    assert name.startswith('item.') and name.endswith('.jpg')
+    assert name == thumbnails.thumbnail_file_name('item', content_hash, 128, 'jpg', 80)
+    assert name != thumbnails.thumbnail_file_name('item', content_hash, 128, 'jpg', 60)
+    assert name != thumbnails.thumbnail_file_name('item', content_hash, 200, 'jpg', 80)
+    assert name != thumbnails.thumbnail_file_name('item', thumbnails.image_hash(b'other'), 128, 'jpg', 80)
@@ -0,0 +1,45 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import triplets
+
+
+@pytest.mark.parametrize('n', [1, 2, 5, 17, 1000, 4097])
+def test_pages_form_a_permutation(n):
+    indices = [i for start in range(0, n, 7) for i in triplets.sample_indices(n, 3, start, 7)]
+
+    assert sorted(indices) == list(range(n))
+
+
+def test_sample_is_seeded():
+    assert triplets.sample_indices(1000, 5, 0, 50) == triplets.sample_indices(1000, 5, 0, 50)
+    assert triplets.sample_indices(1000, 5, 0, 50) != triplets.sample_indices(1000, 6, 0, 50)
+
+
+def test_sample_does_not_follow_file_position():
+    n = 3000000
+    indices = np.array(triplets.sample_indices(n, 7, 0, 10000))
+
+    # An arithmetic progression mod n has at most two distinct steps
+    assert len(set(np.diff(indices) % n)) > 100
+    assert abs(np.corrcoef(np.arange(len(indices)), indices)[0, 1]) < 0.05
+
+
+def test_pages_past_the_end_are_empty():
+    assert triplets.sample_indices(10, 0, 10, 5) == []
+
+
+def test_concurrent_indexing_leaves_one_offsets_file(tmp_path):
+    triplets_path = str(tmp_path / 'triplets.txt')
+    with open(triplets_path, 'w') as triplets_file:
+        triplets_file.write('a b c\nd e f\ng h i')
+
+    offsets_path = str(tmp_path / 'offsets.npy')
+    with ThreadPoolExecutor(4) as executor:
+        list(executor.map(lambda _: triplets.build_offsets(triplets_path, offsets_path), range(8)))
+
+    assert sorted(os.listdir(str(tmp_path))) == ['offsets.npy', 'triplets.txt']
+    assert triplets.TripletFile(triplets_path, offsets_path).line(2) == 'g h i'
@@ -0,0 +1,73 @@
+import pytest
+
+import validation
+
+
+def test_int_field():
+    assert validation.int_field({'mask': '3'}, 'mask', 0, 4) == 3
+
+    for query_json in ({}, {'mask': 'x'}, {'mask': None}, {'mask': 5}, {'mask': -1}):
+        with pytest.raises(validation.InvalidRequest):
+            validation.int_field(query_json, 'mask', 0, 4)
+
+
+def test_mask_weights():
+    assert validation.mask_weights({}) is None
+    assert validation.mask_weights({'weights': [1, 0, '0.5', 0, 0]}) == [1, 0, 0.5, 0, 0]
+
+    for weights in ([1, 1], [0, 0, 0, 0, 0], [1, -1, 0, 0, 0], [1, 'nan', 0, 0, 0], 'x'):
+        with pytest.raises(validation.InvalidRequest):
+            validation.mask_weights({'weights': weights})
+
+
+def test_diversity_lambda():
+    assert validation.diversity_lambda({'mmr_lambda': None}) is None
+    assert validation.diversity_lambda({'mmr_lambda': 0.5}) == 0.5
+
+    for mmr_lambda in (-0.1, 1.5, 'x', 'nan'):
+        with pytest.raises(validation.InvalidRequest):
+            validation.diversity_lambda({'mmr_lambda': mmr_lambda})
+
+
+def test_wardrobe_scope():
+    assert validation.wardrobe_scope({'wardrobe': True}) is True
+    assert validation.wardrobe_scope({'wardrobe': 'random'}) in (True, False)
+
+    with pytest.raises(validation.InvalidRequest):
+        validation.wardrobe_scope({})
+
+
+def test_int_list_field():
+    assert validation.int_list_field({'items': [1, '2']}, 'items') == [1, 2]
+
+    for query_json in ({}, {'items': '123'}, {'items': 123}, {'items': [1, 'x']}, {'items': [None]}):
+        with pytest.raises(validation.InvalidRequest):
+            validation.int_list_field(query_json, 'items')
+
+
+def test_json_object():
+    assert validation.json_object({'item_id': 1}) == {'item_id': 1}
+
+    for body in (None, [], 'item_id', 1):
+        with pytest.raises(validation.InvalidRequest):
+            validation.json_object(body)
+
+
+@pytest.mark.parametrize('path, body', [
+    ('/api/add_wardrobe_item', {}),
+    ('/api/add_wardrobe_item', {'item_id': 'x'}),
+    ('/api/remove_wardrobe_item', {'item_id': None}),
+    ('/api/create_outfit', {'items': '123'}),
+    ('/api/create_outfit', {'items': [1], 'name': 1}),
+    ('/api/delete_outfit', {'outfit_id': [1]}),
+    ('/api/complete_outfit', {'items': '123'}),
+    ('/api/recommend', []),
+])
+def test_malformed_requests_are_rejected(application, path, body):
+    client = application.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = 1
+
+    assert client.post(path, json=body).status_code == 400
+    assert client.post(path, data='item_id=1').status_code == 400
+    assert client.post(path, data='{', content_type='application/json').status_code == 400
@@ -0,0 +1,189 @@
+# Builds small thumbnails of every catalog image, named by a hash of the source image and the thumbnail settings so
+# their URLs can be cached forever. Run after the app has compiled the item catalog:
+#
+# python thumbnails.py --processes 8
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from argparse import ArgumentParser
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from catalog import Catalog
+from tables import item_path
+
+THUMBNAILS_DIR = 'data/thumbnails'
+MANIFEST_FILE_PATH = os.path.join(THUMBNAILS_DIR, 'manifest.json')
+# Content hash of each item's image by item id, 0 for items without thumbnails
+HASHES_FILE_PATH = os.path.join(THUMBNAILS_DIR, 'hashes.npy')
+
+# Longest side in pixels, about twice the size the pages display them at for high density screens
+THUMBNAIL_SIZES = {
+    'small': 128,
+    'medium': 200
+}
+THUMBNAIL_FORMATS = {
+    'jpg': 'JPEG',
+    'webp': 'WEBP'
+}
+DEFAULT_FORMAT = 'jpg'
+DEFAULT_QUALITY = 80
+
+# Thumbnail URLs change whenever their image does, so browsers can keep them indefinitely
+CACHE_SECONDS = 365 * 24 * 60 * 60
+
+MISSING_HASH = 0
+
+
+class ThumbnailTask(NamedTuple):
+    item_id: int
+    name: str
+    sizes: Dict[str, int]
+    ext: str
+    quality: int
+
+
+def thumbnail_file_name(name: str, content_hash: int, pixels: int, ext: str, quality: int) -> str:
+    # A rebuild with other settings writes new files, so cached thumbnails at the old URLs stay valid
+    settings_hash = image_hash('{:016x}:{}:{}:{}'.format(content_hash, pixels, ext, quality).encode())
+    return '{}.{:016x}.{}'.format(name, settings_hash, ext)
+
+
+def image_hash(data: bytes) -> int:
+    content_hash = int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+    return content_hash if content_hash != MISSING_HASH else 1
+
+
+def build_thumbnail(task: ThumbnailTask) -> Tuple[int, int]:
+    # Imported here, since only the builder needs Pillow
+    from PIL import Image
+
+    path = item_path(task.name)
+    if not os.path.exists(path):
+        return task.item_id, MISSING_HASH
+
+    with open(path, 'rb') as image_file:
+        content_hash = image_hash(image_file.read())
+
+    image = None
+    for size, pixels in task.sizes.items():
+        thumbnail_path = os.path.join(THUMBNAILS_DIR, size,
+                                      thumbnail_file_name(task.name, content_hash, pixels, task.ext, task.quality))
+        # Existing thumbnails have the same content, since their names include the image hash and settings
+        if os.path.exists(thumbnail_path):
+            continue
+
+        if image is None:
+            image = Image.open(path).convert('RGB')
+
+        thumbnail = image.copy()
+        thumbnail.thumbnail((pixels, pixels), Image.LANCZOS)
+
+        tmp_path = thumbnail_path + '.tmp'
+        thumbnail.save(tmp_path, THUMBNAIL_FORMATS[task.ext], quality=task.quality)
+        os.replace(tmp_path, thumbnail_path)
+
+    return task.item_id, content_hash
+
+
+def build_thumbnails(catalog: Catalog, sizes: Dict[str, int], ext: str = DEFAULT_FORMAT,
+                     quality: int = DEFAULT_QUALITY, processes: int = os.cpu_count()):
+    for size in sizes:
+        os.makedirs(os.path.join(THUMBNAILS_DIR, size), exist_ok=True)
+
+    item_ids = [item_id for item_id in range(len(catalog)) if item_id in catalog]
+    tasks = (ThumbnailTask(item_id, catalog.name(item_id), sizes, ext, quality) for item_id in item_ids)
+    hashes = np.zeros(len(catalog), dtype=np.uint64)
+
+    print('Building thumbnails for {} items.'.format(len(item_ids)))
+    start_time = time.time()
+    with multiprocessing.Pool(processes) as pool:
+        for i, (item_id, content_hash) in enumerate(pool.imap_unordered(build_thumbnail, tasks, chunksize=64)):
+            hashes[item_id] = content_hash
+            if (i + 1) % 10000 == 0:
+                print('\r{} / {} ({:.2f}s)'.format(i + 1, len(item_ids), time.time() - start_time), end='')
+    print()
+
+    # The manifest is written last, so the app never loads hashes of thumbnails that don't exist yet
+    tmp_path = HASHES_FILE_PATH + '.tmp'
+    with open(tmp_path, 'wb') as hashes_file:
+        np.save(hashes_file, hashes)
+    os.replace(tmp_path, HASHES_FILE_PATH)
+
+    with open(MANIFEST_FILE_PATH + '.tmp', 'w') as manifest_file:
+        json.dump({'format': ext, 'quality': quality, 'sizes': sizes}, manifest_file, indent=2)
+    os.replace(MANIFEST_FILE_PATH + '.tmp', MANIFEST_FILE_PATH)
+
+    print('Built thumbnails for {} items (took {:.2f}s)'.format(
+        int(np.count_nonzero(hashes)), time.time() - start_time))
+
+
+class Thumbnails:
+    def __init__(self):
+        with open(MANIFEST_FILE_PATH) as manifest_file:
+            manifest_json = json.load(manifest_file)
+
+        self.ext: str = manifest_json['format']
+        self.quality: int = manifest_json['quality']
+        self.sizes: Dict[str, int] = manifest_json['sizes']
+        self.hashes = np.load(HASHES_FILE_PATH, mmap_mode='r')
+
+    def url(self, item_id: int, name: str, size: str) -> Optional[str]:
+        if size not in self.sizes or not 0 <= item_id < len(self.hashes):
+            return None
+
+        content_hash = int(self.hashes[item_id])
+        if content_hash == MISSING_HASH:
+            return None
+
+        file_name = thumbnail_file_name(name, content_hash, self.sizes[size], self.ext, self.quality)
+        return '/thumbs/{}/{}'.format(size, file_name)
+
+
+THUMBNAILS: Optional[Thumbnails] = None
+
+
+def load_thumbnails():
+    global THUMBNAILS
+    if not os.path.exists(MANIFEST_FILE_PATH):
+        return
+
+    with open(MANIFEST_FILE_PATH) as manifest_file:
+        if 'quality' not in json.load(manifest_file):
+            # Built before file names included the settings, so none of its URLs exist
+            print('Thumbnails are out of date, run thumbnails.py to rebuild them.')
+            return
+
+    THUMBNAILS = Thumbnails()
+
+
+def thumbnail_url(item, size: str = 'small') -> str:
+    # Items without a thumbnail, like items added after the last build, use their full size image
+    url = THUMBNAILS.url(item.id, item.name, size) if THUMBNAILS is not None else None
+    return url if url is not None else item.get_path()
+
+
+if __name__ == '__main__':
+    from similarity import CATALOG_DIR
+
+    parser = ArgumentParser()
+    parser.add_argument('--catalog-dir', '-c', type=str, default=CATALOG_DIR)
+    parser.add_argument('--format', '-f', type=str, choices=list(THUMBNAIL_FORMATS), default=DEFAULT_FORMAT)
+    parser.add_argument('--quality', '-q', type=int, default=DEFAULT_QUALITY)
+    parser.add_argument('--sizes', '-s', type=str, nargs='+', choices=list(THUMBNAIL_SIZES),
+                        default=list(THUMBNAIL_SIZES))
+    parser.add_argument('--processes', '-p', type=int, default=os.cpu_count())
+
+    args = parser.parse_args()
+    print(args)
+
+    build_thumbnails(
+        catalog=Catalog(args.catalog_dir),
+        sizes={s: THUMBNAIL_SIZES[s] for s in args.sizes},
+        ext=args.format,
+        quality=args.quality,
+        processes=args.processes
+    )
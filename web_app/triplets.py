@@ -1,21 +1,108 @@
+import mmap
 import os
 import random
-from typing import List
+import tempfile
+from typing import List, Optional
 
-lines: List[str] = []
+import numpy as np
 
+TRIPLETS_FILE_PATH = 'data/triplets.txt'
+# Byte offset of the start of every line, followed by the end of the file
+OFFSETS_FILE_PATH = 'data/triplets_offsets.npy'
+SCAN_CHUNK_SIZE = 16 * 1024 * 1024
+FEISTEL_ROUNDS = 6
 
-def get_triplets(count: int = 1000):
-    global lines
-    if len(lines) == 0:
-        with open('data/triplets.txt') as triplets_file:
-            for line in triplets_file:
-                lines.append(line)
 
-    triplets = []
-    for line in random.sample(lines, count):
-        names = line.strip('\n').split(' ')
-        t = [os.path.join('static/images', n + '.jpg') for n in names]
-        triplets.append(t)
+def build_offsets(triplets_path: str, offsets_path: str):
+    print('Indexing triplet lines.')
+    starts = [np.zeros(1, dtype=np.int64)]
+    size = 0
 
-    return triplets
+    with open(triplets_path, 'rb') as triplets_file:
+        while True:
+            chunk = triplets_file.read(SCAN_CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+            starts.append(newlines.astype(np.int64) + size + 1)
+            size += len(chunk)
+
+    offsets = np.concatenate(starts)
+    # A last line without a newline still ends at the end of the file
+    if offsets[-1] != size:
+        offsets = np.append(offsets, size)
+
+    # Workers that start together may all index the file, so each writes its own temporary file
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(offsets_path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as offsets_file:
+            np.save(offsets_file, offsets)
+        os.replace(tmp_path, offsets_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    print('Indexed {} triplets.'.format(len(offsets) - 1))
+
+
+class TripletFile:
+    def __init__(self, triplets_path: str = TRIPLETS_FILE_PATH, offsets_path: str = OFFSETS_FILE_PATH):
+        if not os.path.exists(offsets_path) or os.path.getmtime(offsets_path) < os.path.getmtime(triplets_path):
+            build_offsets(triplets_path, offsets_path)
+
+        self.offsets = np.load(offsets_path, mmap_mode='r')
+        with open(triplets_path, 'rb') as triplets_file:
+            self.data = mmap.mmap(triplets_file.fileno(), 0, access=mmap.ACCESS_READ) if len(self) > 0 else b''
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def line(self, i: int) -> str:
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode('utf-8').strip('\n')
+
+
+triplet_file: Optional[TripletFile] = None
+
+
+def mix(x: np.ndarray) -> np.ndarray:
+    # splitmix64 finalizer, which spreads every input bit over the whole output
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def sample_indices(n: int, seed: int, start: int, count: int) -> List[int]:
+    # Positions start..start+count of a seeded pseudo-random permutation of range(n), so pages never repeat lines and
+    # no permutation of all lines is ever materialized. The permutation is a keyed Feistel network over the smallest
+    # even number of bits that covers n, and positions it maps past n are mapped again until they land inside.
+    half_bits = max(((n - 1).bit_length() + 1) // 2, 1)
+    half_mask = np.uint64((1 << half_bits) - 1)
+    rng = random.Random(seed)
+    round_keys = [np.uint64(rng.getrandbits(64)) for _ in range(FEISTEL_ROUNDS)]
+
+    indices = np.arange(start, min(start + count, n), dtype=np.uint64)
+    pending = np.arange(len(indices))
+    while len(pending) > 0:
+        left = indices[pending] >> np.uint64(half_bits)
+        right = indices[pending] & half_mask
+        for key in round_keys:
+            left, right = right, left ^ (mix(right ^ key) & half_mask)
+
+        indices[pending] = (left << np.uint64(half_bits)) | right
+        pending = pending[indices[pending] >= np.uint64(n)]
+
+    return indices.astype(np.int64).tolist()
+
+
+def get_triplets(count: int = 1000, seed: Optional[int] = None, page: int = 0) -> List[List[str]]:
+    global triplet_file
+    if triplet_file is None:
+        triplet_file = TripletFile()
+
+    if len(triplet_file) == 0:
+        return []
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+
+    # Item names of each triplet
+    return [triplet_file.line(i).split(' ') for i in sample_indices(len(triplet_file), seed, page * count, count)]
@@ -0,0 +1,88 @@
+# Parsing of the JSON fields shared by the API routes of app.py and async_app.py. Invalid fields raise
+# InvalidRequest, which each app turns into a 400 response with its message.
+import math
+import random
+from typing import Dict, List, Optional
+
+import similarity
+
+
+class InvalidRequest(ValueError):
+    pass
+
+
+def int_field(query_json: Dict, key: str, low: Optional[int] = None, high: Optional[int] = None) -> int:
+    try:
+        value = int(query_json[key])
+    except KeyError:
+        raise InvalidRequest('{} is required.'.format(key))
+    except (TypeError, ValueError):
+        raise InvalidRequest('{} must be an integer.'.format(key))
+
+    if (low is not None and value < low) or (high is not None and value > high):
+        raise InvalidRequest('{} must be between {} and {}.'.format(key, low, high))
+
+    return value
+
+
+def int_list_field(query_json: Dict, key: str) -> List[int]:
+    values = query_json.get(key)
+    # Checked first since a string is iterable too, which would read '123' as [1, 2, 3]
+    if not isinstance(values, list):
+        raise InvalidRequest('{} must be a list of integers.'.format(key))
+
+    try:
+        return [int(v) for v in values]
+    except (TypeError, ValueError):
+        raise InvalidRequest('{} must be a list of integers.'.format(key))
+
+
+def json_object(body) -> Dict:
+    # Also rejects bodies that aren't JSON at all, which are parsed as None
+    if not isinstance(body, dict):
+        raise InvalidRequest('The request body must be a JSON object.')
+
+    return body
+
+
+def mask_weights(query_json: Dict) -> Optional[List[float]]:
+    # Optional weights of the full embedding and each mask, e.g. [0, 1, 0, 0.5, 0], for fused queries
+    if 'weights' not in query_json:
+        return None
+
+    weights = query_json['weights']
+    if not isinstance(weights, list) or len(weights) != similarity.NUM_MASKS + 1:
+        raise InvalidRequest('weights must be a list of {} numbers.'.format(similarity.NUM_MASKS + 1))
+
+    try:
+        weights = [float(w) for w in weights]
+    except (TypeError, ValueError):
+        raise InvalidRequest('weights must be a list of {} numbers.'.format(similarity.NUM_MASKS + 1))
+    if not all(math.isfinite(w) and w >= 0 for w in weights) or sum(weights) <= 0:
+        raise InvalidRequest('weights must be non-negative with a positive sum.')
+
+    return weights
+
+
+def diversity_lambda(query_json: Dict) -> Optional[float]:
+    # Optional trade-off between relevance (1) and diversity (0) of the results of each category
+    if query_json.get('mmr_lambda') is None:
+        return None
+
+    try:
+        mmr_lambda = float(query_json['mmr_lambda'])
+    except (TypeError, ValueError):
+        raise InvalidRequest('mmr_lambda must be a number.')
+    if not 0 <= mmr_lambda <= 1:
+        raise InvalidRequest('mmr_lambda must be between 0 and 1.')
+
+    return mmr_lambda
+
+
+def wardrobe_scope(query_json: Dict) -> bool:
+    # Whether a recommendation searches the user's wardrobe or the catalog, where "random" picks either
+    wardrobe = query_json.get('wardrobe')
+    if wardrobe not in (True, False, 'random'):
+        raise InvalidRequest('wardrobe must be true, false or "random".')
+
+    return random.choice((True, False)) if wardrobe == 'random' else wardrobe